@@ -0,0 +1,1578 @@
+# bench_midimaster.py
+"""
+Benchmarks de midimaster. No necesitan hardware MIDI.
+Uso: python bench_midimaster.py <caso> [opciones]   (python bench_midimaster.py -h para la lista)
+"""
+import argparse
+import bisect
+import json
+import platform
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import mido
+import mido.ports
+from pythonosc.osc_message_builder import OscMessageBuilder
+from pythonosc.udp_client import SimpleUDPClient
+
+import midimaster
+
+
+# --- Backend MIDI falso ---
+class FakeRtMidiOut:
+    """
+    Imita el objeto rtmidi.MidiOut: send_message() recibe los bytes y no hace nada más.
+    Con record=True guarda el instante (perf_counter_ns) de cada envío; delay_s simula un puerto lento.
+    """
+    def __init__(self, record=False, delay_s=0.0):
+        self.sent = 0
+        self.record = record
+        self.delay_s = delay_s
+        self.timestamps = []
+        self.messages = [] # Bytes de cada envío, con record=True
+
+    def send_message(self, data):
+        if self.delay_s:
+            time.sleep(self.delay_s)
+        if self.record:
+            self.timestamps.append(time.perf_counter_ns())
+            self.messages.append(bytes(data))
+        self.sent += 1
+
+
+class FakeOutput(mido.ports.BaseOutput):
+    """Puerto de salida con la misma estructura que el backend rtmidi de mido (atributo _rt)."""
+    def _open(self, record=False, delay_s=0.0, **kwargs):
+        self._rt = FakeRtMidiOut(record, delay_s)
+
+    def _send(self, msg):
+        self._rt.send_message(msg.bytes())
+
+
+def _print_results(name, results, as_json):
+    if as_json:
+        print(json.dumps({"benchmark": name, "results": results}))
+        return results
+    print(f"--- {name} ---")
+    for key, value in results.items():
+        print(f"  {key}: {value}")
+    return results
+
+
+# --- soak: deriva de la rejilla de tempo en sesiones largas ---
+def bench_soak(args):
+    """
+    Simula horas de pulsos sin dormir y compara, contra la rejilla ideal exacta,
+    la acumulación clásica en float (t += intervalo) y la TempoGrid en ns enteros.
+    """
+    bpm = args.bpm
+    total_pulses = int(args.hours * 3600 * bpm * midimaster.PPQN / 60)
+    base_s = args.uptime_hours * 3600.0 # perf_counter no empieza en cero en un equipo encendido
+    base_ns = int(base_s * 1e9)
+
+    tempo = midimaster.bpm_to_fraction(bpm)
+    ideal_num = midimaster.NS_PER_MINUTE * tempo.denominator
+    ideal_den = tempo.numerator * midimaster.PPQN
+
+    float_interval = 60.0 / (bpm * midimaster.PPQN)
+    float_time = base_s
+    grid = midimaster.TempoGrid(bpm)
+    grid.start(base_ns)
+
+    max_float_drift = 0.0
+    max_grid_drift = 0.0
+    for n in range(1, total_pulses + 1):
+        float_time += float_interval
+        if n % args.sample_every == 0 or n == total_pulses:
+            ideal_ns = base_ns + n * ideal_num / ideal_den
+            max_float_drift = max(max_float_drift, abs(float_time * 1e9 - ideal_ns))
+            max_grid_drift = max(max_grid_drift, abs(grid.deadline(n) - ideal_ns))
+
+    ideal_end_ns = base_ns + total_pulses * ideal_num / ideal_den
+    results = {
+        "bpm": bpm,
+        "hours": args.hours,
+        "pulses": total_pulses,
+        "float_final_drift_us": round((float_time * 1e9 - ideal_end_ns) / 1000, 3),
+        "float_max_drift_us": round(max_float_drift / 1000, 3),
+        "grid_final_drift_us": round((grid.deadline(total_pulses) - ideal_end_ns) / 1000, 3),
+        "grid_max_drift_us": round(max_grid_drift / 1000, 3),
+    }
+    return _print_results("soak", results, args.json)
+
+
+# --- fanout: coste por pulso de enviar el clock a muchos puertos ---
+def _legacy_clock_pulse(ports):
+    """Camino anterior: un mido.Message nuevo por pulso y port.send() por puerto."""
+    clock_message = mido.Message('clock')
+    for port in ports:
+        try:
+            port.send(clock_message)
+        except Exception: pass
+
+
+def bench_fanout(args):
+    """Compara el coste de CPU por pulso del camino mido clásico con el de bytes precodificados."""
+    results = {"pulses": args.pulses}
+    for port_count in args.ports:
+        ports = [FakeOutput(f"fake_{i}") for i in range(port_count)]
+        midimaster.set_output_ports(ports)
+
+        t0 = time.process_time_ns()
+        for _ in range(args.pulses):
+            _legacy_clock_pulse(ports)
+        legacy_ns = (time.process_time_ns() - t0) / args.pulses
+
+        send_realtime = midimaster.send_realtime
+        clock_bytes = midimaster.CLOCK_BYTES
+        t0 = time.process_time_ns()
+        for _ in range(args.pulses):
+            send_realtime(clock_bytes)
+        fast_ns = (time.process_time_ns() - t0) / args.pulses
+
+        results[f"legacy_us_per_pulse_{port_count}p"] = round(legacy_ns / 1000, 3)
+        results[f"fast_us_per_pulse_{port_count}p"] = round(fast_ns / 1000, 3)
+        results[f"speedup_{port_count}p"] = round(legacy_ns / fast_ns, 2) if fast_ns else None
+    midimaster.set_output_ports([])
+    return _print_results("fanout", results, args.json)
+
+
+# --- skew: retraso de cada puerto respecto al deadline con un puerto lento en la lista ---
+def _percentile(sorted_values, fraction):
+    if not sorted_values: return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def _run_skew(mode, port_count, slow_delay_s, pulses, bpm):
+    midimaster.main_config = {"clock_engine": dict(midimaster.CLOCK_ENGINE_DEFAULTS, fanout=mode)}
+    # El puerto lento va el primero: en serie retrasa a todos los que le siguen
+    ports = [FakeOutput("slow_0", record=True, delay_s=slow_delay_s)]
+    ports += [FakeOutput(f"fake_{i}", record=True) for i in range(1, port_count)]
+    midimaster.set_output_ports(ports)
+    timer = midimaster.get_precision_timer()
+
+    grid = midimaster.TempoGrid(bpm)
+    grid.start(time.perf_counter_ns() + 20_000_000)
+    deadlines = []
+    for _ in range(pulses):
+        deadline = grid.next_deadline()
+        timer.wait_until(deadline - midimaster.performance_state.fanout_lead_ns)
+        midimaster.send_realtime(midimaster.CLOCK_BYTES, deadline)
+        deadlines.append(deadline)
+        grid.advance()
+    time.sleep(0.05 + slow_delay_s * 2) # Dejar que los workers vacíen sus colas
+    midimaster.set_output_ports([])
+
+    skews = [] # Retraso (ns) de los puertos rápidos respecto al deadline de cada pulso
+    for port in ports[1:]:
+        for deadline, sent_ns in zip(deadlines, port._rt.timestamps):
+            skews.append(sent_ns - deadline)
+    skews.sort()
+    return {
+        "p50_us": round(_percentile(skews, 0.5) / 1000, 1),
+        "p99_us": round(_percentile(skews, 0.99) / 1000, 1),
+        "max_us": round((skews[-1] if skews else 0) / 1000, 1),
+        "slow_port_sent": ports[0]._rt.sent,
+    }
+
+
+def bench_skew(args):
+    """Mide el retraso de los puertos rápidos con un puerto lento delante, en fanout serie e hilos."""
+    results = {"ports": args.ports, "slow_port_delay_ms": args.slow_ms, "pulses": args.pulses}
+    for mode in ("serial", "threaded"):
+        for key, value in _run_skew(mode, args.ports, args.slow_ms / 1000.0, args.pulses, args.bpm).items():
+            results[f"{mode}_{key}"] = value
+    return _print_results("skew", results, args.json)
+
+
+# --- dispatch: rendimiento del despachador de reglas ---
+def _legacy_match_count(msg, port_name, mappings, aliases):
+    """Recorrido lineal anterior de process_midi_mappings; devuelve cuántos mapeos coinciden."""
+    matched = 0
+    for mapping in mappings:
+        dev_alias = mapping.get("device_in")
+        if dev_alias:
+            dev_substr = aliases.get(dev_alias, dev_alias)
+            if dev_substr.lower() not in port_name.lower():
+                continue
+        else: continue
+        if "ch_in" in mapping:
+            if hasattr(msg, 'channel'):
+                if msg.channel != mapping["ch_in"]:
+                    continue
+            else:
+                continue
+        map_event = mapping.get("event_in")
+        is_event_match = False
+        if map_event:
+            if map_event == "note" and msg.type in ["note_on", "note_off"]: is_event_match = True
+            elif map_event == "cc" and msg.type == "control_change": is_event_match = True
+            elif map_event == "pc" and msg.type == "program_change": is_event_match = True
+            elif msg.type == map_event: is_event_match = True
+        if not is_event_match: continue
+        if "value_1_in" in mapping:
+            msg_v1 = getattr(msg, 'note', None)
+            if msg_v1 is None: msg_v1 = getattr(msg, 'control', None)
+            if msg_v1 is None: msg_v1 = getattr(msg, 'program', None)
+            if msg_v1 is None: msg_v1 = -1
+            if msg.type in ["note_on", "note_off", "control_change", "program_change"]:
+                if msg_v1 != mapping["value_1_in"]:
+                    continue
+            else:
+                continue
+        matched += 1
+    return matched
+
+
+def synthetic_rules(rule_count, port_count, rng):
+    """Reglas aleatorias repartidas entre port_count dispositivos, con algunos comodines."""
+    aliases = {f"dev{i}": f"Fake Device {i}" for i in range(port_count)}
+    mappings = []
+    for _ in range(rule_count):
+        mapping = {"device_in": f"dev{rng.randrange(port_count)}", "event_in": rng.choice(("note", "cc", "cc", "pc", "note_on"))}
+        if rng.random() < 0.9: mapping["ch_in"] = rng.randrange(16)
+        if rng.random() < 0.95: mapping["value_1_in"] = rng.randrange(128)
+        mappings.append(mapping)
+    return aliases, mappings
+
+
+def synthetic_stream(message_count, port_count, rng):
+    """Mensajes aleatorios (mayoría CC, como un barrido de faders) con el puerto de origen."""
+    stream = []
+    for _ in range(message_count):
+        port_name = f"Fake Device {rng.randrange(port_count)}:0"
+        kind = rng.random()
+        channel = rng.randrange(16)
+        if kind < 0.7:
+            msg = mido.Message('control_change', channel=channel, control=rng.randrange(128), value=rng.randrange(128))
+        elif kind < 0.9:
+            msg = mido.Message('note_on', channel=channel, note=rng.randrange(128), velocity=100)
+        else:
+            msg = mido.Message('program_change', channel=channel, program=rng.randrange(128))
+        stream.append((msg, port_name))
+    return stream
+
+
+def bench_dispatch(args):
+    """Mensajes por segundo del recorrido lineal frente al despachador compilado, con muchas reglas."""
+    rng = random.Random(args.seed)
+    results = {"messages": args.messages}
+    counter = [0]
+    def count_match(msg): counter[0] += 1
+    midimaster.RULE_ACTIONS["bench_count"] = (lambda mapping: count_match, None)
+    try:
+        for rule_count in args.rules:
+            aliases, mappings = synthetic_rules(rule_count, args.ports, rng)
+            for mapping in mappings: mapping["action"] = "bench_count"
+            stream = synthetic_stream(args.messages, args.ports, rng)
+
+            legacy_matches = 0
+            t0 = time.perf_counter_ns()
+            for msg, port_name in stream:
+                legacy_matches += _legacy_match_count(msg, port_name, mappings, aliases)
+            legacy_s = (time.perf_counter_ns() - t0) / 1e9
+
+            compile_t0 = time.perf_counter_ns()
+            dispatcher = midimaster.RuleDispatcher(mappings, aliases)
+            for i in range(args.ports): dispatcher.table_for_port(f"Fake Device {i}:0")
+            compile_ms = (time.perf_counter_ns() - compile_t0) / 1e6
+
+            counter[0] = 0
+            t0 = time.perf_counter_ns()
+            for msg, port_name in stream:
+                dispatcher.dispatch(msg, port_name)
+            compiled_s = (time.perf_counter_ns() - t0) / 1e9
+
+            results[f"legacy_msgs_per_s_{rule_count}r"] = round(args.messages / legacy_s)
+            results[f"compiled_msgs_per_s_{rule_count}r"] = round(args.messages / compiled_s)
+            results[f"compile_ms_{rule_count}r"] = round(compile_ms, 2)
+            results[f"matches_{rule_count}r"] = counter[0]
+            results[f"matches_equal_{rule_count}r"] = legacy_matches == counter[0]
+    finally:
+        del midimaster.RULE_ACTIONS["bench_count"]
+    return _print_results("dispatch", results, args.json)
+
+
+# --- reload: recarga en caliente de las reglas con el clock en marcha ---
+def _rule_file_text(aliases, mappings, version):
+    """Archivo de reglas como los de rules_midimaster/: con comentarios // y input_mappings."""
+    lines = ["{", f"  // Reglas sintéticas, versión {version}", f'  "device_alias": {json.dumps(aliases)},', '  "input_mappings": [']
+    lines += [f"    {json.dumps(mapping)}, // regla {i}" for i, mapping in enumerate(mappings)]
+    lines += ["  ]", "}"]
+    return "\n".join(lines)
+
+
+def bench_reload(args):
+    """
+    Carga un archivo de reglas sintético con comentarios, lo reescribe y recarga --reloads veces con
+    el clock sonando mientras otro hilo despacha mensajes sin parar, y compara la latencia de despacho
+    y el error de los pulsos con los de una ventana igual sin recargas. Mide también la recarga
+    sin cambios (caché por mtime) frente a la compilación completa.
+    """
+    rng = random.Random(args.seed)
+    midimaster.main_config = {"clock_engine": dict(midimaster.CLOCK_ENGINE_DEFAULTS)}
+    aliases, mappings = synthetic_rules(args.rules, args.ports, rng)
+    for mapping in mappings: mapping["action"] = "bench_count"
+    port_names = [f"Fake Device {i}:0" for i in range(args.ports)]
+    stream = synthetic_stream(5000, args.ports, rng)
+    midimaster.RULE_ACTIONS["bench_count"] = (lambda mapping: (lambda msg: None), None)
+    midimaster._port_names.update(inputs=port_names, outputs=[]) # Enumeración ya hecha: no se toca el backend
+    for name in port_names: midimaster.midi_input_ports[name] = None # Ya "abiertas": no se abre nada
+    workdir = tempfile.mkdtemp(prefix="midimaster-reload-")
+    path = Path(workdir) / "bench.json"
+    path.write_text(_rule_file_text(aliases, mappings, 0), encoding="utf-8")
+    # Las versiones se generan antes de medir: en la ventana solo se escriben y se recargan
+    versions = [_rule_file_text(aliases, [dict(mapping, ch_in=rng.randrange(16)) if rng.random() < 0.1 else mapping
+                                          for mapping in mappings], k + 1) for k in range(args.reloads)]
+    messages = []
+    try:
+        midimaster.load_rule_file(path)
+        midimaster.rebuild_rule_dispatcher(port_names)
+        midimaster.start_rule_parser() # Como RuleWatcher al arrancar: el proceso de lectura ya está listo
+        midimaster.set_output_ports([FakeOutput("fake_0")])
+        thread = _start_clock_thread(args.bpm)
+
+        stop = threading.Event()
+        latencies = []
+        def dispatch_loop():
+            process, now, i = midimaster.process_midi_mappings, time.perf_counter_ns, 0
+            while not stop.is_set():
+                msg, port_name = stream[i % len(stream)]
+                t0 = now()
+                process(msg, port_name)
+                latencies.append((t0, now() - t0))
+                i += 1
+                if i % 4 == 0: time.sleep(0.001) # ~4000 mensajes/s: un controlador muy activo
+        dispatcher_thread = threading.Thread(target=dispatch_loop, daemon=True)
+        dispatcher_thread.start()
+
+        def window(reloads):
+            """Una ventana de args.seconds; con reloads, reescribe y recarga las reglas repartidas en ella."""
+            start_ns = time.perf_counter_ns()
+            pulses_before = midimaster.timing_stats.pulses
+            reload_ms = []
+            for k in range(reloads):
+                time.sleep(args.seconds / reloads)
+                path.write_text(versions[k], encoding="utf-8")
+                t0 = time.perf_counter_ns()
+                midimaster.reload_rule_files(messages.append)
+                reload_ms.append((time.perf_counter_ns() - t0) / 1e6)
+            if not reloads: time.sleep(args.seconds)
+            end_ns = time.perf_counter_ns()
+            window_latencies = sorted(latency for t0, latency in latencies if start_ns <= t0 < end_ns)
+            summary = midimaster.timing_stats.summary()
+            return window_latencies, reload_ms, midimaster.timing_stats.pulses - pulses_before, summary
+
+        midimaster.timing_stats = midimaster.TimingStats()
+        base_latencies, _, base_pulses, base_timing = window(0)
+        midimaster.timing_stats = midimaster.TimingStats()
+        reload_latencies, reload_ms, reload_pulses, reload_timing = window(args.reloads)
+
+        t0 = time.perf_counter_ns()
+        midimaster.reload_rule_files(messages.append) # Sin cambios: sale de la caché
+        cached_ms = (time.perf_counter_ns() - t0) / 1e6
+        stop.set()
+        dispatcher_thread.join(timeout=1.0)
+        _stop_clock_thread(thread)
+    finally:
+        del midimaster.RULE_ACTIONS["bench_count"]
+        midimaster.stop_rule_parser()
+        midimaster.midi_input_ports.clear()
+        midimaster.loaded_rule_files.clear()
+        midimaster.set_output_ports([])
+
+    reload_ms.sort()
+    results = {"rules": args.rules, "reloads": args.reloads, "seconds_per_window": args.seconds,
+               "reload_p50_ms": round(_percentile(reload_ms, 0.5), 2), "reload_max_ms": round(reload_ms[-1], 2),
+               "reload_cached_ms": round(cached_ms, 3), "last_message": messages[-1] if messages else ""}
+    for name, window_latencies, pulses, timing in (("steady", base_latencies, base_pulses, base_timing),
+                                                   ("reloading", reload_latencies, reload_pulses, reload_timing)):
+        results[f"{name}_dispatches"] = len(window_latencies)
+        results[f"{name}_dispatch_p50_us"] = round(_percentile(window_latencies, 0.5) / 1000, 1)
+        results[f"{name}_dispatch_p99_us"] = round(_percentile(window_latencies, 0.99) / 1000, 1)
+        results[f"{name}_dispatch_max_us"] = round(window_latencies[-1] / 1000, 1) if window_latencies else 0
+        results[f"{name}_pulses"] = pulses
+        results[f"{name}_pulse_p99_us"] = round(timing["p99_ns"] / 1000, 1)
+        results[f"{name}_pulse_max_us"] = round(timing["max_ns"] / 1000, 1)
+    return _print_results("reload", results, args.json)
+
+
+# --- coalesce: barrido de fader sobre el BPM con el clock en marcha ---
+class CountingOscClient:
+    """Cliente OSC falso que solo cuenta los mensajes enviados."""
+    def __init__(self):
+        self.sent = 0
+
+    def send_message(self, address, value):
+        self.sent += 1
+
+
+def _start_clock_thread(bpm):
+    midimaster.SHUTDOWN_FLAG = False
+    midimaster.performance_state.bpm = bpm
+    midimaster.performance_state.status = "STOPPED"
+    thread = threading.Thread(target=midimaster.midi_clock_sender, daemon=True)
+    thread.start()
+    midimaster.play_clock()
+    return thread
+
+
+def _stop_clock_thread(thread):
+    midimaster.performance_state.status = "STOPPED"
+    midimaster.SHUTDOWN_FLAG = True
+    midimaster.wake_clock_engine()
+    thread.join(timeout=1.0)
+
+
+def bench_coalesce(args):
+    """Envía un barrido rápido de CCs de BPM y cuenta cuántos cambios de tempo y ecos OSC produce."""
+    midimaster.main_config = {"clock_engine": dict(midimaster.CLOCK_ENGINE_DEFAULTS)}
+    osc = CountingOscClient()
+    midimaster.osc_client = osc
+    midimaster.set_output_ports([FakeOutput("fake_0")])
+    coalescer = midimaster.bpm_coalescer
+    requests_before, applied_before = coalescer.requests, coalescer.applied
+
+    thread = _start_clock_thread(args.bpm)
+    interval = args.seconds / args.messages
+    t0 = time.perf_counter()
+    for i in range(args.messages):
+        midimaster.set_bpm(args.bpm + 40.0 * i / args.messages)
+        time.sleep(max(0.0, t0 + (i + 1) * interval - time.perf_counter()))
+    time.sleep(0.2) # Dejar que se apliquen el último tempo y su eco
+    _stop_clock_thread(thread)
+    midimaster.osc_client = None
+    midimaster.set_output_ports([])
+
+    results = {
+        "cc_messages": args.messages,
+        "seconds": args.seconds,
+        "bpm_requests": coalescer.requests - requests_before,
+        "tempo_updates_applied": coalescer.applied - applied_before,
+        "osc_echoes": osc.sent,
+        "final_bpm": round(midimaster.performance_state.bpm, 2),
+    }
+    return _print_results("coalesce", results, args.json)
+
+
+# --- startlat: latencia desde la llegada de Play hasta el start y el primer clock ---
+def _wait_for(condition, timeout_s=1.0):
+    limit = time.perf_counter() + timeout_s
+    while not condition() and time.perf_counter() < limit:
+        time.sleep(0.001)
+
+
+def bench_startlat(args):
+    """
+    Con el clock en reposo, envía Play a instantes aleatorios y mide cuánto tarda en salir el
+    start (0xFA) y el primer clock (0xF8), que por diseño va un intervalo de pulso después.
+    """
+    midimaster.main_config = {"clock_engine": dict(midimaster.CLOCK_ENGINE_DEFAULTS)}
+    port = FakeOutput("fake_0", record=True)
+    midimaster.set_output_ports([port])
+    sent = port._rt.timestamps
+    rng = random.Random(args.seed)
+    period_ns = midimaster.TempoGrid(args.bpm).nominal_period_ns()
+    midimaster.get_precision_timer() # La calibración del temporizador no cuenta como latencia
+
+    midimaster.SHUTDOWN_FLAG = False
+    midimaster.performance_state.bpm = args.bpm
+    midimaster.performance_state.status = "STOPPED"
+    thread = threading.Thread(target=midimaster.midi_clock_sender, daemon=True)
+    thread.start()
+    to_start, to_clock = [], []
+    for _ in range(args.trials):
+        time.sleep(rng.uniform(0.005, 0.03)) # Play en cualquier fase del antiguo sondeo de 10 ms
+        first = len(sent)
+        command_ns = time.perf_counter_ns()
+        midimaster.play_clock()
+        _wait_for(lambda: len(sent) >= first + 2)
+        if len(sent) >= first + 2:
+            to_start.append(sent[first] - command_ns)
+            to_clock.append(sent[first + 1] - command_ns)
+        midimaster.stop_clock()
+        _wait_for(lambda: midimaster.performance_state.status == "STOPPED")
+    _stop_clock_thread(thread)
+    midimaster.set_output_ports([])
+
+    to_start.sort()
+    to_clock.sort()
+    overhead = [value - period_ns for value in to_clock]
+    results = {
+        "bpm": args.bpm,
+        "trials": len(to_clock),
+        "pulse_interval_ms": round(period_ns / 1e6, 3),
+        "command_to_start_p50_us": round(_percentile(to_start, 0.5) / 1000, 1),
+        "command_to_start_max_us": round((to_start[-1] if to_start else 0) / 1000, 1),
+        "command_to_first_clock_p50_ms": round(_percentile(to_clock, 0.5) / 1e6, 3),
+        "command_to_first_clock_max_ms": round((to_clock[-1] if to_clock else 0) / 1e6, 3),
+        "first_clock_minus_interval_p50_us": round(_percentile(overhead, 0.5) / 1000, 1),
+        "first_clock_minus_interval_max_us": round((overhead[-1] if overhead else 0) / 1000, 1),
+    }
+    return _print_results("startlat", results, args.json)
+
+
+# --- jitter: error de cada pulso del motor de clock real respecto a su deadline ---
+def bench_jitter(args):
+    """
+    Hace sonar el ClockEngine contra un puerto falso a varios tempos y resume el error de
+    cada pulso (registro de timing) y la desviación de los intervalos entre pulsos recibidos.
+    """
+    results = {"seconds": args.seconds, "precision": args.precision, "realtime": args.realtime}
+    for bpm in args.bpm:
+        midimaster.main_config = {"clock_engine": dict(midimaster.CLOCK_ENGINE_DEFAULTS, precision=args.precision,
+                                                       realtime=args.realtime, rt_cpu=args.rt_cpu)}
+        midimaster.timing_stats = midimaster.TimingStats()
+        midimaster.performance_state.late_pulses = 0
+        port = FakeOutput("fake_0", record=True)
+        midimaster.set_output_ports([port])
+        thread = _start_clock_thread(bpm)
+        time.sleep(args.seconds)
+        _stop_clock_thread(thread)
+        midimaster.set_output_ports([])
+
+        summary = midimaster.timing_stats.summary()
+        period_ns = midimaster.TempoGrid(bpm).nominal_period_ns()
+        sent = port._rt.timestamps[1:-1] # Sin el start ni el stop
+        interval_errors = sorted(abs((b - a) - period_ns) for a, b in zip(sent, sent[1:]))
+        key = f"{bpm:g}bpm"
+        results[f"{key}_pulses"] = summary["pulses"]
+        results[f"{key}_p50_us"] = round(summary["p50_ns"] / 1000, 1)
+        results[f"{key}_p99_us"] = round(summary["p99_ns"] / 1000, 1)
+        results[f"{key}_max_us"] = round(summary["max_ns"] / 1000, 1)
+        results[f"{key}_late"] = summary["late"]
+        results[f"{key}_missed"] = summary["missed"]
+        results[f"{key}_interval_p99_us"] = round(_percentile(interval_errors, 0.99) / 1000, 1)
+    if args.realtime:
+        results["realtime_report"] = midimaster.performance_state.realtime_report
+    return _print_results("jitter", results, args.json)
+
+
+# --- follow: clock externo con jitter regenerado por el modo --follow ---
+def bench_follow(args):
+    """
+    Alimenta un ExternalClock con un clock sintético a --bpm cuyos pulsos llegan con un jitter
+    uniforme de ±--jitter-ms (más el del propio planificador) y compara la regularidad de los
+    intervalos de entrada con la de los pulsos regenerados por el ClockEngine. Con --step-bpm el
+    tempo de entrada cambia a mitad de la prueba.
+    """
+    engine_config = dict(midimaster.CLOCK_ENGINE_DEFAULTS, realtime=args.realtime, rt_cpu=args.rt_cpu)
+    midimaster.main_config = {"clock_engine": engine_config}
+    timer = midimaster.get_precision_timer()
+    follower = midimaster.ExternalClock("synthetic", engine_config, args.bpm)
+    midimaster.external_clock = follower
+    port = FakeOutput("fake_0", record=True)
+    midimaster.set_output_ports([port])
+    midimaster.SHUTDOWN_FLAG = False
+    midimaster.performance_state.status = "STOPPED"
+    thread = threading.Thread(target=midimaster.midi_clock_sender, daemon=True)
+    thread.start()
+
+    rng = random.Random(args.seed)
+    jitter_ns = int(args.jitter_ms * 1_000_000)
+    pulses = int(args.seconds * args.bpm * midimaster.PPQN / 60)
+    step_at = pulses // 2 if args.step_bpm else pulses
+    ideal, received = [], []
+    follower.on_start() # Como un maestro: start y a continuación sus pulsos
+    midimaster.play_clock()
+    t_ns = time.perf_counter_ns() + 10_000_000
+    for k in range(pulses):
+        bpm = args.bpm if k < step_at else args.step_bpm
+        ideal.append(t_ns)
+        timer.wait_until(t_ns + rng.randint(-jitter_ns, jitter_ns))
+        now_ns = time.perf_counter_ns()
+        received.append(now_ns)
+        follower.on_clock(now_ns)
+        t_ns += round(60e9 / (bpm * midimaster.PPQN))
+    timer.wait_until(t_ns)
+    final_bpm = follower.bpm()
+    midimaster.stop_clock()
+    _wait_for(lambda: midimaster.performance_state.status == "STOPPED")
+    _stop_clock_thread(thread)
+    midimaster.set_output_ports([])
+    midimaster.external_clock = None
+
+    sent = port._rt.timestamps[1:-1] # Sin el start ni el stop
+    settle = 2 * midimaster.PPQN # Enganche (una negra) y asentamiento del PLL
+    def interval_errors(times, start, end):
+        return sorted(abs((times[k + 1] - times[k]) - (ideal[k + 1] - ideal[k])) for k in range(start, min(end, len(times) - 1)))
+    results = {"bpm": args.bpm, "jitter_ms": args.jitter_ms, "pulses_in": pulses, "pulses_out": len(sent)}
+    for name, times in (("input", received), ("output", sent)):
+        errors = interval_errors(times, settle, step_at - 1)
+        results[f"{name}_interval_p50_us"] = round(_percentile(errors, 0.5) / 1000, 1)
+        results[f"{name}_interval_p99_us"] = round(_percentile(errors, 0.99) / 1000, 1)
+        results[f"{name}_interval_max_us"] = round(errors[-1] / 1000, 1) if errors else 0
+    phase = sorted(abs(sent[k] - ideal[k]) for k in range(settle, min(step_at, len(sent))))
+    results["output_phase_p99_us"] = round(_percentile(phase, 0.99) / 1000, 1)
+    if args.step_bpm:
+        tail = sorted(abs(sent[k] - ideal[k]) for k in range(step_at + settle, min(pulses, len(sent))))
+        results["step_bpm"] = args.step_bpm
+        results["after_step_phase_p99_us"] = round(_percentile(tail, 0.99) / 1000, 1)
+    results["final_bpm_estimate"] = round(final_bpm, 3)
+    return _print_results("follow", results, args.json)
+
+
+# --- domains: muchos dominios de clock y divisiones por salida desde un solo hilo ---
+DOMAIN_RATES = (24, 48, 12, 96, 1) # PPQN de las salidas de los dominios, por turnos
+
+def bench_domains(args):
+    """
+    Hace sonar el clock principal (salidas a 24, 96 y 1 PPQN) junto con N dominios independientes,
+    cada uno con su tempo y una salida a otro PPQN, y mide el error de cada pulso respecto al
+    intervalo esperado en su salida. Cuenta también los hilos: los dominios no añaden ninguno.
+    """
+    engine_config = dict(midimaster.CLOCK_ENGINE_DEFAULTS, realtime=args.realtime, rt_cpu=args.rt_cpu)
+    results = {"bpm": args.bpm, "seconds": args.seconds, "realtime": args.realtime}
+    for domain_count in args.domains:
+        midimaster.main_config = {"clock_engine": engine_config}
+        midimaster.timing_stats = midimaster.TimingStats()
+        midimaster.performance_state.output_rates = {"main_96": 96, "main_1": 1}
+        main_ports = [FakeOutput(name, record=True) for name in ("main_24", "main_96", "main_1")]
+        midimaster.set_output_ports(main_ports)
+        configs, domain_ports = [], []
+        for i in range(domain_count):
+            port = FakeOutput(f"dom_{i}", record=True)
+            ppqn = DOMAIN_RATES[i % len(DOMAIN_RATES)]
+            configs.append({"name": f"d{i}", "bpm": args.bpm * (1 + 0.37 * (i + 1) / domain_count),
+                            "outputs": {port.name: ppqn}, "link_transport": False})
+            domain_ports.append((port, ppqn, configs[-1]["bpm"]))
+        midimaster.performance_state.domain_configs = configs
+        midimaster.clock_domains[:] = [midimaster.ClockDomain(config, [port], engine_config)
+                                       for config, (port, _, _) in zip(configs, domain_ports)]
+        threads_before = threading.active_count()
+        thread = _start_clock_thread(args.bpm)
+        for config in configs:
+            midimaster.domain_command(config["name"], "PLAY")
+        time.sleep(args.seconds)
+        threads_during = threading.active_count()
+        for config in configs:
+            midimaster.domain_command(config["name"], "STOP")
+        _wait_for(lambda: all(domain.status == "STOPPED" for domain in midimaster.clock_domains))
+        _stop_clock_thread(thread)
+        midimaster.clock_domains.clear()
+        midimaster.performance_state.domain_configs = []
+        midimaster.performance_state.output_rates = {}
+        midimaster.set_output_ports([])
+
+        errors, rate_errors = [], []
+        outputs = [(port, ppqn, args.bpm) for port, ppqn in zip(main_ports, (24, 96, 1))] + domain_ports
+        for port, ppqn, bpm in outputs:
+            period_ns = 60e9 / (bpm * ppqn)
+            sent = port._rt.timestamps[1:-1] # Sin el start ni el stop
+            errors.extend(abs((b - a) - period_ns) for a, b in zip(sent, sent[1:]))
+            if len(sent) > 1: # Tempo medio recibido frente al esperado
+                rate_errors.append(abs((sent[-1] - sent[0]) / (len(sent) - 1) - period_ns) / period_ns)
+        errors.sort()
+        key = f"{domain_count}dom"
+        results[f"{key}_outputs"] = len(outputs)
+        results[f"{key}_pulses"] = len(errors) + len(outputs)
+        results[f"{key}_interval_p50_us"] = round(_percentile(errors, 0.5) / 1000, 1)
+        results[f"{key}_interval_p99_us"] = round(_percentile(errors, 0.99) / 1000, 1)
+        results[f"{key}_rate_error_max_pct"] = round(max(rate_errors) * 100, 2)
+        results[f"{key}_extra_threads"] = threads_during - threads_before - 1 # Sin el hilo de clock
+    return _print_results("domains", results, args.json)
+
+
+# --- reconnect: desconexión y vuelta de una salida con el clock en marcha ---
+class FakeMidiBackend:
+    """
+    Sustituto de mido para midimaster: enumera y abre FakeOutput (con record=True) y deja
+    desconectar y volver a conectar dispositivos, como ALSA, con otra numeración de cliente.
+    Anota el hilo de cada enumeración o apertura; el resto de atributos son los de mido.
+    """
+    def __init__(self, output_names):
+        self.outputs = list(output_names)
+        self.opened = {} # nombre -> último puerto abierto con ese nombre
+        self.caller_threads = []
+
+    def __getattr__(self, name):
+        return getattr(mido, name)
+
+    def get_output_names(self):
+        self.caller_threads.append(threading.get_ident())
+        return list(self.outputs)
+
+    def get_input_names(self):
+        self.caller_threads.append(threading.get_ident())
+        return []
+
+    def open_output(self, name, **kwargs):
+        self.caller_threads.append(threading.get_ident())
+        if name not in self.outputs: raise OSError(f"no existe el puerto '{name}'")
+        port = self.opened[name] = FakeOutput(name, record=True)
+        return port
+
+
+def bench_reconnect(args):
+    """
+    Desconecta --cycles veces la segunda de dos salidas con el clock en marcha y la vuelve a conectar
+    con otra numeración tras --down-ms. Mide cuánto tarda DeviceMonitor en reincorporarla, comprueba
+    que recibe Song Position Pointer y continue en la posición de la otra salida y que su primer pulso
+    sale junto al de esa salida, y compara el error de los intervalos de la salida que no se toca
+    con y sin reconexiones. Cuenta las enumeraciones y aperturas hechas desde el hilo de clock (cero).
+    """
+    midimaster.main_config = {"clock_engine": dict(midimaster.CLOCK_ENGINE_DEFAULTS)}
+    midimaster.timing_stats = midimaster.TimingStats()
+    backend = FakeMidiBackend(["Synth A 20:0", "Synth B 24:0"])
+    real_mido, midimaster.mido = midimaster.mido, backend
+    messages = []
+    reconnect_ms, phase_us, spp_ok = [], [], 0
+    try:
+        steady = backend.open_output("Synth A 20:0")
+        midimaster.set_output_ports([steady, backend.open_output("Synth B 24:0")])
+        thread = _start_clock_thread(args.bpm)
+        monitor = midimaster.DeviceMonitor(args.interval_ms / 1000, clock=True, rules=False, report=messages.append).start()
+        time.sleep(0.5) # Calibración y arranque fuera de la medida
+        quiet_window = (time.perf_counter_ns(), 0)
+        time.sleep(args.seconds)
+        steady_window = (time.perf_counter_ns(), 0)
+        quiet_window = (quiet_window[0], steady_window[0])
+        current = "Synth B 24:0"
+        for cycle in range(args.cycles):
+            backend.outputs.remove(current)
+            time.sleep(args.down_ms / 1000)
+            current = f"Synth B {30 + cycle}:0"
+            backend.outputs.append(current)
+            plugged_ns = time.perf_counter_ns()
+            _wait_for(lambda: monitor.reconnects > cycle, timeout_s=5.0)
+            if monitor.reconnects <= cycle: break
+            reconnect_ms.append((time.perf_counter_ns() - plugged_ns) / 1e6)
+            time.sleep(0.2) # Unos pulsos en la salida reconectada antes de comprobarla
+            port = backend.opened[current]._rt
+            if len(port.messages) < 3: continue
+            spp, cont = port.messages[0], port.messages[1]
+            position = (spp[1] | spp[2] << 7) * (midimaster.PPQN // 4) if spp[0] == midimaster.SONG_POSITION_STATUS else -1
+            if cont == midimaster.CONTINUE_BYTES and position >= 0:
+                spp_ok += 1
+                # Pulso 'position' de la salida que no se toca: sus clocks empiezan tras el start
+                steady_clocks = [t for t, data in zip(steady._rt.timestamps, steady._rt.messages) if data == midimaster.CLOCK_BYTES]
+                if position < len(steady_clocks):
+                    phase_us.append(abs(port.timestamps[2] - steady_clocks[position]) / 1000)
+            time.sleep(args.seconds / args.cycles)
+        steady_window = (steady_window[0], time.perf_counter_ns())
+        monitor.stop()
+        _stop_clock_thread(thread)
+        clock_ident = thread.ident
+    finally:
+        midimaster.mido = real_mido
+        midimaster.set_output_ports([])
+
+    def interval_errors(start_ns, end_ns):
+        clocks = [t for t, data in zip(steady._rt.timestamps, steady._rt.messages) if data == midimaster.CLOCK_BYTES]
+        period_ns = 60e9 / (args.bpm * midimaster.PPQN)
+        return sorted(abs((b - a) - period_ns) for a, b in zip(clocks, clocks[1:]) if start_ns <= a < end_ns)
+    quiet = interval_errors(*quiet_window)
+    during = interval_errors(*steady_window)
+    reconnect_ms.sort()
+    results = {"bpm": args.bpm, "cycles": args.cycles, "interval_ms": args.interval_ms, "reconnected": len(reconnect_ms),
+               "reconnect_p50_ms": round(_percentile(reconnect_ms, 0.5), 1), "reconnect_max_ms": round(reconnect_ms[-1], 1) if reconnect_ms else 0,
+               "spp_continue_ok": spp_ok, "first_pulse_phase_max_us": round(max(phase_us), 1) if phase_us else None,
+               "steady_interval_p99_us": round(_percentile(quiet, 0.99) / 1000, 1),
+               "reconnecting_interval_p99_us": round(_percentile(during, 0.99) / 1000, 1),
+               "clock_thread_backend_calls": backend.caller_threads.count(clock_ident),
+               "last_message": messages[-1] if messages else ""}
+    return _print_results("reconnect", results, args.json)
+
+
+# --- replay: grabación de la sesión y reproducción determinista ---
+_REPLAY_RULES = """{{
+  // Sesión sintética del caso replay, versión {version}
+  "device_alias": {{"teclado": "Replay Keys"}},
+  "input_mappings": [
+    {{"device_in": "teclado", "event_in": "note_on", "ch_in": 9, "value_1_in": 36, "action": "play"}},
+    {{"device_in": "teclado", "event_in": "note_on", "ch_in": 9, "value_1_in": 37, "action": "stop"}},
+    {{"device_in": "teclado", "event_in": "note_on", "ch_in": 9, "value_1_in": 38, "action": "pause"}},
+    {{"device_in": "teclado", "event_in": "cc", "ch_in": 0, "value_1_in": 74, "action": "bpm",
+     "bpm_scale": {{"range_in": [0, 127], "range_out": [{low}, 160]}}}},
+  ],
+}}"""
+
+
+def _osc_packet(address, *args):
+    builder = OscMessageBuilder(address=address)
+    for arg in args: builder.add_arg(arg)
+    return builder.build().dgram
+
+
+def _record_synthetic_session(path, seconds, seed):
+    """
+    Graba en tiempo real una sesión sintética de 'seconds': hilo de clock, un archivo de reglas que se
+    recarga a mitad, notas de transporte, un barrido de CC sobre el BPM, CCs sin regla, comandos de
+    control, OSC y teclas, todo por las mismas funciones que usan los callbacks de midimaster.
+    """
+    rng = random.Random(seed)
+    workdir = Path(tempfile.mkdtemp(prefix="midimaster-record-"))
+    rules_path = workdir / "replay.json"
+    rules_path.write_text(_REPLAY_RULES.format(version=0, low=80), encoding="utf-8")
+    backend = FakeMidiBackend(["Replay Synth 20:0"])
+    real_mido, midimaster.mido = midimaster.mido, backend
+    in_port = "Replay Keys 24:0"
+    midimaster.main_config = {"clock_engine": dict(midimaster.CLOCK_ENGINE_DEFAULTS)}
+    midimaster.timing_stats = midimaster.TimingStats()
+    midimaster._port_names.update(inputs=[in_port], outputs=list(backend.outputs))
+    midimaster.midi_input_ports[in_port] = None # Ya "abierta": los mensajes se entregan a mano
+    midimaster.load_ui_modules()
+    # (segundo, acción) en una sesión de 5 s; se escala a 'seconds'
+    script = [(0.1, ("midi", mido.Message("note_on", channel=9, note=36, velocity=100))),
+              (1.8, ("control", "ramp 140 2")), (2.6, ("osc", "SET_BPM", 128.0)), (3.0, ("key", "+")),
+              (3.2, ("midi", mido.Message("note_on", channel=9, note=38, velocity=100))), (3.5, ("control", "play")),
+              (3.8, ("rules", _REPLAY_RULES.format(version=1, low=90))), (4.1, ("osc", "RAMP_BPM", 110.0, 1.0)),
+              (4.6, ("midi", mido.Message("note_on", channel=9, note=37, velocity=100)))]
+    script += [(0.5 + k / 100, ("midi", mido.Message("control_change", channel=0, control=74, value=k))) for k in range(100)]
+    script += [(rng.uniform(0.0, 5.0), ("midi", mido.Message("control_change", channel=1, control=rng.randrange(128), value=rng.randrange(128))))
+               for _ in range(1000)] # Un controlador ocupado (200 CC/s) con CCs que no tocan ninguna regla
+    script.sort(key=lambda step: step[0])
+    scale = seconds / 5.0
+    try:
+        midimaster.load_rule_file(rules_path)
+        midimaster.rebuild_rule_dispatcher([in_port])
+        midimaster.set_output_ports([backend.open_output("Replay Synth 20:0")])
+        midimaster.performance_state.bpm = 120.0
+        midimaster.performance_state.status = "STOPPED"
+        midimaster.session_recorder = midimaster.SessionRecorder(path, midimaster.session_settings()).start()
+        disp, kb = midimaster.build_osc_dispatcher(), midimaster.build_key_bindings()
+        midimaster.SHUTDOWN_FLAG = False
+        thread = threading.Thread(target=midimaster.midi_clock_sender, daemon=True)
+        thread.start()
+        t0 = time.perf_counter()
+        for at_s, (kind, *step) in script:
+            time.sleep(max(0.0, t0 + at_s * scale - time.perf_counter()))
+            if kind == "midi": midimaster.global_midi_callback(step[0], in_port)
+            elif kind == "control": midimaster.handle_control_command(step[0])
+            elif kind == "osc": disp.call_handlers_for_packet(_osc_packet(midimaster.OSC_ADDRESSES[step[0]], *step[1:]), ("127.0.0.1", 9999))
+            elif kind == "key": kb.get_bindings_for_keys((step[0],))[-1].handler(SimpleNamespace(app=None))
+            elif kind == "rules":
+                rules_path.write_text(step[0], encoding="utf-8")
+                midimaster.reload_rule_files(lambda message: None)
+        time.sleep(max(0.0, t0 + seconds - time.perf_counter()))
+        midimaster.handle_control_command("quit")
+        midimaster.wake_clock_engine()
+        thread.join(timeout=1.0)
+        return midimaster.session_recorder.stop()
+    finally:
+        midimaster.session_recorder = None
+        midimaster.mido = real_mido
+        midimaster.midi_input_ports.clear()
+        midimaster.loaded_rule_files.clear()
+        midimaster.set_output_ports([])
+
+
+class VirtualTime:
+    """
+    Sustituto del módulo time de midimaster durante la reproducción: el reloj solo avanza cuando el
+    motor espera y, al avanzar, entrega en orden los eventos grabados que caen antes del nuevo instante.
+    Al llegar al final de la sesión activa SHUTDOWN_FLAG.
+    Con recorded=True el motor reproduce también los retrasos grabados: cada pulso sale con el
+    retraso que tuvo y, en reposo, el motor aplica los comandos cuando los aplicó en la grabación
+    (registros APPLY); con recorded=False espera siempre exactamente lo que pide.
+    """
+    def __init__(self, settings, events, end_ns, deliver, recorded=True):
+        self.start_ns = self.now = settings["start_ns"]
+        self.start_time = settings["start_time"]
+        self.events = [event for event in events if event[1] not in _ENGINE_RECORDS]
+        self.index = 0
+        self.end_ns = end_ns
+        self.deliver = deliver
+        self.delivering = False
+        engine = [event for event in events if event[1] in _ENGINE_RECORDS] if recorded else []
+        self.pulses = sorted((event[4], event[0]) for event in engine if event[1] == midimaster.REC_PULSE)
+        self.reactions = [event[0] for event in engine if event[1] == midimaster.REC_APPLY]
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def perf_counter_ns(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now / 1e9
+
+    monotonic_ns, monotonic = perf_counter_ns, perf_counter
+
+    def time(self):
+        return self.start_time + (self.now - self.start_ns) / 1e9
+
+    def sleep(self, seconds):
+        self.advance_to(self.now + int(seconds * 1e9))
+
+    def advance_to(self, target_ns, wakeup=None):
+        """Entrega los eventos hasta target_ns; con wakeup, para en el primero que despierta al motor."""
+        if self.delivering: # Una espera dentro de un evento no entrega otros
+            self.now = max(self.now, target_ns)
+            return
+        events = self.events
+        while self.index < len(events) and events[self.index][0] <= target_ns and not midimaster.SHUTDOWN_FLAG:
+            event = events[self.index]
+            self.index += 1
+            self.now = max(self.now, event[0])
+            self.delivering = True
+            try:
+                self.deliver(event)
+            finally:
+                self.delivering = False
+            if wakeup is not None and wakeup.flag: return
+        if target_ns >= self.end_ns:
+            self.now = max(self.now, self.end_ns)
+            midimaster.SHUTDOWN_FLAG = True
+        else:
+            self.now = max(self.now, target_ns)
+
+
+    def react(self):
+        """
+        Tras despertar al motor en reposo, adelanta el reloj hasta su reacción grabada, entregando
+        los eventos que llegaron mientras tanto (en la grabación, desde otros hilos).
+        """
+        k = bisect.bisect_left(self.reactions, self.now)
+        if k < len(self.reactions):
+            self.advance_to(self.reactions[k])
+
+
+# Registros que produce el propio motor: en la reproducción se regeneran, no se entregan
+_ENGINE_RECORDS = (midimaster.REC_TEMPO, midimaster.REC_RAMP, midimaster.REC_TRANSPORT, midimaster.REC_PULSE, midimaster.REC_APPLY)
+_PULSE_MATCH_NS = 1_000_000 # Más lejos de cualquier deadline grabado, la espera no es la de un pulso grabado
+
+
+class VirtualTimer:
+    """PrecisionTimer sobre VirtualTime: esperar es avanzar el reloj hasta el deadline o, si es el de un pulso grabado, hasta su envío."""
+    spin_window_ns = 0
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def wait_until(self, deadline_ns):
+        pulses = self.clock.pulses # (deadline, envío) de todos los pulsos grabados, del clock principal y de los dominios
+        k = bisect.bisect_left(pulses, (deadline_ns,))
+        nearest = min(pulses[max(0, k - 1):k + 1], key=lambda pulse: abs(pulse[0] - deadline_ns), default=None)
+        if nearest is not None and abs(nearest[0] - deadline_ns) < _PULSE_MATCH_NS:
+            deadline_ns = max(deadline_ns, nearest[1]) # Se despierta cuando despertó en la grabación
+        self.clock.advance_to(deadline_ns)
+
+
+class VirtualWakeup:
+    """command_wakeup sobre VirtualTime: la espera avanza el reloj hasta el timeout o el primer comando."""
+    def __init__(self, clock):
+        self.clock = clock
+        self.flag = False
+
+    def set(self):
+        self.flag = True
+
+    def clear(self):
+        self.flag = False
+
+    def is_set(self):
+        return self.flag
+
+    def wait(self, timeout=None):
+        if not self.flag:
+            target_ns = self.clock.end_ns if timeout is None else self.clock.now + int(timeout * 1e9)
+            self.clock.advance_to(target_ns, wakeup=self)
+            if self.flag: self.clock.react()
+        return self.flag
+
+
+def _replay_session(settings, events, end_ns, path, recorded_timing=True):
+    """
+    Reproduce una grabación en el hilo actual y en tiempo virtual contra FakeMidiBackend, grabando a
+    su vez la reproducción en path. Devuelve (registros, perdidos, segundos de reloj real).
+    """
+    workdir = Path(tempfile.mkdtemp(prefix="midimaster-replay-"))
+    rule_paths = {name: workdir / name for name in settings["rules"]}
+    for name, text in settings["rules"].items(): rule_paths[name].write_text(text, encoding="utf-8")
+    inputs = sorted({event[3] for event in events if event[1] == midimaster.REC_MIDI_IN})
+    backend = FakeMidiBackend(dict.fromkeys(settings["outputs"] + settings["domain_outputs"]))
+    handlers = {}
+
+    def deliver(event):
+        t_ns, kind, code, name, value, real = event
+        if kind == midimaster.REC_MIDI_IN:
+            try:
+                msg = mido.Message.from_bytes(midimaster.unpack_midi(value))
+            except ValueError: # SysEx: solo se graban sus primeros bytes
+                return
+            midimaster.global_midi_callback(msg, name)
+        elif kind == midimaster.REC_CONTROL:
+            if name != "reload": # La recarga llega con su propio evento y el contenido grabado
+                midimaster.handle_control_command(name)
+        elif kind == midimaster.REC_OSC:
+            handlers["osc"].call_handlers_for_packet(_osc_packet(name, *[real, value / 1000][:code]), ("127.0.0.1", 9999))
+        elif kind == midimaster.REC_KEY:
+            bindings = handlers["keys"].get_bindings_for_keys(tuple(name.split(" ")))
+            if bindings: bindings[-1].handler(SimpleNamespace(app=None))
+        elif kind == "rules":
+            for file_name, text in name.items():
+                if file_name in rule_paths: rule_paths[file_name].write_text(text, encoding="utf-8")
+            midimaster.reload_rule_files(lambda message: None)
+
+    clock = VirtualTime(settings, events, end_ns, deliver, recorded_timing)
+    saved = (midimaster.time, midimaster.get_precision_timer, midimaster.command_wakeup, midimaster.mido)
+    midimaster.time, midimaster.mido = clock, backend
+    midimaster.get_precision_timer = lambda: VirtualTimer(clock)
+    midimaster.command_wakeup = VirtualWakeup(clock)
+    midimaster.main_config = {"clock_engine": dict(settings["clock_engine"], fanout="serial", realtime=False, process=False, timing_dump="")}
+    midimaster.performance_state = midimaster.PerformanceState()
+    midimaster.timing_stats = midimaster.TimingStats()
+    midimaster.bpm_coalescer = midimaster.BpmCoalescer()
+    midimaster.command_queue.clear()
+    midimaster.external_clock = None
+    midimaster.OSC_ADDRESSES.update(settings["osc_addresses"])
+    midimaster._port_names.update(inputs=inputs, outputs=list(backend.outputs))
+    for name in inputs: midimaster.midi_input_ports[name] = None
+    midimaster.load_ui_modules() # KeyBindings para las teclas grabadas
+    wall_start = time.perf_counter()
+    try:
+        for rule_path in rule_paths.values(): midimaster.load_rule_file(rule_path)
+        midimaster.rebuild_rule_dispatcher(inputs)
+        midimaster.set_output_ports([backend.open_output(name) for name in settings["outputs"]])
+        midimaster.clock_domains.extend(midimaster.open_clock_domains(midimaster.performance_state.domain_configs))
+        midimaster.performance_state.bpm = settings["bpm"]
+        midimaster.performance_state.quantize = settings["quantize"]
+        midimaster.performance_state.beats_per_bar = settings["beats_per_bar"]
+        recorder = midimaster.SessionRecorder(path, settings, capacity=max(65536, 2 * len(events) + 4096))
+        midimaster.session_recorder = recorder # Sin start(): se vuelca entera al final, sin hilos
+        handlers.update(osc=midimaster.build_osc_dispatcher(), keys=midimaster.build_key_bindings())
+        midimaster.SHUTDOWN_FLAG = False
+        midimaster.midi_clock_sender()
+        records, dropped = recorder.stop()
+    finally:
+        midimaster.session_recorder = None
+        midimaster.time, midimaster.get_precision_timer, midimaster.command_wakeup, midimaster.mido = saved
+        midimaster.midi_input_ports.clear()
+        midimaster.loaded_rule_files.clear()
+        midimaster.close_clock_domains()
+        midimaster.set_output_ports([])
+    return records, dropped, time.perf_counter() - wall_start
+
+
+def _recorder_cost(count=100000):
+    """ns por evento y bloques de memoria nuevos por cada 1000 eventos de SessionRecorder.record()."""
+    recorder = midimaster.SessionRecorder(Path(tempfile.mkdtemp(prefix="midimaster-rec-")) / "cost.mmsr", {}, capacity=4096)
+    record, now, kind = recorder.record, time.perf_counter_ns, midimaster.REC_PULSE
+    name = recorder.name_index("Replay Keys 24:0")
+    blocks = sys.getallocatedblocks()
+    t0 = now()
+    for _ in range(count):
+        record(kind, now(), 1, name, 0)
+    elapsed_ns = now() - t0
+    blocks = sys.getallocatedblocks() - blocks
+    recorder.stop()
+    return elapsed_ns / count, blocks * 1000 / count
+
+
+def bench_replay(args):
+    """
+    Graba una sesión sintética en tiempo real (o usa --session) y la reproduce --runs veces en tiempo
+    virtual, sin hilos y contra FakeMidiBackend. Compara pulsos, transporte y tempo de la reproducción
+    con los grabados, comprueba que las reproducciones son idénticas entre sí y mide la velocidad
+    frente al tiempo real y el coste de grabar un evento.
+    """
+    workdir = Path(tempfile.mkdtemp(prefix="midimaster-replay-"))
+    session = Path(args.session) if args.session else workdir / "session.mmsr"
+    if not args.session:
+        _record_synthetic_session(session, args.seconds, args.seed)
+    settings, events, end = midimaster.read_session(session)
+    end_ns = end[0] if end is not None else (events[-1][0] if events else settings["start_ns"])
+
+    replays, records_per_run, wall_s = [], [], []
+    for run in range(args.runs):
+        replay_path = workdir / f"replay-{run}.mmsr"
+        records, dropped, seconds = _replay_session(settings, events, end_ns, replay_path, args.timing == "recorded")
+        replays.append(midimaster.read_session(replay_path)[1])
+        records_per_run.append(records)
+        wall_s.append(seconds)
+
+    def of_kind(session_events, kind):
+        return [event for event in session_events if event[1] == kind]
+    def pulses_by_clock(session_events): # "" = clock principal; el resto, dominios
+        streams = {}
+        for event in of_kind(session_events, midimaster.REC_PULSE): streams.setdefault(event[3], []).append(event)
+        return streams
+    recorded_pulses, replayed_pulses = pulses_by_clock(events), pulses_by_clock(replays[0])
+    divergence = sorted(abs(a[4] - b[4]) for name, pulses in recorded_pulses.items()
+                        for a, b in zip(pulses, replayed_pulses.get(name, ())))
+    send_error = sorted(abs(t_ns - deadline_ns) for t_ns, _, _, _, deadline_ns, _ in recorded_pulses.get("", ()))
+    transport = lambda session_events: [(event[2], event[4]) for event in of_kind(session_events, midimaster.REC_TRANSPORT)]
+    tempo = lambda session_events: [round(event[5], 3) for event in of_kind(session_events, midimaster.REC_TEMPO) + of_kind(session_events, midimaster.REC_RAMP)]
+    counts = {}
+    for event in events:
+        kind = midimaster.SESSION_KINDS.get(event[1], event[1])
+        counts[kind] = counts.get(kind, 0) + 1
+    record_ns, blocks_per_1k = _recorder_cost()
+    duration_s = (end_ns - settings["start_ns"]) / 1e9
+    results = {"session": str(session), "timing": args.timing, "session_s": round(duration_s, 2), "file_bytes": session.stat().st_size,
+               "records": counts, "dropped": end[2] if end is not None else None,
+               "record_ns_per_event": round(record_ns), "record_alloc_blocks_per_1k": round(blocks_per_1k, 1),
+               "recorded_send_error_p50_us": round(_percentile(send_error, 0.5) / 1000, 1),
+               "recorded_send_error_p99_us": round(_percentile(send_error, 0.99) / 1000, 1),
+               "recorded_send_error_max_us": round(send_error[-1] / 1000, 1) if send_error else 0,
+               "pulses_recorded": {name or "main": len(pulses) for name, pulses in recorded_pulses.items()},
+               "pulses_replayed": {name or "main": len(pulses) for name, pulses in replayed_pulses.items()},
+               "pulse_deadline_divergence_p99_us": round(_percentile(divergence, 0.99) / 1000, 1),
+               "pulse_deadline_divergence_max_us": round(divergence[-1] / 1000, 1) if divergence else 0,
+               "transport_match": transport(events) == transport(replays[0]),
+               "tempo_match": tempo(events) == tempo(replays[0]),
+               "replay_records": records_per_run[0], "replay_wall_ms": round(min(wall_s) * 1000, 1),
+               "speedup": round(duration_s / min(wall_s), 1) if min(wall_s) > 0 else None,
+               "deterministic": all(replay == replays[0] for replay in replays[1:])}
+    return _print_results("replay", results, args.json)
+
+
+# --- osc: comandos OSC por segundo a través del dispatcher real ---
+def bench_osc(args):
+    """
+    Pasa paquetes OSC ya codificados por el dispatcher de midimaster (sin sockets), con el hilo
+    de clock en reposo consumiendo los comandos, y comprueba que se aplica el último tempo pedido.
+    """
+    midimaster.main_config = {"clock_engine": dict(midimaster.CLOCK_ENGINE_DEFAULTS)}
+    midimaster.osc_client = CountingOscClient()
+    midimaster.set_output_ports([FakeOutput("fake_0")])
+    rng = random.Random(args.seed)
+    packets = []
+    for i in range(args.messages):
+        if i % 100 == 99: # Algún comando de transporte entre los cambios de tempo
+            builder = OscMessageBuilder(address=midimaster.OSC_ADDRESSES["STOP"])
+        else:
+            builder = OscMessageBuilder(address=midimaster.OSC_ADDRESSES["SET_BPM"])
+            builder.add_arg(round(rng.uniform(60.0, 180.0), 2))
+        packets.append(builder.build().dgram)
+    last_bpm = OscMessageBuilder(address=midimaster.OSC_ADDRESSES["SET_BPM"])
+    last_bpm.add_arg(133.0)
+    packets.append(last_bpm.build().dgram)
+
+    disp = midimaster.build_osc_dispatcher()
+    coalescer = midimaster.bpm_coalescer
+    requests_before, applied_before = coalescer.requests, coalescer.applied
+    midimaster.SHUTDOWN_FLAG = False
+    midimaster.performance_state.status = "STOPPED"
+    thread = threading.Thread(target=midimaster.midi_clock_sender, daemon=True)
+    thread.start()
+
+    client_address = ("127.0.0.1", 9999)
+    t0 = time.perf_counter_ns()
+    for packet in packets:
+        disp.call_handlers_for_packet(packet, client_address)
+    elapsed_ns = time.perf_counter_ns() - t0
+    _wait_for(lambda: not midimaster.command_queue and midimaster.bpm_coalescer.pending() is None)
+    _stop_clock_thread(thread)
+    midimaster.osc_client = None
+    midimaster.set_output_ports([])
+
+    results = {
+        "messages": len(packets),
+        "msgs_per_s": round(len(packets) / (elapsed_ns / 1e9)),
+        "us_per_msg": round(elapsed_ns / len(packets) / 1000, 2),
+        "bpm_requests": coalescer.requests - requests_before,
+        "tempo_updates_applied": coalescer.applied - applied_before,
+        "final_bpm": midimaster.performance_state.bpm,
+        "final_bpm_ok": midimaster.performance_state.bpm == 133.0,
+    }
+    return _print_results("osc", results, args.json)
+
+
+# --- oscsend: coste del envío OSC para el hilo que lo pide ---
+def _time_osc_calls(client, messages):
+    costs = []
+    now = time.perf_counter_ns
+    for address, value in messages:
+        t0 = now()
+        client.send_message(address, value)
+        costs.append(now() - t0)
+    costs.sort()
+    return costs
+
+
+def bench_oscsend(args):
+    """
+    Cuánto tarda send_message() en el hilo que lo llama: envío UDP síncrono (SimpleUDPClient, el
+    envío anterior) frente a OscSender, con un receptor UDP local por destino. Los mensajes son
+    ecos de BPM con algún cambio de estado, a ráfagas como los de un fader.
+    """
+    receivers = []
+    for _ in range(args.targets):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        receiver.bind(("127.0.0.1", 0))
+        receivers.append(receiver)
+    targets = [{"ip": "127.0.0.1", "port": r.getsockname()[1]} for r in receivers]
+    messages = [(midimaster.OSC_ADDRESSES["STATUS"], "PLAYING") if i % 50 == 0 else
+                (midimaster.OSC_ADDRESSES["CURRENT_BPM"], 100.0 + (i % 80)) for i in range(args.messages)]
+
+    sync_clients = [SimpleUDPClient(t["ip"], t["port"]) for t in targets]
+    class FanoutClient: # Lo que costaría el envío síncrono a cada destino
+        def send_message(self, address, value):
+            for client in sync_clients: client.send_message(address, value)
+    sync_costs = _time_osc_calls(FanoutClient(), messages)
+
+    sender = midimaster.OscSender.from_config({"send_targets": targets})
+    async_costs = _time_osc_calls(sender, messages)
+    sender.close()
+    for receiver in receivers: receiver.close()
+
+    results = {"messages": args.messages, "targets": args.targets}
+    for name, costs in (("sync", sync_costs), ("sender", async_costs)):
+        results[f"{name}_p50_us"] = round(_percentile(costs, 0.5) / 1000, 2)
+        results[f"{name}_p99_us"] = round(_percentile(costs, 0.99) / 1000, 2)
+        results[f"{name}_max_us"] = round(costs[-1] / 1000, 1)
+    results["sync_packets"] = args.messages * args.targets
+    results["sender_packets"] = sender.packets
+    results["sender_superseded"] = sender.superseded
+    return _print_results("oscsend", results, args.json)
+
+
+# --- control: ida y vuelta por el socket de control ---
+def bench_control(args):
+    """
+    Tiempo de ida y vuelta de comandos por el socket de control (línea enviada -> respuesta leída),
+    con el hilo de clock en marcha a --bpm aplicando los cambios de tempo.
+    """
+    midimaster.main_config = {"clock_engine": dict(midimaster.CLOCK_ENGINE_DEFAULTS)}
+    midimaster.set_output_ports([FakeOutput("fake_0")])
+    path = os.path.join(tempfile.mkdtemp(prefix="midimaster-bench-"), "control.sock")
+    server = midimaster.start_control_server(path)
+    thread = _start_clock_thread(args.bpm)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    reader = client.makefile("rb")
+
+    def round_trips(lines):
+        rtts = []
+        for line in lines:
+            t0 = time.perf_counter_ns()
+            client.sendall(line)
+            reply = reader.readline()
+            rtts.append(time.perf_counter_ns() - t0)
+            if not reply.startswith(b"ok"): raise RuntimeError(reply.decode("utf-8", "replace"))
+        rtts.sort()
+        return rtts
+
+    rng = random.Random(args.seed)
+    bpm_rtts = round_trips(b"bpm %.2f\n" % rng.uniform(60.0, 180.0) for _ in range(args.commands))
+    status_rtts = round_trips(b"status\n" for _ in range(args.commands))
+    reader.close()
+    client.close()
+    _stop_clock_thread(thread)
+    server.close()
+    os.rmdir(os.path.dirname(path))
+    midimaster.set_output_ports([])
+
+    results = {"commands": args.commands}
+    for name, rtts in (("bpm", bpm_rtts), ("status", status_rtts)):
+        results[f"{name}_p50_us"] = round(_percentile(rtts, 0.5) / 1000, 1)
+        results[f"{name}_p99_us"] = round(_percentile(rtts, 0.99) / 1000, 1)
+        results[f"{name}_max_us"] = round(rtts[-1] / 1000, 1)
+    return _print_results("control", results, args.json)
+
+
+# --- coldstart: desde lanzar midimaster hasta el primer pulso de clock ---
+def _python_ms(code):
+    t0 = time.perf_counter_ns()
+    subprocess.run([sys.executable, "-c", code], check=True)
+    return (time.perf_counter_ns() - t0) / 1e6
+
+
+def _coldstart_run(script, workdir, extra_args):
+    """Lanza midimaster --headless, manda play en cuanto responde el socket y espera al primer pulso."""
+    path = os.path.join(workdir, "control.sock")
+    t0 = time.perf_counter_ns()
+    process = subprocess.Popen([sys.executable, str(script), "--headless", "--control-socket", path, *extra_args],
+                               cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        while True:
+            try:
+                client.connect(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if process.poll() is not None: raise RuntimeError("midimaster terminó antes de abrir el socket de control")
+                time.sleep(0.0005)
+        ready_ns = time.perf_counter_ns() - t0
+        reader = client.makefile("rb")
+        client.sendall(b"play\n")
+        reader.readline()
+        while True:
+            client.sendall(b"status\n")
+            if b" pulse=0 " not in reader.readline(): break
+            time.sleep(0.0005)
+        first_pulse_ns = time.perf_counter_ns() - t0
+        client.sendall(b"quit\n")
+        reader.readline()
+        reader.close()
+    finally:
+        client.close()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    return ready_ns / 1e6, first_pulse_ns / 1e6
+
+
+def bench_coldstart(args):
+    """
+    Arranque en frío de midimaster.py --headless en un directorio vacío (configuración por defecto):
+    tiempo hasta que responde el socket de control y hasta el primer pulso tras un play inmediato,
+    más el coste de importar el módulo respecto a un intérprete vacío.
+    """
+    script = Path(args.script).resolve()
+    baseline_ms = statistics.median(_python_ms("pass") for _ in range(args.runs))
+    import_ms = statistics.median(_python_ms(f"import sys; sys.path.insert(0, {str(script.parent)!r}); import {script.stem}")
+                                  for _ in range(args.runs))
+    ready, first_pulse = [], []
+    with tempfile.TemporaryDirectory(prefix="midimaster-coldstart-") as workdir:
+        for _ in range(args.runs):
+            ready_ms, first_pulse_ms = _coldstart_run(script, workdir, args.extra)
+            ready.append(ready_ms)
+            first_pulse.append(first_pulse_ms)
+    results = {
+        "runs": args.runs,
+        "python_ms": round(baseline_ms, 1),
+        "import_ms": round(import_ms - baseline_ms, 1),
+        "ready_ms_median": round(statistics.median(ready), 1),
+        "first_pulse_ms_median": round(statistics.median(first_pulse), 1),
+        "first_pulse_ms_max": round(max(first_pulse), 1),
+        "target_ms": args.target_ms,
+        "target_ok": statistics.median(first_pulse) <= args.target_ms,
+    }
+    return _print_results("coldstart", results, args.json)
+
+
+# --- isolation: jitter del clock con carga Python en el front-end, en hilo y en proceso aparte ---
+def _busy_python(stop):
+    """Carga de front-end: trabajo Python puro que compite por el GIL (como renders o ráfagas OSC)."""
+    while not stop.is_set():
+        sum(i * i for i in range(2000))
+
+
+def _run_isolated_clock(mode, bpm, seconds, load_threads):
+    midimaster.main_config = {"clock_engine": dict(midimaster.CLOCK_ENGINE_DEFAULTS),
+                              "osc_configuration": {"enabled": False}}
+    midimaster.timing_stats = midimaster.TimingStats()
+    stop = threading.Event()
+    load = [threading.Thread(target=_busy_python, args=(stop,), daemon=True) for _ in range(load_threads)]
+    if mode == "process":
+        midimaster.clock_process = midimaster.ClockProcess.launch({
+            "main_config": midimaster.main_config, "device_aliases": {}, "bpm": bpm, "quantize": "none",
+            "beats_per_bar": midimaster.BEATS_PER_BAR, "output_rates": {}, "domains": [], "port_names": [],
+            "virtual_name": None, "timing_dump": None, "timing_report": False})
+        if midimaster.clock_process is None: # Sin rtmidi u otro fallo al arrancar: el caso se omite
+            return None
+        time.sleep(0.2) # Calibración del temporizador en el proceso de clock
+        thread = None
+    else:
+        midimaster.set_output_ports([FakeOutput("fake_0")])
+        thread = _start_clock_thread(bpm)
+        midimaster.stop_clock()
+    for worker in load: worker.start()
+    midimaster.play_clock()
+    time.sleep(seconds)
+    midimaster.stop_clock()
+    time.sleep(0.5) # El proceso publica el resumen de timing cada 250 ms
+    summary = midimaster.current_timing_summary()
+    stop.set()
+    if thread is not None:
+        _stop_clock_thread(thread)
+        midimaster.set_output_ports([])
+    else:
+        midimaster.clock_process.stop()
+        midimaster.clock_process = None
+    return summary
+
+
+def bench_isolation(args):
+    """Compara el error de los pulsos con el clock en un hilo y en --clock-process bajo la misma carga."""
+    results = {"bpm": args.bpm, "seconds": args.seconds, "load_threads": args.load_threads}
+    for mode in ("thread", "process"):
+        summary = _run_isolated_clock(mode, args.bpm, args.seconds, args.load_threads)
+        if summary is None:
+            results[f"{mode}_skipped"] = "el proceso de clock no pudo arrancar"
+            continue
+        results[f"{mode}_pulses"] = summary["pulses"]
+        results[f"{mode}_p50_us"] = round(summary["p50_ns"] / 1000, 1)
+        results[f"{mode}_p99_us"] = round(summary["p99_ns"] / 1000, 1)
+        results[f"{mode}_max_us"] = round(summary["max_ns"] / 1000, 1)
+        results[f"{mode}_late"] = summary["late"]
+    return _print_results("isolation", results, args.json)
+
+
+# --- suite: casos estándar con sus opciones por defecto, para comparar entre versiones ---
+SUITE_CASES = ("jitter", "fanout", "dispatch", "osc", "startlat")
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def bench_suite(args):
+    """Ejecuta los casos de SUITE_CASES y guarda un único JSON con los resultados y el entorno."""
+    parser = build_parser()
+    report = {
+        "suite": "midimaster",
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": {},
+    }
+    for case in args.cases:
+        case_args = parser.parse_args((["--json"] if args.json else []) + [case])
+        report["results"][case] = CASES[case](case_args)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Resultados guardados en '{args.output}'.")
+    return report
+
+
+CASES = {
+    "soak": bench_soak,
+    "fanout": bench_fanout,
+    "skew": bench_skew,
+    "dispatch": bench_dispatch,
+    "coalesce": bench_coalesce,
+    "reload": bench_reload,
+    "startlat": bench_startlat,
+    "jitter": bench_jitter,
+    "follow": bench_follow,
+    "domains": bench_domains,
+    "reconnect": bench_reconnect,
+    "replay": bench_replay,
+    "osc": bench_osc,
+    "oscsend": bench_oscsend,
+    "control": bench_control,
+    "coldstart": bench_coldstart,
+    "isolation": bench_isolation,
+    "suite": bench_suite,
+}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="bench_midimaster.py", description="Benchmarks de midimaster")
+    parser.add_argument("--json", action="store_true", help="Resultados en JSON (una línea por caso).")
+    subparsers = parser.add_subparsers(dest="case", required=True)
+
+    soak = subparsers.add_parser("soak", help="Deriva de la rejilla de tempo tras horas de pulsos simulados.")
+    soak.add_argument("--bpm", type=float, default=127.3)
+    soak.add_argument("--hours", type=float, default=4.0)
+    soak.add_argument("--uptime-hours", type=float, default=72.0, help="Valor inicial simulado de perf_counter.")
+    soak.add_argument("--sample-every", type=int, default=997)
+
+    fanout = subparsers.add_parser("fanout", help="Coste de CPU por pulso según el número de puertos de salida.")
+    fanout.add_argument("--ports", type=int, nargs="+", default=[1, 8, 64])
+    fanout.add_argument("--pulses", type=int, default=5000)
+
+    skew = subparsers.add_parser("skew", help="Retraso por puerto respecto al deadline con un puerto lento (serie vs hilos).")
+    skew.add_argument("--ports", type=int, default=32)
+    skew.add_argument("--slow-ms", type=float, default=2.0)
+    skew.add_argument("--pulses", type=int, default=200)
+    skew.add_argument("--bpm", type=float, default=120.0)
+
+    dispatch = subparsers.add_parser("dispatch", help="Mensajes por segundo del despachador de reglas según el número de reglas.")
+    dispatch.add_argument("--rules", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    dispatch.add_argument("--messages", type=int, default=20000)
+    dispatch.add_argument("--ports", type=int, default=4)
+    dispatch.add_argument("--seed", type=int, default=1)
+
+    coalesce = subparsers.add_parser("coalesce", help="Cambios de tempo y ecos OSC producidos por un barrido rápido de fader.")
+    coalesce.add_argument("--messages", type=int, default=300)
+    coalesce.add_argument("--seconds", type=float, default=1.0)
+    coalesce.add_argument("--bpm", type=float, default=120.0)
+
+    reload = subparsers.add_parser("reload", help="Recarga en caliente de las reglas con el clock sonando y mensajes entrando.")
+    reload.add_argument("--rules", type=int, default=1000)
+    reload.add_argument("--ports", type=int, default=4)
+    reload.add_argument("--reloads", type=int, default=20)
+    reload.add_argument("--seconds", type=float, default=4.0, help="Duración de cada ventana (sin y con recargas).")
+    reload.add_argument("--bpm", type=float, default=120.0)
+    reload.add_argument("--seed", type=int, default=1)
+
+    startlat = subparsers.add_parser("startlat", help="Latencia desde la llegada de Play hasta el start y el primer clock.")
+    startlat.add_argument("--trials", type=int, default=50)
+    startlat.add_argument("--bpm", type=float, default=120.0)
+    startlat.add_argument("--seed", type=int, default=1)
+
+    jitter = subparsers.add_parser("jitter", help="Error de los pulsos del motor de clock a varios tempos.")
+    jitter.add_argument("--bpm", type=float, nargs="+", default=[20.0, 120.0, 300.0])
+    jitter.add_argument("--seconds", type=float, default=4.0, help="Duración por tempo.")
+    jitter.add_argument("--precision", choices=midimaster.PRECISION_MODES, default=midimaster.CLOCK_ENGINE_DEFAULTS["precision"])
+    jitter.add_argument("--realtime", action="store_true", help="Ejecuta el clock como con midimaster.py --realtime.")
+    jitter.add_argument("--rt-cpu", type=int, default=None)
+
+    follow = subparsers.add_parser("follow", help="Regularidad del clock regenerado con --follow a partir de una entrada con jitter.")
+    follow.add_argument("--bpm", type=float, default=120.0)
+    follow.add_argument("--jitter-ms", type=float, default=1.0, help="Jitter uniforme (±) añadido a cada pulso de entrada.")
+    follow.add_argument("--seconds", type=float, default=8.0)
+    follow.add_argument("--step-bpm", type=float, default=0.0, help="Tempo de entrada en la segunda mitad (0 = sin cambio).")
+    follow.add_argument("--seed", type=int, default=1)
+    follow.add_argument("--realtime", action="store_true", help="Ejecuta el clock como con midimaster.py --realtime.")
+    follow.add_argument("--rt-cpu", type=int, default=None)
+
+    domains = subparsers.add_parser("domains", help="Error de los pulsos con varios dominios de clock y divisiones por salida en un solo hilo.")
+    domains.add_argument("--domains", type=int, nargs="+", default=[1, 8, 32])
+    domains.add_argument("--bpm", type=float, default=120.0)
+    domains.add_argument("--seconds", type=float, default=4.0)
+    domains.add_argument("--realtime", action="store_true", help="Ejecuta el clock como con midimaster.py --realtime.")
+    domains.add_argument("--rt-cpu", type=int, default=None)
+
+    reconnect = subparsers.add_parser("reconnect", help="Reconexión de una salida desconectada con el clock en marcha.")
+    reconnect.add_argument("--cycles", type=int, default=5)
+    reconnect.add_argument("--down-ms", type=float, default=300.0, help="Tiempo que el dispositivo está desconectado.")
+    reconnect.add_argument("--interval-ms", type=float, default=100.0, help="Intervalo de DeviceMonitor.")
+    reconnect.add_argument("--bpm", type=float, default=120.0)
+    reconnect.add_argument("--seconds", type=float, default=2.0)
+
+    replay = subparsers.add_parser("replay", help="Grabación de la sesión y reproducción determinista en tiempo virtual.")
+    replay.add_argument("--session", metavar="RUTA", help="Grabación de midimaster.py --record; sin ella se graba una sesión sintética.")
+    replay.add_argument("--seconds", type=float, default=5.0, help="Duración de la sesión sintética.")
+    replay.add_argument("--runs", type=int, default=2)
+    replay.add_argument("--timing", choices=("recorded", "ideal"), default="recorded", help="recorded: el motor reproduce los retrasos grabados; ideal: sin retrasos.")
+    replay.add_argument("--seed", type=int, default=1)
+
+    osc = subparsers.add_parser("osc", help="Comandos OSC por segundo a través del dispatcher de midimaster.")
+    osc.add_argument("--messages", type=int, default=20000)
+    osc.add_argument("--seed", type=int, default=1)
+
+    oscsend = subparsers.add_parser("oscsend", help="Coste de send_message() para quien envía OSC: UDP síncrono frente a OscSender.")
+    oscsend.add_argument("--messages", type=int, default=5000)
+    oscsend.add_argument("--targets", type=int, default=2)
+
+    control = subparsers.add_parser("control", help="Ida y vuelta de comandos por el socket de control (Unix).")
+    control.add_argument("--commands", type=int, default=5000)
+    control.add_argument("--bpm", type=float, default=120.0)
+    control.add_argument("--seed", type=int, default=1)
+
+    coldstart = subparsers.add_parser("coldstart", help="Arranque en frío de midimaster --headless hasta el primer pulso de clock.")
+    coldstart.add_argument("--runs", type=int, default=5)
+    coldstart.add_argument("--target-ms", type=float, default=300.0, help="Objetivo para la mediana hasta el primer pulso.")
+    coldstart.add_argument("--script", default=str(Path(__file__).with_name("midimaster.py")), help="midimaster.py a medir (para comparar versiones).")
+    coldstart.add_argument("--extra", nargs=argparse.REMAINDER, default=[], help="Argumentos adicionales para midimaster.py.")
+
+    isolation = subparsers.add_parser("isolation", help="Error de los pulsos con carga en el front-end: clock en hilo frente a proceso aparte.")
+    isolation.add_argument("--bpm", type=float, default=120.0)
+    isolation.add_argument("--seconds", type=float, default=4.0)
+    isolation.add_argument("--load-threads", type=int, default=2)
+
+    suite = subparsers.add_parser("suite", help="Casos estándar con opciones por defecto y un único JSON de resultados.")
+    suite.add_argument("--cases", nargs="+", choices=SUITE_CASES, default=list(SUITE_CASES))
+    suite.add_argument("--output", metavar="RUTA", help="Guarda el informe JSON en RUTA.")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    CASES[args.case](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@
 import mido
 import time
 import json
+import re
 import argparse
 import traceback
 import signal
@@ -9,23 +10,50 @@ import os
 from pathlib import Path
 import sys
 import threading
+import queue
+import math
+import functools
+import gc
+import itertools
+import heapq
+import struct
+import pickle
+import socket
+import socketserver
+import stat
+from collections import deque
+from array import array
+from fractions import Fraction
 
 # --- UI Imports ---
-from prompt_toolkit import Application, HTML
-from prompt_toolkit.layout.containers import HSplit, Window
-from prompt_toolkit.layout.controls import FormattedTextControl
-from prompt_toolkit.layout.layout import Layout
-from prompt_toolkit.key_binding import KeyBindings
+# prompt_toolkit se importa al arrancar la UI (load_ui_modules); con --headless o --list-ports no se carga
+Application = HTML = HSplit = Window = FormattedTextControl = Layout = KeyBindings = None
+
+def load_ui_modules():
+    global Application, HTML, HSplit, Window, FormattedTextControl, Layout, KeyBindings
+    from prompt_toolkit import Application, HTML
+    from prompt_toolkit.layout.containers import HSplit, Window
+    from prompt_toolkit.layout.controls import FormattedTextControl
+    from prompt_toolkit.layout.layout import Layout
+    from prompt_toolkit.key_binding import KeyBindings
 
 # --- OSC Imports ---
-from pythonosc import dispatcher, osc_server, udp_client
+# pythonosc (que arrastra asyncio) solo se importa si se usa OSC (load_osc_modules)
+dispatcher = osc_server = osc_message_builder = osc_bundle_builder = None
+
+def load_osc_modules():
+    global dispatcher, osc_server, osc_message_builder, osc_bundle_builder
+    from pythonosc import dispatcher, osc_server, osc_message_builder, osc_bundle_builder
 
 # --- Global Configuration ---
 RULES_DIR_NAME = "rules_midimaster"
 RULES_DIR = Path(f"./{RULES_DIR_NAME}")
 SHUTDOWN_FLAG = False
 DEFAULT_BPM = 120.0
+DEFAULT_CONTROL_SOCKET = "/tmp/midimaster.sock" # Socket de control de --headless si no se indica otro
 PPQN = 24
+BEATS_PER_BAR = 4
+NS_PER_MINUTE = 60_000_000_000
 
 # --- Performance State ---
 class PerformanceState:
@@ -35,24 +63,47 @@ class PerformanceState:
         self.bpm_input_buffer = ""
         self.bpm_locked = False
         self.output_ports = []
+        self.output_senders = () # (puerto, función de envío de bytes crudos, PortTiming), ver set_output_ports()
+        self.send_errors = {} # nombre de puerto -> número de envíos fallidos
+        self.port_workers = () # PortWorker por puerto en modo fanout "threaded"
+        self.fanout_lead_ns = 0 # Adelanto con el que el clock entrega los pulsos a los workers
+        self.output_rates = {} # alias/subcadena de salida -> PPQN propio (clock_settings.output_rates)
+        self.clock_groups = () # (divisor, senders, workers) por PPQN de salida, ver build_output_fanout()
+        self.clock_resolution = PPQN # Pasos por negra de la rejilla: mínimo común múltiplo de los PPQN de salida
+        self.domain_configs = [] # Dominios de clock adicionales (clock_settings.domains), ya validados
         self.virtual_port_name = None
         self.last_feedback_message = ""
         self.feedback_message_time = 0
         self.feedback_message_duration = 3
+        self.late_pulses = 0
+        self.quantize = "none" # "none", "beat" o "bar": cuándo se ejecutan stop/pause con el clock en marcha
+        self.beats_per_bar = BEATS_PER_BAR
+        self.song_pulse = 0 # Pulsos emitidos desde el último start (posición de la canción)
+        self.scheduled_transport = None # Acción cuantizada pendiente, para la UI
+        self.realtime_report = [] # Resultado de --realtime en el hilo de clock
 
 performance_state = PerformanceState()
 midi_clock_thread = None
+clock_process = None # ClockProcess con --clock-process; None = clock en un hilo de este proceso
 app_ui_instance = None
-bpm_update_signal = threading.Event()
+shutdown_requested = threading.Event() # Lo espera el hilo principal en --headless
 
 # --- OSC Configuration & State ---
 main_config = {}
-osc_client = None
+osc_client = None # OscSender (o cualquier objeto con send_message(address, value), value quizá una función); None = sin envío OSC
 osc_server_thread = None
 
 # --- Mapeo de MIDI ---
 global_device_aliases = {}
 midi_filters = []
+rule_dispatcher = None # RuleDispatcher compilado a partir de midi_filters
+loaded_rule_files = [] # Rutas de los archivos de reglas cargados (los que vigila RuleWatcher)
+midi_input_ports = {} # nombre -> puerto de entrada MIDI abierto con callback
+thru_outputs = {} # alias de device_out de acciones "thru" -> (puerto, función de envío)
+latency_tracer = None # LatencyTracer con --trace-latency; None = trazado desactivado
+session_recorder = None # SessionRecorder con --record; None = sin grabación
+external_clock = None # ExternalClock con --follow; None = clock interno
+clock_domains = [] # ClockDomain abiertos en el proceso que tiene el motor de clock
 
 # --- Helper Functions ---
 def signal_handler(sig, frame):
@@ -62,48 +113,247 @@ def signal_handler(sig, frame):
         app_ui_instance.exit(result="shutdown")
     # print("\n[*] Interrupción recibida, cerrando midimaster...") # Se imprime en finally
 
+# Nombres de puertos MIDI consultados una sola vez por arranque: cada consulta al backend
+# (rtmidi) cuesta milisegundos y el arranque las repetía para cada alias.
+_port_names = {} # "inputs"/"outputs" -> lista de nombres
+
+def midi_port_names(kind, refresh=False):
+    """Nombres de los puertos MIDI de 'inputs' u 'outputs'; refresh=True vuelve a preguntar al backend."""
+    names = _port_names.get(kind)
+    if names is None or refresh:
+        names = _port_names[kind] = mido.get_input_names() if kind == "inputs" else mido.get_output_names()
+    return names
+
+# Numeración que el backend puede cambiar al reconectar un dispositivo (ALSA " 20:0", Windows " 1")
+_PORT_NUMBER = re.compile(r"\s+\d+(?::\d+)?$")
+
+def port_base_name(name):
+    """Nombre del puerto sin la numeración de cliente/índice, para reconocerlo al volver a aparecer."""
+    return _PORT_NUMBER.sub("", name)
+
 def find_port_by_substring(ports, sub):
     if not ports or not sub: return None
     for name in ports:
         if sub.lower() in name.lower(): return name
     return None
 
-def _load_json_file_content(filepath: Path):
+# Los archivos de reglas llevan comentarios // (y a veces comas finales al comentar la última
+# entrada): se quitan fuera de las cadenas antes de pasar el texto a json
+_JSON_COMMENTS = re.compile(r'("[^"\\]*(?:\\.[^"\\]*)*")|//[^\n]*|/\*.*?\*/|,(?=(?:\s|//[^\n]*|/\*.*?\*/)*[}\]])', re.S)
+
+def strip_json_comments(text):
+    """Texto JSON sin comentarios // ni /* */ ni comas finales antes de } o ]."""
+    return _JSON_COMMENTS.sub(lambda match: match.group(1) or "", text)
+
+def _parse_json_file(filepath: Path):
+    """(contenido, None) del archivo JSON con comentarios, o (None, mensaje de error)."""
     if not filepath.is_file():
-        print(f"Advertencia: Archivo '{filepath.name}' no encontrado.")
-        return None
+        return None, f"Advertencia: Archivo '{filepath.name}' no encontrado."
     try:
-        with open(filepath, 'r', encoding='utf-8') as f: content = json.load(f)
-        return content
-    except json.JSONDecodeError:
-        print(f"Error: Archivo '{filepath.name}' no es un JSON válido.")
+        with open(filepath, 'r', encoding='utf-8') as f: return json.loads(strip_json_comments(f.read())), None
+    except json.JSONDecodeError as e:
+        return None, f"Error: Archivo '{filepath.name}' no es un JSON válido (línea {e.lineno}, columna {e.colno})."
     except Exception as e:
-        print(f"Error inesperado cargando '{filepath.name}': {e}")
-    return None
+        return None, f"Error inesperado cargando '{filepath.name}': {e}"
+
+def _load_json_file_content(filepath: Path, report=print):
+    content, error = _parse_json_file(filepath)
+    if error is not None: report(error)
+    return content
+
+# --- Lectura de reglas fuera del intérprete del clock ---
+# re.sub y json.loads son una sola llamada en C cada uno y no sueltan el GIL: con un archivo de
+# reglas grande paran el hilo de clock más de 10 ms. En las recargas en caliente los hace un proceso
+# auxiliar, que devuelve el contenido en trozos pickle de RULE_PARSE_CHUNK mapeos; aquí se
+# deserializan de uno en uno, cediendo el GIL entre trozos.
+RULE_PARSE_CHUNK = 50
+RULE_MAPPING_KEYS = ("input_mappings", "midi_filter")
+_rule_parser = None # ProcessPoolExecutor de un proceso, creado en la primera recarga
+
+def _parse_rule_file_chunks(path_name):
+    """(Proceso auxiliar) (error, clave de los mapeos, trozos pickle: cabecera y luego los mapeos)."""
+    content, error = _parse_json_file(Path(path_name))
+    if error is not None: return error, None, ()
+    key = next((key for key in RULE_MAPPING_KEYS if isinstance(content, dict) and key in content), None)
+    mappings = content.get(key) if key else None
+    if not isinstance(mappings, list): return None, None, (pickle.dumps(content),)
+    content[key] = []
+    return None, key, (pickle.dumps(content),) + tuple(pickle.dumps(mappings[i:i + RULE_PARSE_CHUNK])
+                                                       for i in range(0, len(mappings), RULE_PARSE_CHUNK))
+
+def _rule_parser_init():
+    """Prioridad mínima para el proceso auxiliar: en una sola CPU no le quita turno al clock."""
+    if hasattr(os, "nice"):
+        try: os.nice(19)
+        except OSError: pass
+
+def start_rule_parser():
+    """Arranca (si no lo está) el proceso auxiliar de lectura de reglas; None si no es posible."""
+    global _rule_parser
+    if _rule_parser is None:
+        import concurrent.futures, multiprocessing
+        try:
+            # spawn: proceso limpio, sin los hilos ni los puertos de este
+            _rule_parser = concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn"),
+                                                                  initializer=_rule_parser_init)
+            _rule_parser.submit(int).result(timeout=30) # Que el proceso ya esté listo en la primera recarga
+        except Exception:
+            stop_rule_parser()
+    return _rule_parser
+
+def stop_rule_parser():
+    global _rule_parser
+    if _rule_parser is not None:
+        _rule_parser.shutdown(wait=False)
+        _rule_parser = None
+
+def load_rule_file_content_offloaded(filepath: Path, report=print):
+    """Como _load_json_file_content, pero leído y parseado en el proceso auxiliar (o aquí si no lo hay)."""
+    parser = start_rule_parser()
+    if parser is None:
+        return _load_json_file_content(filepath, report)
+    try:
+        error, key, chunks = parser.submit(_parse_rule_file_chunks, str(filepath)).result(timeout=30)
+    except Exception as e: # Proceso caído o colgado: se recrea en la próxima recarga
+        stop_rule_parser()
+        report(f"Error leyendo '{filepath.name}' en el proceso auxiliar: {e}")
+        return None
+    if error is not None:
+        report(error)
+        return None
+    content = pickle.loads(chunks[0])
+    for chunk in chunks[1:]:
+        time.sleep(0) # Ceder el GIL al hilo de clock entre trozos
+        content[key].extend(pickle.loads(chunk))
+    return content
+
+MAX_CLOCK_RESOLUTION = 960 # Pasos por negra como máximo en una rejilla de clock
+
+def lcm(*values):
+    """Mínimo común múltiplo de enteros positivos (math.lcm admite varios solo desde Python 3.9)."""
+    return functools.reduce(lambda a, b: a * b // math.gcd(a, b), values, 1)
+
+def parse_output_rate(spec):
+    """
+    PPQN de una salida a partir de {"ppqn": N}, {"multiplier": M} o {"divider": D} (sobre los 24 PPQN
+    del clock; un número suelto es el PPQN). Devuelve None si no da un número entero de pulsos por negra.
+    """
+    if isinstance(spec, (int, float)) and not isinstance(spec, bool):
+        spec = {"ppqn": spec}
+    if not isinstance(spec, dict): return None
+    try:
+        if "ppqn" in spec:
+            rate = Fraction(str(spec["ppqn"]))
+        else:
+            rate = PPQN * Fraction(str(spec.get("multiplier", 1))) / Fraction(str(spec.get("divider", 1)))
+    except (ValueError, ZeroDivisionError):
+        return None
+    if rate <= 0 or rate.denominator != 1 or rate > MAX_CLOCK_RESOLUTION: return None
+    return int(rate)
+
+def _parse_rates(specs, where):
+    """{alias: especificación} -> {alias: PPQN}; las entradas no válidas se avisan y se quedan en 24 PPQN."""
+    rates = {}
+    for alias, spec in specs.items():
+        ppqn = PPQN if spec is None or spec == {} else parse_output_rate(spec)
+        if ppqn is None:
+            print(f"Advertencia: División de clock no válida para '{alias}' en {where}: {spec}. Se usarán {PPQN} PPQN.")
+            ppqn = PPQN
+        rates[alias] = ppqn
+    return rates
+
+def parse_domain_config(config):
+    """Valida un dominio de clock_settings.domains; devuelve None (con aviso) si no se puede usar."""
+    name = config.get("name") if isinstance(config, dict) else None
+    if not isinstance(name, str) or not name:
+        print(f"Advertencia: Dominio de clock sin nombre ignorado: {config}")
+        return None
+    outputs = config.get("outputs", {})
+    if isinstance(outputs, list): # Lista de alias: todas a 24 PPQN
+        outputs = {alias: None for alias in outputs if isinstance(alias, str)}
+    if not isinstance(outputs, dict) or not outputs:
+        print(f"Advertencia: El dominio de clock '{name}' no tiene salidas (outputs); se ignora.")
+        return None
+    bpm = config.get("bpm", DEFAULT_BPM)
+    bpm = max(20.0, min(300.0, float(bpm))) if isinstance(bpm, (int, float)) else DEFAULT_BPM
+    return {"name": name, "bpm": bpm, "outputs": _parse_rates(outputs, f"el dominio '{name}'"),
+            "link_transport": bool(config.get("link_transport"))}
+
+def apply_live_clock_settings(clock_settings):
+    """Ajustes de clock_settings que se pueden cambiar con el clock en marcha (también al recargar)."""
+    quantize = clock_settings.get("quantize")
+    if quantize in QUANTIZE_MODES:
+        performance_state.quantize = quantize
+    beats_per_bar = clock_settings.get("beats_per_bar")
+    if isinstance(beats_per_bar, int) and beats_per_bar > 0:
+        performance_state.beats_per_bar = beats_per_bar
+
+class RuleFile:
+    """Contenido de un archivo de reglas ya leído y normalizado; se guarda en caché por ruta, mtime y tamaño."""
+    def __init__(self, path, stamp, content):
+        self.path = path
+        self.stamp = stamp
+        devices = content.get("device_alias", {})
+        self.aliases = dict(devices) if isinstance(devices, dict) else {}
+        # "input_mappings" es el nombre documentado; "midi_filter" el de los primeros archivos
+        mappings = content.get("input_mappings", content.get("midi_filter", []))
+        self.mappings = []
+        if isinstance(mappings, list):
+            for i, m_config in enumerate(mappings):
+                if isinstance(m_config, dict):
+                    m_config["_source_file"] = path.name
+                    m_config["_map_id_in_file"] = i
+                    self.mappings.append(m_config)
+        clock_settings = content.get("clock_settings", {})
+        self.clock_settings = clock_settings if isinstance(clock_settings, dict) else {}
+        self.dispatchers = {} # (alias, salidas thru) -> RuleDispatcher compilado con estos mapeos
+
+    def dispatcher(self, aliases):
+        """RuleDispatcher de este archivo con esos alias, compilado una sola vez por versión del archivo."""
+        # Las acciones "thru" capturan su puerto al compilar: otro puerto abierto es otra compilación
+        key = (tuple(sorted(aliases.items())), tuple(sorted((alias, id(entry[0])) for alias, entry in thru_outputs.items())))
+        compiled = self.dispatchers.get(key)
+        if compiled is None:
+            compiled = self.dispatchers[key] = RuleDispatcher(self.mappings, aliases)
+        return compiled
+
+_rule_cache = {} # ruta -> RuleFile de la última versión leída
+
+def _file_stamp(path):
+    """(mtime en ns, tamaño) del archivo, o None si no existe."""
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def compile_rule_file(path, report=print, load=_load_json_file_content):
+    """
+    RuleFile de path, desde la caché si el archivo no ha cambiado; None si no se puede leer.
+    load(path, report) lee el contenido (en las recargas, load_rule_file_content_offloaded).
+    """
+    stamp = _file_stamp(path)
+    cached = _rule_cache.get(path)
+    if cached is not None and cached.stamp == stamp:
+        return cached
+    content = load(path, report)
+    if not content or not isinstance(content, dict): return None
+    rule_file = _rule_cache[path] = RuleFile(path, stamp, content)
+    return rule_file
 
 def load_rule_file(fp: Path):
     global global_device_aliases, midi_filters, performance_state
-    content = _load_json_file_content(fp)
-    if not content or not isinstance(content, dict): return False # Indicar fallo
-
-    devices = content.get("device_alias", {})
-    mappings = content.get("midi_filter", [])
-    clock_settings = content.get("clock_settings", {}) # Cargar clock_settings
+    rule_file = compile_rule_file(fp)
+    if rule_file is None: return False # Indicar fallo
+    loaded_rule_files.append(fp)
 
-    if isinstance(devices, dict):
-        if not global_device_aliases: # Cargar solo los primeros alias definidos
-            global_device_aliases.update(devices)
-        # else: si ya hay alias, no sobrescribir con los de archivos posteriores (o decidir otra estrategia)
-            
-    if isinstance(mappings, list):
-        for i, m_config in enumerate(mappings):
-            if isinstance(m_config, dict):
-                m_config["_source_file"] = fp.name
-                m_config["_map_id_in_file"] = i
-                midi_filters.append(m_config)
+    if not global_device_aliases: # Cargar solo los primeros alias definidos
+        global_device_aliases.update(rule_file.aliases)
+    midi_filters.extend(rule_file.mappings)
+    clock_settings = rule_file.clock_settings
     
     # Aplicar clock_settings
-    if isinstance(clock_settings, dict):
+    if clock_settings:
         new_bpm = clock_settings.get("default_bpm")
         if isinstance(new_bpm, (int, float)):
             performance_state.bpm = max(20.0, min(300.0, float(new_bpm)))
@@ -117,6 +367,24 @@ def load_rule_file(fp: Path):
              # Guardaremos el alias para resolverlo después
              performance_state.default_device_out_alias_from_json = default_out_alias
 
+        follow_alias = clock_settings.get("follow")
+        if follow_alias: # Se resuelve en main() como device_out
+            performance_state.follow_alias_from_json = follow_alias
+
+        apply_live_clock_settings(clock_settings)
+
+        output_rates = clock_settings.get("output_rates")
+        if isinstance(output_rates, dict):
+            performance_state.output_rates.update(_parse_rates(output_rates, "output_rates"))
+        domains = clock_settings.get("domains")
+        if isinstance(domains, list):
+            for domain_config in domains:
+                domain_config = parse_domain_config(domain_config)
+                if domain_config is None: continue
+                if any(d["name"] == domain_config["name"] for d in performance_state.domain_configs):
+                    print(f"Advertencia: Dominio de clock '{domain_config['name']}' repetido; se usa el primero.")
+                    continue
+                performance_state.domain_configs.append(domain_config)
 
     return True # Indicar éxito
 
@@ -127,9 +395,11 @@ OSC_ADDRESSES = {
     "STOP": "/midimaster/stop",
     "PAUSE": "/midimaster/pause",
     "SET_BPM": "/midimaster/bpm/set",
-    # Para enviar actualizaciones
+    "RAMP_BPM": "/midimaster/bpm/ramp",
+    # Para enviar actualizaciones (TIMING también responde a peticiones recibidas en esa dirección)
     "STATUS": "/midimaster/status",
-    "CURRENT_BPM": "/midimaster/bpm/current"
+    "CURRENT_BPM": "/midimaster/bpm/current",
+    "TIMING": "/midimaster/stats/timing"
 }
 
 def load_main_config():
@@ -138,146 +408,2413 @@ def load_main_config():
     defaults = {
         "general_settings": {
             "default_bpm": 120.0,
-            "default_virtual_port_name": "midimaster_OUT"
+            "default_virtual_port_name": "midimaster_OUT",
+            "ui_beat_indicator": True,
+            "ui_timing_refresh_ms": 1000,
+            "control_socket": "",
+            "rules_reload_interval_ms": 500,
+            "device_monitor_interval_ms": 1000,
+            "session_record": ""
         },
         "osc_configuration": {
             "enabled": False,
             "listen_ip": "0.0.0.0",
             "listen_port": 8000,
             "send_ip": "127.0.0.1",
-            "send_port": 9000
-        }
+            "send_port": 9000,
+            "send_targets": [],
+            "bundle_window_ms": 1.0
+        },
+        "clock_engine": dict(CLOCK_ENGINE_DEFAULTS)
     }
     if not config_path.is_file():
         print(f"Advertencia: Archivo de configuración '{config_path.name}' no encontrado. Usando valores por defecto.")
         return defaults
 
-    try:
-        with open(config_path, 'r', encoding='utf-8') as f:
-            user_config = json.load(f)
-        
-        # Sobrescribir valores por defecto con los del usuario de forma segura
-        defaults["general_settings"].update(user_config.get("general_settings", {}))
-        defaults["osc_configuration"].update(user_config.get("osc_configuration", {}))
-        return defaults
-    except (json.JSONDecodeError, Exception) as e:
-        print(f"Error cargando '{config_path.name}': {e}. Usando valores por defecto.")
-        return defaults
-    
+    try:
+        with open(config_path, 'r', encoding='utf-8') as f:
+            user_config = json.loads(strip_json_comments(f.read()))
+        
+        # Sobrescribir valores por defecto con los del usuario de forma segura
+        defaults["general_settings"].update(user_config.get("general_settings", {}))
+        defaults["osc_configuration"].update(user_config.get("osc_configuration", {}))
+        defaults["clock_engine"].update(user_config.get("clock_engine", {}))
+        return defaults
+    except (json.JSONDecodeError, Exception) as e:
+        print(f"Error cargando '{config_path.name}': {e}. Usando valores por defecto.")
+        return defaults
+    
+
+# --- Motor de precisión del clock ---
+# "sleep": solo time.sleep (mínimo CPU, precisión limitada por el planificador del SO)
+# "yield": sleep grueso + espera final cediendo la CPU con time.sleep(0)
+# "spin":  sleep grueso + espera activa final (máxima precisión, más CPU)
+PRECISION_MODES = ("sleep", "yield", "spin")
+# Política para pulsos que llegan tarde (al menos un intervalo completo de retraso):
+# "burst": envía los pulsos perdidos de golpe (hasta max_burst) para no perder la cuenta
+# "skip": descarta los pulsos perdidos y mantiene la fase de la rejilla
+# "stretch": reancla la rejilla en el instante actual (comportamiento clásico), sin cortar una
+# rampa en curso; con --follow no hace nada, la fase la marca el clock externo
+LATE_POLICIES = ("burst", "skip", "stretch")
+
+# Reparto a los puertos de salida:
+# "serial": el hilo de clock envía a cada puerto en orden
+# "threaded": un hilo por puerto con cola propia; un puerto lento no retrasa a los demás
+FANOUT_MODES = ("serial", "threaded")
+
+# Cuantización del transporte (clock_settings.quantize en el archivo de reglas). Solo se cuantizan
+# stop y pause; play y continue arrancan al instante: con el clock parado no hay tiempos en marcha
+# a los que alinearlos.
+QUANTIZE_MODES = ("none", "beat", "bar")
+
+# Recolector de basura con --realtime:
+# "disable": congelado al arrancar y desactivado mientras suena el clock
+# "freeze": solo congelado al arrancar
+# "none": el recolector no se toca
+RT_GC_MODES = ("disable", "freeze", "none")
+
+CLOCK_ENGINE_DEFAULTS = {
+    "precision": "yield",
+    "spin_window_ms": "auto",
+    "late_policy": "burst",
+    "max_burst": 4,
+    "fanout": "serial",
+    "port_queue_size": 8,
+    "port_offsets_ms": {},
+    "bpm_apply_interval_ms": 0,
+    "osc_echo_interval_ms": 50,
+    "timing_buffer_size": 4096,
+    "late_threshold_ms": 1.0,
+    "stats_osc_interval_ms": 1000,
+    "timing_dump": "",
+    "trace_latency": False,
+    "slow_rule_ms": 1.0,
+    "process": False,
+    "realtime": False,
+    "rt_priority": 80,
+    "rt_cpu": None,
+    "rt_lock_memory": True,
+    "rt_gc": "disable",
+    "follow_offset_ms": 0.0,
+    "follow_phase_gain": 0.1,
+    "follow_dropout_ms": 250
+}
+
+def calibrate_sleep_overshoot(samples=40, request_ns=1_000_000):
+    """Mide cuánto se pasa time.sleep() respecto a lo pedido (percentil 90, en ns)."""
+    overshoots = []
+    for _ in range(samples):
+        t0 = time.perf_counter_ns()
+        time.sleep(request_ns / 1e9)
+        overshoots.append(time.perf_counter_ns() - t0 - request_ns)
+    overshoots.sort()
+    return max(0, overshoots[int(len(overshoots) * 0.9)])
+
+class PrecisionTimer:
+    """Espera híbrida hasta un deadline absoluto (perf_counter_ns): sleep grueso y fase final de spin/yield."""
+    def __init__(self, precision="yield", spin_window_ns=1_000_000):
+        self.precision = precision if precision in PRECISION_MODES else "yield"
+        self.spin_window_ns = 0 if self.precision == "sleep" else max(0, int(spin_window_ns))
+
+    @classmethod
+    def from_config(cls, engine_config):
+        precision = engine_config.get("precision", CLOCK_ENGINE_DEFAULTS["precision"])
+        window_ms = engine_config.get("spin_window_ms", "auto")
+        if isinstance(window_ms, (int, float)):
+            spin_window_ns = int(window_ms * 1_000_000)
+        else: # "auto": ventana = sobrepaso típico de sleep con margen, acotada a [0.2, 4] ms
+            spin_window_ns = min(4_000_000, max(200_000, calibrate_sleep_overshoot() * 3 // 2 + 200_000))
+        return cls(precision, spin_window_ns)
+
+    def wait_until(self, deadline_ns):
+        remaining = deadline_ns - time.perf_counter_ns()
+        if remaining > self.spin_window_ns:
+            time.sleep((remaining - self.spin_window_ns) / 1e9)
+        if self.precision == "spin":
+            while time.perf_counter_ns() < deadline_ns: pass
+        elif self.precision == "yield":
+            while time.perf_counter_ns() < deadline_ns: time.sleep(0)
+        else: # "sleep": el sleep grueso ya cubrió todo el intervalo
+            remaining = deadline_ns - time.perf_counter_ns()
+            if remaining > 0: time.sleep(remaining / 1e9)
+
+_precision_timer = None
+_precision_timer_lock = threading.Lock() # La calibración puede adelantarse en otro hilo al arrancar
+
+def get_precision_timer():
+    """PrecisionTimer compartido (la calibración se hace una sola vez)."""
+    global _precision_timer
+    with _precision_timer_lock:
+        if _precision_timer is None:
+            _precision_timer = PrecisionTimer.from_config(main_config.get("clock_engine", CLOCK_ENGINE_DEFAULTS))
+    return _precision_timer
+
+# --- Modo tiempo real (--realtime) ---
+MCL_CURRENT, MCL_FUTURE = 1, 2
+
+def enter_realtime(engine_config):
+    """
+    Prepara el hilo que la llama (el de clock) para tiempo real: SCHED_FIFO, afinidad a una CPU,
+    memoria bloqueada y recolector cíclico congelado. Lo que falle no es fatal; devuelve un
+    informe con una línea por apartado.
+    """
+    report = []
+    try:
+        priority = int(engine_config.get("rt_priority", 80))
+    except (TypeError, ValueError):
+        message = f"rt_priority no válido ({engine_config.get('rt_priority')!r}); se usa 80"
+        report.append(f"SCHED_FIFO: {message}")
+        set_feedback_message(message)
+        priority = 80
+    if not hasattr(os, "sched_setscheduler"):
+        report.append("SCHED_FIFO: no disponible en esta plataforma")
+    else:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority)) # 0 = este hilo
+            report.append(f"SCHED_FIFO: prioridad {priority}")
+            if engine_config.get("precision") == "spin" and engine_config.get("rt_cpu") is None:
+                report.append("  aviso: precision \"spin\" con SCHED_FIFO puede acaparar una CPU; usa rt_cpu con un núcleo libre")
+        except (PermissionError, OSError) as e:
+            report.append(f"SCHED_FIFO: no aplicado ({e.strerror or e}); requiere CAP_SYS_NICE o rtprio en /etc/security/limits.conf")
+
+    cpu = engine_config.get("rt_cpu")
+    if cpu is not None:
+        if not hasattr(os, "sched_setaffinity"):
+            report.append("Afinidad de CPU: no disponible en esta plataforma")
+        else:
+            try:
+                os.sched_setaffinity(0, {int(cpu)})
+                report.append(f"Afinidad de CPU: núcleo {int(cpu)}")
+            except (OSError, ValueError) as e:
+                report.append(f"Afinidad de CPU: no aplicada al núcleo {cpu} ({e})")
+
+    if engine_config.get("rt_lock_memory", True):
+        import ctypes
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            if libc.mlockall(MCL_CURRENT | MCL_FUTURE) == 0:
+                report.append("Memoria: bloqueada (mlockall)")
+            else:
+                report.append(f"Memoria: no bloqueada ({os.strerror(ctypes.get_errno())}); requiere CAP_IPC_LOCK o subir 'ulimit -l'")
+        except (OSError, AttributeError):
+            report.append("Memoria: mlockall no disponible en esta plataforma")
+
+    gc_mode = engine_config.get("rt_gc", "disable")
+    if gc_mode in RT_GC_MODES and gc_mode != "none":
+        gc.collect()
+        gc.freeze() # Los objetos vivos al arrancar dejan de recorrerse en cada recolección
+        report.append("GC: congelado" + (", desactivado mientras suena el clock" if gc_mode == "disable" else ""))
+    return report
+
+def bpm_to_fraction(bpm):
+    """BPM como fracción exacta de su representación decimal (120.5 -> 241/2)."""
+    return Fraction(str(float(bpm)))
+
+MAX_RAMP_BARS = 256 # Límite de la rampa: la tabla tiene un pulso por entrada
+
+def ramp_bars_value(bars):
+    """bars como float si es una longitud de rampa válida (finita, 0-MAX_RAMP_BARS); si no, ValueError."""
+    bars = float(bars)
+    if not (0 <= bars <= MAX_RAMP_BARS): # También descarta inf y nan
+        raise ValueError(f"los compases de la rampa deben estar entre 0 y {MAX_RAMP_BARS}")
+    return bars
+
+class TempoRamp:
+    """
+    Rampa de tempo precalculada: offsets[i] es el instante (ns desde el ancla) del pulso i,
+    con offsets[0] = 0 en el pulso de partida. bpms[i] es el tempo mostrado en ese pulso.
+    """
+    def __init__(self, start_bpm, target_bpm, bars, beats_per_bar=BEATS_PER_BAR, ppqn=PPQN):
+        bars = ramp_bars_value(bars)
+        self.target_bpm = target_bpm
+        total_pulses = max(1, int(round(bars * beats_per_bar * ppqn)))
+        self.offsets = array('q', [0])
+        self.bpms = [float(start_bpm)]
+        elapsed = 0.0
+        for i in range(1, total_pulses + 1):
+            bpm = start_bpm + (target_bpm - start_bpm) * i / total_pulses
+            elapsed += NS_PER_MINUTE / (bpm * ppqn)
+            self.offsets.append(int(round(elapsed)))
+            self.bpms.append(bpm)
+
+class TempoGrid:
+    """
+    Rejilla de pulsos en nanosegundos enteros.
+    El deadline del pulso N se calcula directamente como ancla + N * periodo, con el periodo
+    como fracción exacta (60e9 * den / (num * PPQN)), así que no se acumula error de redondeo.
+    Durante una rampa los deadlines salen de la tabla precalculada de TempoRamp.
+    """
+    def __init__(self, bpm=DEFAULT_BPM, ppqn=PPQN):
+        self.ppqn = ppqn
+        self.anchor_ns = 0
+        self.index = 0 # Próximo pulso a emitir
+        self.ramp = None
+        self.set_tempo(bpm)
+
+    def set_tempo(self, bpm):
+        self.bpm = float(bpm)
+        tempo = bpm_to_fraction(bpm)
+        self.period_num = NS_PER_MINUTE * tempo.denominator
+        self.period_den = tempo.numerator * self.ppqn
+
+    def start(self, anchor_ns):
+        self.anchor_ns = anchor_ns
+        self.index = 0
+        self.ramp = None
+
+    def _rebase(self):
+        """Reancla la rejilla en el último pulso emitido (índice 0 = ese pulso)."""
+        if self.index > 0:
+            self.anchor_ns = self.deadline(self.index - 1)
+            self.index = 1
+        self.ramp = None
+
+    def retempo(self, bpm):
+        """Cambia el tempo manteniendo la fase: la rejilla nueva parte del último pulso emitido."""
+        self._rebase()
+        self.set_tempo(bpm)
+
+    def reanchor(self, now_ns):
+        """Desplaza la rejilla para que el próximo pulso toque en now_ns; una rampa en curso sigue su tabla."""
+        self.anchor_ns += now_ns - self.deadline(self.index)
+
+    def start_ramp(self, ramp):
+        """Instala una rampa precalculada partiendo del último pulso emitido."""
+        self._rebase()
+        self.set_tempo(ramp.target_bpm) # Tempo constante al terminar la rampa
+        self.ramp = ramp
+
+    def advance(self):
+        self.index += 1
+        ramp = self.ramp
+        if ramp is not None and self.index >= len(ramp.offsets): # Rampa terminada
+            last = len(ramp.offsets) - 1
+            self.anchor_ns += ramp.offsets[last]
+            self.index -= last
+            self.ramp = None
+
+    def current_bpm(self):
+        """Tempo del último pulso emitido (en rampa, el de la tabla precalculada)."""
+        ramp = self.ramp
+        if ramp is None: return self.bpm
+        return ramp.bpms[min(max(self.index - 1, 0), len(ramp.bpms) - 1)]
+
+    def period_ns(self):
+        return self.deadline(self.index + 1) - self.deadline(self.index)
+
+    def nominal_period_ns(self):
+        """Periodo al tempo fijado, sin tener en cuenta rampas."""
+        return self.period_num // self.period_den
+
+    def deadline(self, index):
+        ramp = self.ramp
+        if ramp is not None:
+            last = len(ramp.offsets) - 1
+            if index <= last:
+                return self.anchor_ns + ramp.offsets[index]
+            return self.anchor_ns + ramp.offsets[last] + ((index - last) * self.period_num) // self.period_den
+        return self.anchor_ns + (index * self.period_num) // self.period_den
+
+    def next_deadline(self):
+        return self.deadline(self.index)
+
+    def ready(self):
+        return True
+
+# --- Seguimiento de un clock MIDI externo (--follow) ---
+FOLLOW_RING_SIZE = 128 # Instantes de llegada guardados (más de 5 negras a 24 PPQN)
+
+class ExternalClock:
+    """
+    Estimación de tempo y fase de un clock MIDI entrante. El callback de entrada guarda la llegada
+    de cada 0xF8 en un anillo de tamaño fijo y actualiza un modelo lineal (pulso n llega en
+    anchor_ns + (n - anchor_n) * period_ns) con un PLL alfa-beta. Mientras engancha (la primera
+    negra, o tras un corte) el modelo sale de un ajuste por mínimos cuadrados sobre el anillo.
+    Un pulso aislado fuera de fase se descarta; varios seguidos obligan a volver a enganchar.
+    El hilo de clock solo lee model, una tupla que se sustituye de una vez.
+    """
+    def __init__(self, port_name, engine_config=None, bpm=DEFAULT_BPM):
+        engine_config = engine_config or CLOCK_ENGINE_DEFAULTS
+        self.port_name = port_name
+        self.alpha = min(1.0, max(0.001, float(engine_config.get("follow_phase_gain", 0.1))))
+        self.beta = self.alpha * self.alpha / (2 - self.alpha) # Amortiguamiento crítico
+        self.lock_pulses = PPQN
+        self.min_dropout_ns = int(float(engine_config.get("follow_dropout_ms", 250)) * 1_000_000)
+        self.arrivals = array('q', bytes(8 * FOLLOW_RING_SIZE))
+        self.count = 0 # Pulsos recibidos (índice del próximo)
+        self.run_start = 0 # Primer pulso de la racha actual sin cortes
+        self.outliers = 0 # Pulsos seguidos con error de fase de más de medio periodo
+        self.last_ns = 0
+        self.locked = False
+        self.start_index = None # Índice del primer pulso tras un start/continue recibido
+        self.model = (0, 0, NS_PER_MINUTE / (bpm * PPQN)) # (anchor_n, anchor_ns, period_ns)
+        self.arrived = threading.Event() # Despierta al hilo de clock mientras no hay enganche
+
+    def dropout_ns(self, period_ns):
+        return max(self.min_dropout_ns, int(3 * period_ns))
+
+    def on_clock(self, now_ns):
+        n = self.count
+        arrivals = self.arrivals
+        arrivals[n % FOLLOW_RING_SIZE] = now_ns
+        anchor_n, anchor_ns, period = self.model
+        if n == 0 or now_ns - self.last_ns > self.dropout_ns(period):
+            self.run_start = n # Primer pulso o vuelta tras un corte: empezar a enganchar
+            self.locked = False
+            model = (n, now_ns, period)
+        else:
+            run = n - self.run_start
+            error = now_ns - (anchor_ns + (n - anchor_n) * period)
+            if self.locked and abs(error) > period / 2:
+                self.outliers += 1
+                if self.outliers < 3: # Un retraso aislado de la entrada no mueve la salida
+                    model = self.model
+                else: # Salto de fase o de tempo: volver a enganchar con los pulsos de ahora
+                    self.run_start = n - 1
+                    self.locked = False
+                    self.outliers = 0
+                    model = (n, now_ns, now_ns - self.last_ns)
+            elif not self.locked:
+                model = self._fit(n, min(run, FOLLOW_RING_SIZE - 1))
+                self.locked = run >= self.lock_pulses
+            else: # PLL: corrección proporcional de la fase e integral del periodo
+                self.outliers = 0
+                model = (n, now_ns - (1 - self.alpha) * error, period + self.beta * error)
+        self.model = model
+        self.last_ns = now_ns
+        self.count = n + 1
+        if not self.locked: self.arrived.set()
+
+    def _fit(self, n, span):
+        """Recta por mínimos cuadrados de las llegadas n-span..n; devuelve el modelo anclado en n."""
+        arrivals = self.arrivals
+        base_ns = arrivals[(n - span) % FOLLOW_RING_SIZE]
+        points = span + 1
+        mean_x = span / 2
+        mean_y = sum(arrivals[(n - span + i) % FOLLOW_RING_SIZE] - base_ns for i in range(points)) / points
+        sxx = sxy = 0.0
+        for i in range(points):
+            dx = i - mean_x
+            sxx += dx * dx
+            sxy += dx * (arrivals[(n - span + i) % FOLLOW_RING_SIZE] - base_ns - mean_y)
+        period = sxy / sxx
+        return (n, base_ns + mean_y + (span - mean_x) * period, period)
+
+    def on_start(self):
+        self.start_index = self.count
+
+    def take_start_index(self):
+        index, self.start_index = self.start_index, None
+        return self.count if index is None else index
+
+    def bpm(self):
+        return NS_PER_MINUTE / (self.model[2] * PPQN)
+
+class FollowGrid:
+    """
+    Rejilla del hilo de clock en modo --follow, con la interfaz de TempoGrid. El pulso i desde el
+    start sale en el instante que el modelo de ExternalClock predice para el pulso de entrada
+    correspondiente (más offset_ns), así que la salida no hereda el jitter de la entrada.
+    Sin enganche, cada pulso espera a su pulso de entrada y sale al llegar.
+    """
+    ramp = None # Las rampas no aplican: el tempo lo marca el clock externo
+
+    def __init__(self, follower, offset_ns=0):
+        self.follower = follower
+        self.offset_ns = offset_ns
+        self.base = 0 # Índice de entrada del pulso 0 de la rejilla
+        self.index = 0
+
+    def set_tempo(self, bpm): pass
+    def retempo(self, bpm): pass
+    def start_ramp(self, ramp): pass
+
+    def start(self, anchor_ns):
+        self.base = self.follower.take_start_index()
+        self.index = 0
+
+    def advance(self):
+        self.index += 1
+
+    def current_bpm(self):
+        return self.follower.bpm()
+
+    def period_ns(self):
+        return int(self.follower.model[2])
+
+    nominal_period_ns = period_ns
+
+    def deadline(self, index):
+        follower = self.follower
+        n = self.base + index
+        if not follower.locked and n < follower.count: # Sin enganche: a la llegada del pulso
+            return follower.arrivals[n % FOLLOW_RING_SIZE] + self.offset_ns
+        anchor_n, anchor_ns, period = follower.model
+        return int(anchor_ns + (n - anchor_n) * period) + self.offset_ns
+
+    def next_deadline(self):
+        return self.deadline(self.index)
+
+    def ready(self):
+        """¿Se puede programar el próximo pulso? Enganchado y sin corte, o su pulso de entrada ya llegó."""
+        follower = self.follower
+        if follower.locked:
+            return time.perf_counter_ns() - follower.last_ns <= follower.dropout_ns(follower.model[2])
+        return self.base + self.index < follower.count
+
+    def wait_input(self, timeout):
+        self.follower.arrived.wait(timeout)
+        self.follower.arrived.clear()
+
+# --- Instrumentación de timing ---
+# Histogramas log-lineales: 8 cubos por potencia de dos (error relativo < 12,5 %), de 0 ns
+# hasta ~2^40 ns. Registrar un valor solo incrementa un contador de un array preasignado.
+HISTOGRAM_BUCKETS = 304
+TIMING_DUMP_MAGIC = b"MMTS"
+TIMING_DUMP_VERSION = 1
+TIMING_RECORD = struct.Struct("<qqqq") # pulso, deadline_ns, error_ns, duración del envío en ns
+
+def _histogram_bucket(value_ns):
+    if value_ns < 16: return max(0, value_ns)
+    bits = value_ns.bit_length()
+    return min(((bits - 3) << 3) + ((value_ns >> (bits - 4)) & 7), HISTOGRAM_BUCKETS - 1)
+
+def _histogram_bucket_high(index):
+    """Mayor valor (ns) que cae en el cubo index."""
+    if index < 16: return index
+    bits = (index >> 3) + 3
+    return (((index & 7) + 9) << (bits - 4)) - 1
+
+class LatencyHistogram:
+    """Histograma de tiempos en ns con cubos preasignados, más el máximo exacto."""
+    __slots__ = ("counts", "count", "max_ns")
+
+    def __init__(self):
+        self.counts = array('q', bytes(8 * HISTOGRAM_BUCKETS))
+        self.count = 0
+        self.max_ns = 0
+
+    def record(self, value_ns):
+        self.counts[_histogram_bucket(value_ns)] += 1
+        self.count += 1
+        if value_ns > self.max_ns: self.max_ns = value_ns
+
+    def percentile(self, fraction):
+        """Cota superior (ns) del percentil pedido, sin pasar del máximo observado."""
+        if not self.count: return 0
+        rank = max(1, math.ceil(self.count * fraction))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(_histogram_bucket_high(index), self.max_ns)
+        return self.max_ns
+
+class PortTiming:
+    """
+    Timing de un puerto de salida: retraso del envío respecto a su deadline y duración de send().
+    En fanout "threaded" lleva también los contadores de su PortWorker, que así sobreviven a una
+    reconexión del puerto.
+    """
+    __slots__ = ("name", "delay", "duration", "sent", "dropped", "errors", "max_backlog")
+
+    def __init__(self, name):
+        self.name = name
+        self.delay = LatencyHistogram()
+        self.duration = LatencyHistogram()
+        self.sent = 0 # Mensajes enviados por el worker
+        self.dropped = 0 # Pulsos de clock descartados con la cola llena (los escribe el hilo de clock)
+        self.errors = 0 # Fallos de send() en el worker
+        self.max_backlog = 0 # Mayor cola vista al entregar un mensaje
+
+    def record(self, delay_ns, duration_ns):
+        self.delay.record(delay_ns)
+        self.duration.record(duration_ns)
+
+class TimingStats:
+    """
+    Registro de timing del clock. Por cada pulso guarda en un anillo de tamaño fijo el deadline,
+    el error del envío respecto a él y cuánto tardó el envío a todas las salidas, y acumula
+    histogramas de toda la sesión. El anillo y los histogramas solo los escribe el hilo de clock;
+    los PortTiming los escribe quien envía a ese puerto (el clock o su PortWorker).
+    """
+    def __init__(self, size=4096, late_threshold_ns=1_000_000):
+        self.ports = {} # nombre de puerto -> PortTiming, se conserva si el puerto se reabre
+        self._allocate(size)
+        self.late_threshold_ns = late_threshold_ns
+
+    def _allocate(self, size):
+        self.size = max(1, int(size))
+        self.deadlines = array('q', bytes(8 * self.size))
+        self.errors = array('q', bytes(8 * self.size))
+        self.durations = array('q', bytes(8 * self.size))
+        self.pulses = 0
+        self.late = 0
+        self.jitter = LatencyHistogram()
+        self.send = LatencyHistogram()
+
+    def configure(self, engine_config):
+        size = int(engine_config.get("timing_buffer_size", 4096))
+        if size != self.size: self._allocate(size)
+        self.late_threshold_ns = int(float(engine_config.get("late_threshold_ms", 1.0)) * 1_000_000)
+
+    def port(self, name):
+        timing = self.ports.get(name)
+        if timing is None:
+            timing = self.ports[name] = PortTiming(name)
+        return timing
+
+    def record_pulse(self, deadline_ns, sent_ns, done_ns):
+        slot = self.pulses % self.size
+        error_ns = sent_ns - deadline_ns
+        self.deadlines[slot] = deadline_ns
+        self.errors[slot] = error_ns
+        self.durations[slot] = done_ns - sent_ns
+        self.pulses += 1
+        self.jitter.record(error_ns)
+        self.send.record(done_ns - sent_ns)
+        if error_ns > self.late_threshold_ns: self.late += 1
+
+    def recent(self):
+        """Registros del anillo en orden cronológico: (pulso, deadline_ns, error_ns, duración_ns)."""
+        for pulse in range(max(0, self.pulses - self.size), self.pulses):
+            slot = pulse % self.size
+            yield pulse, self.deadlines[slot], self.errors[slot], self.durations[slot]
+
+    def summary(self):
+        jitter = self.jitter
+        result = {
+            "pulses": self.pulses,
+            "p50_ns": jitter.percentile(0.5),
+            "p99_ns": jitter.percentile(0.99),
+            "max_ns": jitter.max_ns,
+            "late": self.late,
+            "missed": performance_state.late_pulses,
+            "send_p99_ns": self.send.percentile(0.99),
+            "dropped": 0,
+            "port_errors": 0,
+            "max_backlog": 0,
+            "worst_port": "",
+            "worst_port_p99_ns": 0,
+        }
+        for timing in list(self.ports.values()):
+            result["dropped"] += timing.dropped
+            result["port_errors"] += timing.errors
+            result["max_backlog"] = max(result["max_backlog"], timing.max_backlog)
+            p99 = timing.delay.percentile(0.99)
+            if p99 > result["worst_port_p99_ns"] or not result["worst_port"]:
+                result["worst_port"], result["worst_port_p99_ns"] = timing.name, p99
+        return result
+
+    def dump(self, path):
+        """
+        Vuelca el anillo a path: CSV si la extensión es .csv; si no, binario con cabecera
+        MMTS, versión (uint16) y número de registros (uint32), y registros TIMING_RECORD.
+        """
+        records = list(self.recent())
+        if Path(path).suffix.lower() == ".csv":
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("pulse,deadline_ns,error_ns,send_ns\n")
+                for record in records:
+                    f.write("%d,%d,%d,%d\n" % record)
+        else:
+            with open(path, "wb") as f:
+                f.write(TIMING_DUMP_MAGIC + struct.pack("<HI", TIMING_DUMP_VERSION, len(records)))
+                for record in records:
+                    f.write(TIMING_RECORD.pack(*record))
+        return len(records)
+
+timing_stats = TimingStats()
+
+def format_duration_ns(value_ns):
+    if value_ns >= 1_000_000: return f"{value_ns / 1_000_000:.2f}ms"
+    return f"{value_ns / 1000:.0f}µs"
+
+def current_timing_summary():
+    """Resumen de timing del clock, esté en este proceso o en el proceso de clock."""
+    return clock_process.timing if clock_process is not None else timing_stats.summary()
+
+def timing_summary_text():
+    summary = current_timing_summary()
+    return (f"p50 {format_duration_ns(summary['p50_ns'])}  p99 {format_duration_ns(summary['p99_ns'])}"
+            f"  máx {format_duration_ns(summary['max_ns'])}  tarde {summary['late']}  perdidos {summary['missed']}")
+
+def timing_osc_values():
+    """[p50_us, p99_us, max_us, tarde, perdidos, pulsos, descartados, errores] para /midimaster/stats/timing."""
+    summary = current_timing_summary()
+    return [summary["p50_ns"] / 1000, summary["p99_ns"] / 1000, summary["max_ns"] / 1000,
+            summary["late"], summary["missed"], summary["pulses"], summary["dropped"], summary["port_errors"]]
+
+# --- Trazado de latencia entrada -> salida (opcional) ---
+# Etapas: recv (llega al callback MIDI o al manejador OSC), match (el despachador ha encontrado
+# las reglas), queued (comando en command_queue), clock (el hilo de clock lo recoge), out (salen
+# los primeros bytes tras aplicarlo) y done (fin de un evento que no genera comando, p. ej. thru).
+class LatencyTrace:
+    __slots__ = ("source", "label", "stamps")
+
+    def __init__(self, source, now_ns):
+        self.source = source
+        self.label = "rules"
+        self.stamps = [("recv", now_ns)]
+
+    def mark(self, stage):
+        self.stamps.append((stage, time.perf_counter_ns()))
+
+class LatencyTracer:
+    """
+    Traza eventos de entrada hasta los bytes MIDI que producen y acumula, por tramo entre etapas
+    y por tipo de comando, histogramas de latencia; además mide cada regla y marca las lentas.
+    Desactivado, latency_tracer es None y cada punto de traza cuesta una comparación.
+    """
+    def __init__(self, slow_rule_ns=1_000_000):
+        self.slow_rule_ns = slow_rule_ns
+        self._local = threading.local() # Traza en curso en el hilo que atiende el evento
+        self._lock = threading.Lock() # Terminan trazas el hilo de clock y los de entrada
+        self.waiting = [] # Trazas ya aplicadas por el clock, a la espera de sus bytes (solo hilo de clock)
+        self.segments = {} # "etapa>etapa" -> LatencyHistogram
+        self.totals = {} # tipo de comando -> LatencyHistogram de recv a la última etapa
+        self.rules = {} # etiqueta de regla -> LatencyHistogram
+        self.slow_rules = {} # etiqueta de regla -> ejecuciones por encima de slow_rule_ns
+
+    @classmethod
+    def from_config(cls, engine_config):
+        return cls(int(float(engine_config.get("slow_rule_ms", 1.0)) * 1_000_000))
+
+    def begin(self, source):
+        trace = self._local.trace = LatencyTrace(source, time.perf_counter_ns())
+        return trace
+
+    def current(self):
+        return getattr(self._local, "trace", None)
+
+    def end(self, trace):
+        """Fin del manejador de entrada: si el evento no entregó su traza al clock, se cierra aquí."""
+        self._local.trace = None
+        if trace.label == "rules":
+            trace.mark("done")
+            self.finish(trace)
+
+    def handoff(self, trace, kind, arrival_ns):
+        """La traza acompaña al primer comando que genera el evento; queued es su llegada a la cola."""
+        self._local.trace = None
+        trace.label = kind
+        trace.stamps.append(("queued", arrival_ns))
+
+    def flush_waiting(self, stage):
+        waiting = self.waiting
+        for trace in waiting:
+            trace.mark(stage)
+            self.finish(trace)
+        waiting.clear()
+
+    def finish(self, trace):
+        stamps = trace.stamps
+        with self._lock:
+            for (prev, prev_ns), (stage, stage_ns) in zip(stamps, stamps[1:]):
+                key = f"{prev}>{stage}"
+                histogram = self.segments.get(key) or self.segments.setdefault(key, LatencyHistogram())
+                histogram.record(stage_ns - prev_ns)
+            total = self.totals.get(trace.label) or self.totals.setdefault(trace.label, LatencyHistogram())
+            total.record(stamps[-1][1] - stamps[0][1])
+
+    def run_rules(self, fns, msg, labels):
+        trace = self.current()
+        if trace is not None: trace.mark("match")
+        now = time.perf_counter_ns
+        for fn in fns:
+            start_ns = now()
+            fn(msg)
+            elapsed_ns = now() - start_ns
+            label = labels.get(fn, "?")
+            with self._lock:
+                histogram = self.rules.get(label) or self.rules.setdefault(label, LatencyHistogram())
+                histogram.record(elapsed_ns)
+                slow = elapsed_ns > self.slow_rule_ns
+                first_slow = slow and label not in self.slow_rules
+                if slow: self.slow_rules[label] = self.slow_rules.get(label, 0) + 1
+            if first_slow:
+                set_feedback_message(f"Regla lenta: {label} ({format_duration_ns(elapsed_ns)})")
+
+    def report_lines(self):
+        def row(name, histogram):
+            return (f"  {name:<22} n={histogram.count:<6} p50 {format_duration_ns(histogram.percentile(0.5))}"
+                    f"  p99 {format_duration_ns(histogram.percentile(0.99))}  máx {format_duration_ns(histogram.max_ns)}")
+        with self._lock:
+            lines = ["Latencia por tramo:"] + [row(k, h) for k, h in self.segments.items()]
+            lines += ["Latencia total por tipo:"] + [row(k, h) for k, h in self.totals.items()]
+            if self.slow_rules:
+                lines.append(f"Reglas lentas (> {format_duration_ns(self.slow_rule_ns)}):")
+                lines += [f"  {label}: {count} veces, máx {format_duration_ns(self.rules[label].max_ns)}"
+                          for label, count in self.slow_rules.items()]
+        return lines
+
+def traced_handler(source, handler):
+    """Envuelve un manejador de entrada (OSC) para que abra y cierre una traza."""
+    def wrapper(*args):
+        trace = latency_tracer.begin(source)
+        try:
+            handler(*args)
+        finally:
+            latency_tracer.end(trace)
+    return wrapper
+
+# --- Grabación de sesión (--record) ---
+# Archivo: SESSION_MAGIC, SESSION_HEADER y el JSON de ajustes iniciales; después fragmentos que solo
+# se añaden: b"N" nombre (índice y texto), b"R" registros SESSION_RECORD, b"F" archivos de reglas
+# (t_ns y JSON) y b"E" cierre (t_ns, registros, perdidos). Una grabación cortada se lee hasta el
+# último fragmento completo.
+SESSION_MAGIC = b"MMSR"
+SESSION_VERSION = 1
+SESSION_HEADER = struct.Struct("<HqdI") # versión, inicio en perf_counter_ns, inicio en time.time(), longitud del JSON
+SESSION_RECORD = struct.Struct("<IBBHqqd") # secuencia + 1, tipo, código, nombre, t_ns, entero, real
+SESSION_RING_RECORDS = 65536 # 2 MB preasignados: unos 10 s de una sesión muy cargada sin volcar
+# Tipos de registro. entero/real según el tipo: MIDI_IN mensaje empaquetado (ver _pack_midi);
+# OSC primer argumento en real y segundo x1000 en entero; TEMPO bpm; RAMP bpm destino y compases
+# x1000; TRANSPORT código = índice en TRANSPORT_STATES y pulso de canción; PULSE deadline_ns
+# (t_ns es el envío), código = resolución / 24 de la rejilla y nombre = dominio (vacío el
+# clock principal); APPLY entero = comandos que el motor sacó de la cola en ese instante (lo
+# que la reproducción necesita para despertarlo cuando despertó).
+REC_MIDI_IN, REC_OSC, REC_KEY, REC_CONTROL, REC_TEMPO, REC_RAMP, REC_TRANSPORT, REC_PULSE, REC_APPLY = range(1, 10)
+SESSION_KINDS = {REC_MIDI_IN: "midi_in", REC_OSC: "osc", REC_KEY: "key", REC_CONTROL: "control", REC_TEMPO: "tempo",
+                 REC_RAMP: "ramp", REC_TRANSPORT: "transport", REC_PULSE: "pulse", REC_APPLY: "apply"}
+
+# (estado, atributo de data1, atributo de data2) de los mensajes de canal más habituales
+_SESSION_MIDI_FIELDS = {"note_on": (0x90, "note", "velocity"), "note_off": (0x80, "note", "velocity"),
+                        "control_change": (0xB0, "control", "value"), "polytouch": (0xA0, "note", "value")}
+_SESSION_MIDI_STATUS = {"clock": 0xF8, "start": 0xFA, "continue": 0xFB, "stop": 0xFC}
+
+def _pack_midi(msg):
+    """Mensaje MIDI en un entero: estado | data1 << 8 | data2 << 16 | longitud << 24 (se guardan 3 bytes como mucho)."""
+    fields = _SESSION_MIDI_FIELDS.get(msg.type)
+    if fields is not None:
+        status, attr_1, attr_2 = fields
+        return status | msg.channel | getattr(msg, attr_1) << 8 | getattr(msg, attr_2) << 16 | 3 << 24
+    status = _SESSION_MIDI_STATUS.get(msg.type)
+    if status is not None:
+        return status | 1 << 24
+    data = msg.bytes()[:3]
+    value = len(data) << 24
+    for k, byte in enumerate(data):
+        value |= byte << (8 * k)
+    return value
+
+def unpack_midi(value):
+    """Bytes de un mensaje empaquetado con _pack_midi."""
+    return bytes((value >> (8 * k)) & 0xFF for k in range((value >> 24) & 0xFF))
+
+def rule_files_snapshot():
+    """Contenido de los archivos de reglas cargados, por nombre, para la grabación de la sesión."""
+    files = {}
+    for path in loaded_rule_files:
+        try:
+            files[path.name] = path.read_text(encoding="utf-8")
+        except OSError:
+            pass
+    return files
+
+def session_settings():
+    """Estado inicial que necesita la reproducción: tempo, salidas abiertas, reglas y motor de clock."""
+    return {"bpm": performance_state.bpm, "quantize": performance_state.quantize,
+            "beats_per_bar": performance_state.beats_per_bar,
+            "outputs": [getattr(port, "name", "") for port in performance_state.output_ports],
+            "domain_outputs": sorted({getattr(port, "name", "") for domain in clock_domains for port in domain.ports}),
+            "rules": rule_files_snapshot(), "clock_engine": main_config.get("clock_engine", {}),
+            "osc_addresses": OSC_ADDRESSES,
+            "follow": external_clock.port_name if external_clock is not None else None}
+
+class SessionRecorder:
+    """
+    Grabación de la sesión (--record): entradas MIDI por puerto, OSC, teclas, comandos de control,
+    cambios de tempo y transporte y cada paso de clock emitido, con marca de perf_counter_ns.
+    Cada evento es un registro de tamaño fijo en un anillo preasignado: quien graba reserva su
+    posición con next() sobre un contador (atómico con el GIL) y la escribe con un solo pack_into,
+    sin bloqueos ni reservar memoria. Un hilo aparte vuelca al archivo, en orden, los registros ya
+    escritos; si el anillo da la vuelta antes del volcado, los registros pisados se cuentan como perdidos.
+    """
+    def __init__(self, path, settings, capacity=SESSION_RING_RECORDS, flush_interval_s=0.05):
+        self.path = Path(path)
+        self.capacity = capacity
+        self.flush_interval_s = flush_interval_s
+        self.buffer = bytearray(SESSION_RECORD.size * capacity)
+        self._seq = itertools.count()
+        self.records = 0 # Registros volcados (o perdidos): secuencia del próximo a volcar
+        self.dropped = 0
+        self.names = {} # nombre (puerto, dirección OSC, tecla, comando) -> índice desde 1
+        self._name_list = []
+        self._names_lock = threading.Lock() # Solo la primera vez que aparece un nombre
+        self._names_written = 0
+        self._rule_snapshots = deque() # (t_ns, archivos) de las recargas de reglas, pendientes de volcar
+        self.start_ns = time.perf_counter_ns()
+        settings_json = json.dumps(settings).encode("utf-8")
+        self.file = open(self.path, "wb")
+        self.file.write(SESSION_MAGIC + SESSION_HEADER.pack(SESSION_VERSION, self.start_ns, time.time(), len(settings_json)) + settings_json)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True, name="midimaster-recorder")
+        self.record = self._bind_record()
+
+    @classmethod
+    def from_path_template(cls, template, settings):
+        """Abre la grabación en template (admite campos de strftime, p. ej. sesiones/%Y%m%d-%H%M%S.mmsr)."""
+        path = Path(time.strftime(template))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return cls(path, settings)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _bind_record(self):
+        """
+        record(kind, t_ns, code, name, value, real) con todo lo que usa ya enlazado en la clausura:
+        cada evento cuesta un next() y un pack_into, sin buscar atributos ni globales.
+        """
+        pack_into, buffer, capacity, size = SESSION_RECORD.pack_into, self.buffer, self.capacity, SESSION_RECORD.size
+        next_seq = self._seq.__next__
+        def record(kind, t_ns, code=0, name=0, value=0, real=0.0):
+            seq = next_seq()
+            pack_into(buffer, (seq % capacity) * size, (seq + 1) & 0xFFFFFFFF, kind, code, name, t_ns, value, real)
+        return record
+
+    def name_index(self, name):
+        index = self.names.get(name)
+        if index is None:
+            with self._names_lock:
+                index = self.names.get(name)
+                if index is None:
+                    if len(self._name_list) >= 0xFFFE: return 0xFFFF # Tabla llena: nombre desconocido
+                    self._name_list.append(name)
+                    index = self.names[name] = len(self._name_list)
+        return index
+
+    def midi(self, msg, port_name):
+        self.record(REC_MIDI_IN, time.perf_counter_ns(), 0, self.name_index(port_name), _pack_midi(msg))
+
+    def osc(self, address, args):
+        first = float(args[0]) if args and isinstance(args[0], (int, float)) else 0.0
+        second = round(args[1] * 1000) if len(args) > 1 and isinstance(args[1], (int, float)) else 0
+        self.record(REC_OSC, time.perf_counter_ns(), min(len(args), 255), self.name_index(address), second, first)
+
+    def key(self, key):
+        self.record(REC_KEY, time.perf_counter_ns(), 0, self.name_index(key))
+
+    def control(self, line):
+        self.record(REC_CONTROL, time.perf_counter_ns(), 0, self.name_index(line))
+
+    def tempo(self, bpm, t_ns):
+        self.record(REC_TEMPO, t_ns, 0, 0, 0, bpm)
+
+    def ramp(self, target_bpm, bars):
+        self.record(REC_RAMP, time.perf_counter_ns(), 0, 0, round(bars * 1000), target_bpm)
+
+    def transport(self, status, song_pulse, t_ns=0):
+        self.record(REC_TRANSPORT, t_ns or time.perf_counter_ns(), TRANSPORT_STATES.index(status), 0, song_pulse)
+
+    def pulse(self, sent_ns, deadline_ns, resolution=24, domain=0):
+        self.record(REC_PULSE, sent_ns, resolution // 24, domain, deadline_ns)
+
+    def apply(self, now_ns, commands):
+        self.record(REC_APPLY, now_ns, 0, 0, commands)
+
+    def rules(self, files):
+        self._rule_snapshots.append((time.perf_counter_ns(), files))
+
+    def _run(self):
+        while not self.stopped.wait(self.flush_interval_s):
+            self._drain()
+
+    def _drain(self):
+        out = bytearray()
+        names = self._name_list[self._names_written:]
+        for index, name in enumerate(names, self._names_written + 1):
+            data = name.encode("utf-8")
+            out += b"N" + struct.pack("<HH", index, len(data)) + data
+        self._names_written += len(names)
+        while self._rule_snapshots:
+            t_ns, files = self._rule_snapshots.popleft()
+            data = json.dumps(files).encode("utf-8")
+            out += b"F" + struct.pack("<qI", t_ns, len(data)) + data
+
+        buffer, size, capacity = self.buffer, SESSION_RECORD.size, self.capacity
+        records = bytearray()
+        seq = self.records
+        while len(records) < capacity * size:
+            offset = (seq % capacity) * size
+            ahead = (struct.unpack_from("<I", buffer, offset)[0] - (seq + 1)) & 0xFFFFFFFF
+            if ahead >= 0x80000000: break # Reservado pero aún sin escribir (o anillo vacío)
+            if ahead: # El anillo dio la vuelta: los registros hasta el de esta posición se han pisado
+                self.dropped += ahead - capacity + 1
+                seq += ahead - capacity + 1
+                continue
+            records += buffer[offset:offset + size]
+            seq += 1
+        count = len(records) // size
+        self.records = seq
+        if count:
+            out += b"R" + struct.pack("<I", count) + records
+        if out:
+            self.file.write(out)
+            self.file.flush()
+
+    def stop(self):
+        """Vuelca lo pendiente, cierra el archivo y devuelve (registros, perdidos)."""
+        self.stopped.set()
+        if self.thread.is_alive(): self.thread.join(timeout=1.0)
+        self._drain()
+        self.file.write(b"E" + struct.pack("<qQQ", time.perf_counter_ns(), self.records, self.dropped))
+        self.file.close()
+        return self.records, self.dropped
+
+def read_session(path):
+    """
+    Lee una grabación: (ajustes, eventos, cierre). Cada evento es (t_ns, tipo, código, nombre,
+    entero, real) ordenado por t_ns; las recargas de reglas aparecen con tipo "rules" y los
+    archivos en lugar del nombre. cierre es (t_ns, registros, perdidos) o None si la grabación se cortó.
+    """
+    data = Path(path).read_bytes()
+    if data[:4] != SESSION_MAGIC:
+        raise ValueError(f"'{path}' no es una grabación de midimaster")
+    version, start_ns, start_time, settings_len = SESSION_HEADER.unpack_from(data, 4)
+    if version != SESSION_VERSION:
+        raise ValueError(f"versión de grabación no soportada: {version}")
+    offset = 4 + SESSION_HEADER.size
+    settings = json.loads(data[offset:offset + settings_len])
+    settings.update(start_ns=start_ns, start_time=start_time)
+    offset += settings_len
+    names, raw_events, end = {0: "", 0xFFFF: "?"}, [], None
+    try:
+        while offset < len(data):
+            tag = data[offset:offset + 1]
+            offset += 1
+            if tag == b"N":
+                index, length = struct.unpack_from("<HH", data, offset)
+                offset += 4
+                names[index] = data[offset:offset + length].decode("utf-8")
+                offset += length
+            elif tag == b"R":
+                count = struct.unpack_from("<I", data, offset)[0]
+                offset += 4
+                if offset + count * SESSION_RECORD.size > len(data): break
+                for record in SESSION_RECORD.iter_unpack(data[offset:offset + count * SESSION_RECORD.size]):
+                    raw_events.append(record[1:])
+                offset += count * SESSION_RECORD.size
+            elif tag == b"F":
+                t_ns, length = struct.unpack_from("<qI", data, offset)
+                offset += 12
+                raw_events.append(("rules", 0, json.loads(data[offset:offset + length]), t_ns, 0, 0.0))
+                offset += length
+            elif tag == b"E":
+                end = struct.unpack_from("<qQQ", data, offset)
+                break
+            else:
+                break
+    except (struct.error, ValueError): # Fragmento final incompleto
+        pass
+    events = [(t_ns, kind, code, name if kind == "rules" else names.get(name, "?"), value, real)
+              for kind, code, name, t_ns, value, real in raw_events]
+    events.sort(key=lambda event: event[0]) # Estable: a igual marca se mantiene el orden de grabación
+    return settings, events, end
+
+# --- Salida MIDI rápida ---
+# Mensajes de tiempo real precodificados una sola vez; el hilo de clock no crea objetos por pulso.
+CLOCK_BYTES = b'\xf8'
+START_BYTES = b'\xfa'
+CONTINUE_BYTES = b'\xfb'
+STOP_BYTES = b'\xfc'
+SONG_POSITION_STATUS = 0xF2
+REALTIME_BYTES = {'clock': CLOCK_BYTES, 'start': START_BYTES, 'continue': CONTINUE_BYTES, 'stop': STOP_BYTES}
+_REALTIME_MESSAGES = {data: mido.Message(msg_type) for msg_type, data in REALTIME_BYTES.items()}
+
+def raw_sender_for(port):
+    """
+    Devuelve una función send(data) para el puerto. Con el backend rtmidi de mido escribe los
+    bytes directamente en el objeto rtmidi, sin crear mido.Message ni pasar por su validación.
+    En otros backends usa un mensaje mido precreado para esos bytes.
+    """
+    send_message = getattr(getattr(port, '_rt', None), 'send_message', None)
+    if send_message is not None:
+        return send_message
+    messages = _REALTIME_MESSAGES
+    port_send = port.send
+    from_bytes = mido.Message.from_bytes
+    def send(data):
+        msg = messages.get(data)
+        port_send(msg if msg is not None else from_bytes(data))
+    return send
+
+class PortWorker:
+    """
+    Hilo de envío dedicado a un puerto (fanout "threaded"). El clock le entrega (bytes, deadline)
+    por una cola y el worker envía en deadline - offset, así que un puerto lento o bloqueado solo
+    acumula cola propia. Con la cola llena se descartan pulsos de clock, nunca mensajes de transporte.
+    """
+    def __init__(self, port, send, timing, offset_ns=0, max_backlog=8, timer=None):
+        self.port = port
+        self.send = send
+        self.timing = timing
+        self.offset_ns = offset_ns
+        self.max_backlog = max_backlog
+        self.timer = timer
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, daemon=True, name=f"midimaster-out-{getattr(port, 'name', '?')}")
+        self.thread.start()
+
+    def post(self, data, deadline_ns=0):
+        backlog = self.queue.qsize()
+        timing = self.timing
+        if backlog >= self.max_backlog and data is CLOCK_BYTES:
+            if not timing.dropped: # Avisar solo del primer descarte de cada puerto
+                set_feedback_message(f"'{timing.name}' no da abasto: se descartan pulsos de clock")
+            timing.dropped += 1
+            return
+        if backlog > timing.max_backlog:
+            timing.max_backlog = backlog
+        self.queue.put((data, deadline_ns))
+
+    def _run(self):
+        get = self.queue.get
+        while True:
+            data, deadline_ns = get()
+            if data is None: break
+            target = deadline_ns - self.offset_ns
+            if deadline_ns and self.timer:
+                self.timer.wait_until(target)
+            start_ns = time.perf_counter_ns()
+            try:
+                self.send(data)
+                self.timing.sent += 1
+            except Exception as e:
+                self.timing.errors += 1
+                _report_send_error(self.port, e)
+            if deadline_ns:
+                self.timing.record(start_ns - target, time.perf_counter_ns() - start_ns)
+
+    def stop(self, timeout=0.2):
+        self.queue.put((None, 0))
+        self.thread.join(timeout=timeout)
+
+def _port_offset_ns(port_name, offsets_config):
+    """Offset de latencia (ns) configurado para un puerto, buscando por alias o substring."""
+    for key, offset_ms in offsets_config.items():
+        dev_substr = global_device_aliases.get(key, key)
+        if isinstance(offset_ms, (int, float)) and dev_substr.lower() in port_name.lower():
+            return int(offset_ms * 1_000_000)
+    return 0
+
+def _port_rate_ppqn(port_name, rates):
+    """PPQN configurado para un puerto (output_rates u outputs de un dominio), por alias o substring."""
+    for key, ppqn in rates.items():
+        dev_substr = global_device_aliases.get(key, key)
+        if dev_substr.lower() in port_name.lower():
+            return ppqn
+    return PPQN
+
+def build_output_fanout(ports, rates, engine_config):
+    """
+    Prepara el envío a un conjunto de salidas: (senders, workers, grupos de clock, resolución, adelanto).
+    La rejilla avanza a 'resolución' pasos por negra (mínimo común múltiplo de los PPQN de las
+    salidas) y cada grupo (divisor, senders, workers) recibe un pulso cada 'divisor' pasos.
+    """
+    senders = tuple((port, raw_sender_for(port), timing_stats.port(getattr(port, 'name', '?'))) for port in ports)
+    workers = ()
+    lead_ns = 0
+    if ports and engine_config.get("fanout") == "threaded":
+        offsets_config = engine_config.get("port_offsets_ms") or {}
+        max_backlog = max(1, int(engine_config.get("port_queue_size", 8)))
+        timer = get_precision_timer()
+        workers = tuple(PortWorker(port, send, timing, _port_offset_ns(getattr(port, 'name', ''), offsets_config), max_backlog, timer)
+                        for port, send, timing in senders)
+        lead_ns = max(0, max(worker.offset_ns for worker in workers))
+
+    ppqns = []
+    for port in ports:
+        ppqn = _port_rate_ppqn(getattr(port, 'name', ''), rates)
+        if ppqn != PPQN and (external_clock is not None and PPQN % ppqn or lcm(PPQN, *ppqns, ppqn) > MAX_CLOCK_RESOLUTION):
+            # Siguiendo un clock externo solo hay 24 pasos por negra: caben divisiones, no multiplicaciones
+            set_feedback_message(f"'{getattr(port, 'name', '?')}': {ppqn} PPQN no es posible aquí; se usarán {PPQN}")
+            ppqn = PPQN
+        ppqns.append(ppqn)
+    resolution = lcm(PPQN, *ppqns)
+    groups = []
+    for ppqn in sorted(set(ppqns)):
+        members = [i for i, port_ppqn in enumerate(ppqns) if port_ppqn == ppqn]
+        groups.append((resolution // ppqn, tuple(senders[i] for i in members), tuple(workers[i] for i in members) if workers else ()))
+    return senders, workers, tuple(groups), resolution, lead_ns
+
+def set_output_ports(ports):
+    """Fija los puertos de salida, precalcula sus funciones de envío y (re)crea los workers si procede."""
+    for worker in publish_output_fanout(prepare_output_fanout(ports, performance_state.output_rates)):
+        worker.stop()
+
+def prepare_output_fanout(ports, rates):
+    """(puertos, senders, workers, grupos, resolución, adelanto) de build_output_fanout, sin publicarlo aún."""
+    engine_config = main_config.get("clock_engine", CLOCK_ENGINE_DEFAULTS)
+    return (ports,) + build_output_fanout(ports, rates, engine_config)
+
+def publish_output_fanout(fanout):
+    """Publica un fanout preparado como salidas del clock principal; devuelve los workers anteriores, a parar."""
+    old_workers = performance_state.port_workers
+    ports, senders, workers, groups, resolution, lead_ns = fanout
+    performance_state.output_ports = ports
+    performance_state.output_senders = senders
+    performance_state.fanout_lead_ns = lead_ns
+    performance_state.port_workers = workers
+    performance_state.clock_groups = groups
+    performance_state.clock_resolution = resolution
+    request_ui_refresh()
+    return old_workers
+
+def _report_send_error(port, error):
+    name = getattr(port, 'name', '?')
+    count = performance_state.send_errors.get(name, 0)
+    performance_state.send_errors[name] = count + 1
+    if count == 0: # Avisar solo del primer fallo de cada puerto
+        set_feedback_message(f"Error enviando a '{name}': {error}")
+
+def song_position_bytes(song_pulse):
+    """Song Position Pointer (0xF2) para una posición en pulsos; la unidad de SPP son semicorcheas (6 pulsos)."""
+    position = min(song_pulse // (PPQN // 4), 0x3FFF)
+    return bytes((SONG_POSITION_STATUS, position & 0x7F, position >> 7))
+
+def transport_state_bytes(status, song_pulse):
+    """Mensajes que ponen a un equipo recién conectado en el estado de transporte actual."""
+    if status == "PLAYING": # song_pulse en límite de semicorchea: el siguiente clock es ese pulso
+        return (song_position_bytes(song_pulse), CONTINUE_BYTES)
+    if status == "PAUSED": # Como al pausar: parado y en la posición desde la que continuará
+        return (STOP_BYTES, song_position_bytes(song_pulse - song_pulse % (PPQN // 4)))
+    return (STOP_BYTES,)
+
+def send_bytes(data, deadline_ns, senders, workers):
+    """
+    Envía bytes precodificados a un conjunto de salidas. En fanout "threaded" los entrega a los
+    workers, que los envían en deadline_ns (0 = en cuanto puedan).
+    """
+    if workers:
+        for worker in workers:
+            worker.post(data, deadline_ns)
+        return
+    now = time.perf_counter_ns
+    for port, send, timing in senders:
+        start_ns = now()
+        try:
+            send(data)
+        except Exception as e:
+            _report_send_error(port, e)
+        if deadline_ns: # Solo los pulsos con deadline cuentan para el timing por puerto
+            timing.record(start_ns - deadline_ns, now() - start_ns)
+
+def send_realtime(data, deadline_ns=0):
+    """Envía un mensaje de tiempo real precodificado a todas las salidas del clock principal."""
+    send_bytes(data, deadline_ns, performance_state.output_senders, performance_state.port_workers)
+    if latency_tracer is not None and latency_tracer.waiting:
+        latency_tracer.flush_waiting("out") # En fanout "threaded", la entrega a los workers
+
+def send_clock_tick(tick, deadline_ns, groups):
+    """Pulso de clock del paso 'tick' de la rejilla: solo a los grupos cuyo divisor toca en ese paso."""
+    for divisor, senders, workers in groups:
+        if not tick % divisor:
+            send_bytes(CLOCK_BYTES, deadline_ns, senders, workers)
+
+# --- Cola de comandos ---
+# Todas las mutaciones de transporte y tempo entran por esta cola y solo las aplica el hilo de
+# clock, en el límite de un pulso. deque.append/popleft son atómicos, así que los productores
+# (teclado, callbacks MIDI, hilos del servidor OSC) nunca se bloquean ni se pisan entre sí.
+# Cada comando es (tipo, valor, llegada en perf_counter_ns, LatencyTrace o None); la llegada decide
+# en qué límite de pulso se aplica: el primero posterior a ella.
+command_queue = deque()
+# Despierta al hilo de clock cuando está parado o en pausa: un Play se atiende al instante
+command_wakeup = threading.Event()
+clock_engine_ready = threading.Event() # El motor ya ha calibrado y (con --realtime) ajustado su hilo
+
+def enqueue_command(kind, value=None):
+    arrival_ns = time.perf_counter_ns()
+    trace = None
+    if latency_tracer is not None:
+        trace = latency_tracer.current()
+        if trace is not None: latency_tracer.handoff(trace, kind, arrival_ns)
+    if clock_process is not None:
+        clock_process.send(kind, value)
+        if trace is not None: latency_tracer.finish(trace) # La traza no cruza al proceso de clock
+        return
+    command_queue.append((kind, value, arrival_ns, trace))
+    command_wakeup.set()
+
+def wake_clock_engine():
+    """Saca al hilo de clock de la espera en reposo (p. ej. para que vea SHUTDOWN_FLAG)."""
+    command_wakeup.set()
+
+# --- Coalescencia de tempo ---
+class BpmCoalescer:
+    """
+    De todas las peticiones de tempo (teclado, faders, OSC) solo cuenta la última. El hilo de
+    clock la aplica como mucho una vez por pulso, o cada min_interval_ns si se configura, y el
+    eco OSC del BPM se limita a uno cada echo_interval_ns (el último valor siempre se envía).
+    """
+    def __init__(self):
+        self._counter = itertools.count(1)
+        self.latest = None # (secuencia, bpm) de la última petición: se sustituye con una sola asignación
+        self.held = None # Petición recibida por el hilo de clock y aún no aplicada
+        self.applied_seq = 0
+        self.requests = 0
+        self.applied = 0
+        self.min_interval_ns = 0
+        self.echo_interval_ns = 50_000_000
+        self.last_apply_ns = 0
+        self.last_echo_ns = 0
+        self.echo_value = None # BPM pendiente de eco OSC
+
+    def configure(self, engine_config):
+        self.min_interval_ns = int(float(engine_config.get("bpm_apply_interval_ms", 0)) * 1_000_000)
+        self.echo_interval_ns = int(float(engine_config.get("osc_echo_interval_ms", 50)) * 1_000_000)
+
+    def next_due_ns(self):
+        """Instante en que habrá trabajo retenido (tempo o eco OSC), o None si no hay nada pendiente."""
+        due = []
+        if self.held is not None: due.append(self.last_apply_ns + self.min_interval_ns)
+        if self.echo_value is not None: due.append(self.last_echo_ns + self.echo_interval_ns)
+        return min(due) if due else None
+
+    def request(self, bpm):
+        """Productores: registra la petición y la encola para el hilo de clock."""
+        item = (next(self._counter), bpm)
+        self.latest = item
+        enqueue_command("BPM", item)
+
+    def pending(self):
+        """Último tempo pedido que aún no se ha aplicado, o None."""
+        item = self.latest
+        if item is None or item[0] <= self.applied_seq: return None
+        return item[1]
+
+    # Lo que sigue solo lo llama el hilo de clock
+    def offer(self, item):
+        self.held = item # Sustituye a la petición anterior sin aplicar
+        self.requests += 1
+
+    def discard(self):
+        if self.held is not None:
+            self.applied_seq = self.held[0]
+            self.held = None
+
+    def take(self, now_ns):
+        """Devuelve el tempo a aplicar ahora, o None."""
+        item = self.held
+        if item is None or now_ns - self.last_apply_ns < self.min_interval_ns: return None
+        self.held = None
+        self.applied_seq = item[0]
+        self.last_apply_ns = now_ns
+        self.applied += 1
+        return item[1]
+
+    def echo(self, bpm, now_ns):
+        self.echo_value = bpm
+        self.flush_echo(now_ns)
+
+    def flush_echo(self, now_ns):
+        value = self.echo_value
+        if value is None or now_ns - self.last_echo_ns < self.echo_interval_ns: return
+        self.echo_value = None
+        self.last_echo_ns = now_ns
+        send_osc_message(OSC_ADDRESSES["CURRENT_BPM"], value)
+
+bpm_coalescer = BpmCoalescer()
+
+def target_bpm():
+    """Tempo destino: el último pedido si aún no se ha aplicado, si no el actual."""
+    pending = bpm_coalescer.pending()
+    return pending if pending is not None else performance_state.bpm
+
+# --- Dominios de clock adicionales (clock_settings.domains) ---
+class TimerHeap:
+    """
+    Cola de prioridad de deadlines de los dominios en marcha: el hilo de clock espera solo al
+    primero, así que cualquier número de dominios comparte un único hilo y un único timer.
+    Reprogramar o parar un dominio invalida su entrada anterior (generación), que se descarta al salir.
+    """
+    def __init__(self):
+        self.heap = []
+        self._counter = itertools.count() # Desempate entre deadlines iguales sin comparar dominios
+
+    def schedule(self, domain):
+        domain.generation += 1
+        heapq.heappush(self.heap, (domain.next_deadline(), next(self._counter), domain.generation, domain))
+
+    def cancel(self, domain):
+        domain.generation += 1
+
+    def next_due(self):
+        """Deadline más próximo de un dominio en marcha, o None si no hay ninguno."""
+        heap = self.heap
+        while heap and heap[0][2] != heap[0][3].generation:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def pop_due(self, now_ns):
+        """Saca y devuelve los dominios cuyo deadline ya ha llegado."""
+        heap = self.heap
+        due = []
+        while heap and heap[0][0] <= now_ns:
+            _, _, generation, domain = heapq.heappop(heap)
+            if generation == domain.generation:
+                due.append(domain)
+        return due
+
+class ClockDomain:
+    """
+    Dominio de clock independiente: tempo, transporte y salidas propios, cada salida con su PPQN.
+    No tiene hilo: el ClockEngine lo atiende desde su TimerHeap y es el único que lo modifica.
+    """
+    def __init__(self, config, ports, engine_config):
+        self.name = config["name"]
+        self.link_transport = config.get("link_transport", False)
+        self.rates = config["outputs"]
+        self.ports = ports
+        self.senders, self.workers, self.groups, self.resolution, self.lead_ns = \
+            build_output_fanout(ports, self.rates, engine_config)
+        self.rejoins = [] # OutputRejoin esperando al próximo límite de semicorchea
+        self.base = self.resolution // PPQN # Pasos de rejilla por pulso de 24 PPQN
+        self.bpm = config["bpm"]
+        self.grid = TempoGrid(self.bpm, self.resolution)
+        self.status = "STOPPED"
+        self.tick = 0
+        self.song_pulse = 0
+        self.late_pulses = 0
+        self.generation = 0 # Ver TimerHeap
+
+    def next_deadline(self):
+        return self.grid.next_deadline() - self.lead_ns
+
+    def emit_due(self):
+        """Emite el paso que toca; si va tarde un paso o más, salta los perdidos para no perder la posición."""
+        grid = self.grid
+        start_ns = time.perf_counter_ns()
+        behind = start_ns - grid.next_deadline()
+        period_ns = grid.period_ns()
+        if behind >= period_ns:
+            missed = behind // period_ns
+            for _ in range(missed):
+                self._advance()
+            self.late_pulses += missed
+        if self.rejoins and not self.tick % self.base and not self.song_pulse % (PPQN // 4):
+            for rejoin in self.rejoins: rejoin.apply("PLAYING", self.song_pulse)
+            self.rejoins.clear()
+        deadline_ns = grid.next_deadline()
+        send_clock_tick(self.tick, deadline_ns, self.groups)
+        if session_recorder is not None:
+            session_recorder.pulse(start_ns, deadline_ns, self.resolution, session_recorder.name_index(self.name))
+        self._advance()
+
+    def set_outputs(self, fanout):
+        """Sustituye las salidas del dominio (fanout de prepare_output_fanout); devuelve los workers anteriores."""
+        old_workers = self.workers
+        self.ports, self.senders, self.workers, self.groups, self.resolution, self.lead_ns = fanout
+        return old_workers
+
+    def _advance(self):
+        if not self.tick % self.base:
+            self.song_pulse += 1
+        self.tick += 1
+        self.grid.advance()
+
+    def command(self, kind, value, now_ns):
+        """Aplica un comando de transporte o tempo (mismos tipos que command_queue, sin rampas)."""
+        status = self.status
+        if kind == "TOGGLE":
+            kind = "PAUSE" if status == "PLAYING" else "PLAY"
+        elif kind == "PLAY_STOP":
+            kind = "STOP" if status in ("PLAYING", "PAUSED") else "PLAY"
+        elif kind == "CONTINUE":
+            if status != "PAUSED": return
+            kind = "PLAY"
+
+        if kind == "BPM":
+            self.bpm = max(20.0, min(300.0, float(value)))
+            if status == "PLAYING":
+                self.grid.retempo(self.bpm) # Mantiene la fase, como el clock principal
+            else:
+                self.grid.set_tempo(self.bpm)
+            set_feedback_message(f"Dominio '{self.name}': BPM {self.bpm:.2f}")
+            return
+        if kind == "PLAY" and status != "PLAYING":
+            if status == "STOPPED":
+                self.song_pulse = 0
+                send_bytes(START_BYTES, 0, self.senders, self.workers) # Sin deadline: no cuenta como pulso en el timing
+            else: # PAUSED: SPP y continue, como el clock principal
+                self.song_pulse -= self.song_pulse % (PPQN // 4)
+                send_bytes(song_position_bytes(self.song_pulse), 0, self.senders, self.workers)
+                send_bytes(CONTINUE_BYTES, 0, self.senders, self.workers)
+            self.tick = self.song_pulse * self.base # Los divisores cuentan desde el principio de la canción
+            self.grid.set_tempo(self.bpm)
+            self.grid.start(now_ns + self.grid.nominal_period_ns() * self.base)
+            self.status = "PLAYING"
+        elif kind == "PAUSE" and status == "PLAYING":
+            send_bytes(STOP_BYTES, 0, self.senders, self.workers)
+            self.status = "PAUSED"
+        elif kind == "STOP":
+            send_bytes(STOP_BYTES, 0, self.senders, self.workers)
+            self.status = "STOPPED"
+        else:
+            return
+        set_feedback_message(f"Dominio '{self.name}': {self.status}")
+
+def open_clock_domains(domain_configs, output_names=None):
+    """Abre las salidas de cada dominio (reutilizando las del clock principal) y crea sus ClockDomain."""
+    engine_config = main_config.get("clock_engine", CLOCK_ENGINE_DEFAULTS)
+    output_names = output_names if output_names is not None else midi_port_names("outputs")
+    opened = {port.name: port for port in performance_state.output_ports}
+    domains = []
+    for config in domain_configs:
+        ports = []
+        for alias in config["outputs"]:
+            port_name = find_port_by_substring(output_names, global_device_aliases.get(alias, alias))
+            if not port_name:
+                print(f"Advertencia: Salida '{alias}' del dominio '{config['name']}' no encontrada.")
+                continue
+            port = opened.get(port_name)
+            try:
+                if port is None:
+                    port = opened[port_name] = mido.open_output(port_name)
+                    print(f"Puerto de salida '{port_name}' del dominio '{config['name']}' abierto.")
+                if port not in ports: ports.append(port)
+            except Exception as e:
+                print(f"Error abriendo puerto de salida '{port_name}' del dominio '{config['name']}': {e}")
+        domains.append(ClockDomain(config, ports, engine_config))
+    return domains
+
+def close_clock_domains():
+    """Cierra las salidas de los dominios que no son también salidas del clock principal."""
+    main_ports = {id(port) for port in performance_state.output_ports}
+    to_close = {}
+    for domain in clock_domains:
+        for worker in domain.workers: worker.stop()
+        for port in domain.ports:
+            if id(port) not in main_ports: to_close[id(port)] = port
+    clock_domains.clear()
+    for port in to_close.values():
+        try:
+            if not port.closed: port.close()
+        except Exception: pass
+
+class OutputRejoin:
+    """
+    Puertos reabiertos por DeviceMonitor para las salidas del clock principal (domain None) o de un
+    dominio, con el fanout ya preparado fuera del hilo de clock. El hilo de clock los incorpora con
+    apply(): manda el estado de transporte solo a los puertos nuevos y publica el fanout. En marcha
+    espera a un límite de semicorchea, para que el Song Position Pointer caiga en el pulso siguiente.
+    """
+    def __init__(self, domain, fanout, new_ports):
+        self.domain = domain
+        self.fanout = fanout
+        self.new_ports = new_ports
+        self.retired_workers = () # Workers del fanout anterior: los para quien pidió la reincorporación
+        self.done = threading.Event()
+
+    def apply(self, status, song_pulse):
+        senders, workers = self.fanout[1], self.fanout[2]
+        new = [i for i, (port, _, _) in enumerate(senders) if port in self.new_ports]
+        new_senders = tuple(senders[i] for i in new)
+        new_workers = tuple(workers[i] for i in new) if workers else ()
+        for data in transport_state_bytes(status, song_pulse):
+            send_bytes(data, 0, new_senders, new_workers)
+        if self.domain is not None:
+            self.retired_workers = self.domain.set_outputs(self.fanout)
+        else:
+            self.retired_workers = publish_output_fanout(self.fanout)
+        self.done.set()
+
+# --- MIDI Clock Thread ---
+class ClockEngine:
+    """
+    Motor del hilo de clock y único escritor del estado de transporte y tempo: emite los pulsos
+    de la rejilla y, en cada límite de pulso, aplica los comandos pendientes de command_queue.
+    Los dominios adicionales (clock_domains) se atienden en el mismo hilo desde un TimerHeap.
+    """
+    def __init__(self, engine_config):
+        self.config = engine_config
+        self.timer = get_precision_timer()
+        self.late_policy = engine_config.get("late_policy", "burst")
+        self.max_burst = max(1, int(engine_config.get("max_burst", 4)))
+        bpm_coalescer.configure(engine_config)
+        timing_stats.configure(engine_config)
+        self.stats_interval_ns = int(float(engine_config.get("stats_osc_interval_ms", 1000)) * 1_000_000)
+        self.last_stats_ns = 0
+        self.realtime = bool(engine_config.get("realtime"))
+        self.gc_mode = engine_config.get("rt_gc", "disable") if self.realtime else "none"
+        self.gc_paused = False
+        self.following = external_clock is not None
+        self.resolution = performance_state.clock_resolution
+        self.base = self.resolution // PPQN # Pasos de rejilla por pulso de 24 PPQN
+        if self.following:
+            self.grid = FollowGrid(external_clock, int(float(engine_config.get("follow_offset_ms", 0.0)) * 1_000_000))
+        else:
+            self.grid = TempoGrid(performance_state.bpm, self.resolution)
+        self.domains = list(clock_domains)
+        self.timers = TimerHeap()
+        self.ramping = False
+        self.song_pulse = 0
+        self.tick = 0 # Paso de la rejilla (a 'resolution' pasos por negra) desde el principio de la canción
+        self.ui_beat = -1 # Último tiempo notificado a la UI
+        self.scheduled = None # (acción, pulso de canción en el que se ejecuta) con transporte cuantizado
+        self.rejoins = [] # OutputRejoin del clock principal esperando al próximo límite de semicorchea
+
+    def run(self):
+        if self.realtime:
+            performance_state.realtime_report = enter_realtime(self.config)
+        clock_engine_ready.set()
+        timers = self.timers
+        while not SHUTDOWN_FLAG:
+            playing = performance_state.status == "PLAYING"
+            domain_due = timers.next_due()
+            if playing or domain_due is not None:
+                if self.gc_mode == "disable" and not self.gc_paused:
+                    gc.disable() # Ninguna pausa del recolector entre pulsos mientras suena
+                    self.gc_paused = True
+            elif self.gc_paused: # Parado no hay pulsos que proteger: se recoge lo acumulado
+                gc.enable()
+                gc.collect()
+                self.gc_paused = False
+
+            if playing:
+                if self.following and not self.grid.ready():
+                    # Siguiendo sin enganche, o con la entrada cortada: el próximo pulso espera al de entrada
+                    timeout = 0.05 if domain_due is None else min(0.05, max(0, domain_due - time.perf_counter_ns()) / 1e9)
+                    self.grid.wait_input(timeout)
+                    self._run_domains()
+                    self._process_commands(time.perf_counter_ns())
+                    continue
+                # Con workers y offsets de latencia el pulso se entrega antes para que cada puerto lo compense
+                main_due = self.grid.next_deadline() - performance_state.fanout_lead_ns
+                if domain_due is None or main_due <= domain_due:
+                    boundary_ns = main_due
+                    self.timer.wait_until(main_due)
+                    self._emit_due_pulses()
+                else:
+                    boundary_ns = domain_due
+                    self.timer.wait_until(domain_due)
+                if domain_due is not None:
+                    self._run_domains()
+                now_ns = time.perf_counter_ns()
+                self._process_commands(now_ns, boundary_ns)
+                if self.stats_interval_ns and now_ns - self.last_stats_ns >= self.stats_interval_ns:
+                    self.last_stats_ns = now_ns
+                    # El resumen (todos los histogramas de puerto) lo calcula el hilo de OSC al enviar
+                    send_osc_message(OSC_ADDRESSES["TIMING"], timing_osc_values)
+            else: # STOPPED o PAUSED
+                self._process_commands(time.perf_counter_ns())
+                if performance_state.status != "PLAYING":
+                    domain_due = timers.next_due()
+                    if domain_due is None:
+                        self._idle_wait()
+                    elif self._wait_domains(domain_due):
+                        self._run_domains()
+
+    def _wait_domains(self, due_ns):
+        """
+        Con el transporte principal parado y dominios en marcha: espera al próximo dominio, pero un
+        comando interrumpe la espera gruesa. Devuelve False si la interrumpió un comando.
+        """
+        remaining = due_ns - time.perf_counter_ns() - self.timer.spin_window_ns
+        if remaining > 0 and not command_queue and command_wakeup.wait(remaining / 1e9):
+            command_wakeup.clear()
+            return False
+        self.timer.wait_until(due_ns)
+        return True
+
+    def _run_domains(self):
+        timers = self.timers
+        for domain in timers.pop_due(time.perf_counter_ns()):
+            domain.emit_due()
+            timers.schedule(domain)
+
+    def _domain_command(self, domain, kind, value, now_ns):
+        domain.command(kind, value, now_ns)
+        if domain.status == "PLAYING":
+            self.timers.schedule(domain) # Arranque o tempo nuevo: la entrada anterior queda invalidada
+        else:
+            self.timers.cancel(domain)
+            for rejoin in domain.rejoins: rejoin.apply(domain.status, domain.song_pulse)
+            domain.rejoins.clear()
+
+    def _rejoin(self, rejoin):
+        """Incorpora puertos reconectados: al momento si el transporte no suena, si no en la próxima semicorchea."""
+        domain = rejoin.domain
+        if domain is not None:
+            if domain.status == "PLAYING": domain.rejoins.append(rejoin)
+            else: rejoin.apply(domain.status, domain.song_pulse)
+        elif performance_state.status == "PLAYING":
+            self.rejoins.append(rejoin)
+        else:
+            rejoin.apply(performance_state.status, self.song_pulse)
+
+    def _apply_rejoins(self):
+        for rejoin in self.rejoins:
+            rejoin.apply(performance_state.status, self.song_pulse)
+        self.rejoins.clear()
+
+    def _idle_wait(self):
+        # Sin pulsos que emitir el hilo duerme hasta que llega un comando; solo usa timeout
+        # si queda un tempo o un eco OSC retenido por los límites de frecuencia.
+        due_ns = bpm_coalescer.next_due_ns()
+        timeout = None if due_ns is None else max(0, due_ns - time.perf_counter_ns()) / 1e9
+        if not command_queue and not SHUTDOWN_FLAG:
+            command_wakeup.wait(timeout)
+        command_wakeup.clear() # La cola se vacía justo después, en _process_commands
+
+    def _emit_due_pulses(self):
+        grid = self.grid
+        pulses_due = 1
+        behind = time.perf_counter_ns() - grid.next_deadline()
+        period_ns = grid.period_ns()
+        if behind >= period_ns: # Llegamos tarde al menos un pulso completo
+            missed = behind // period_ns
+            if self.late_policy == "skip":
+                for _ in range(missed): grid.advance()
+                performance_state.late_pulses += missed
+            elif self.late_policy == "stretch":
+                # Siguiendo un clock externo la rejilla la marca la entrada: no se reancla
+                if not self.following:
+                    grid.reanchor(time.perf_counter_ns())
+                    performance_state.late_pulses += missed
+            else: # "burst": los que no quepan en esta ráfaga se recuperan en la siguiente vuelta
+                pulses_due = min(missed + 1, self.max_burst)
+                performance_state.late_pulses += pulses_due - 1
+
+        now = time.perf_counter_ns
+        groups = performance_state.clock_groups
+        base = self.base
+        for i in range(pulses_due):
+            if i and self.following and not grid.ready(): break # No adelantarse a la entrada sin enganche
+            deadline_ns = grid.next_deadline()
+            tick = self.tick
+            on_pulse = not tick % base # Paso que coincide con un pulso de 24 PPQN
+            if on_pulse:
+                scheduled = self.scheduled
+                if scheduled is not None and self.song_pulse >= scheduled[1]:
+                    # La acción cuantizada ocupa el lugar del pulso del límite de tiempo/compás
+                    self.scheduled = performance_state.scheduled_transport = None
+                    self._execute_transport(scheduled[0], deadline_ns)
+                    return
+                if self.rejoins and not self.song_pulse % (PPQN // 4): # SPP y continue justo antes de este pulso
+                    self._apply_rejoins()
+                    groups = performance_state.clock_groups
+                if performance_state.clock_resolution != self.resolution: # Cambiaron las salidas
+                    self._regrid(deadline_ns)
+                    grid, groups, base = self.grid, performance_state.clock_groups, self.base
+                    tick = self.tick
+            sent_ns = now()
+            send_clock_tick(tick, deadline_ns, groups)
+            if latency_tracer is not None and latency_tracer.waiting:
+                latency_tracer.flush_waiting("out")
+            if session_recorder is not None:
+                session_recorder.pulse(sent_ns, deadline_ns, self.resolution)
+            # Con workers el clock entrega el pulso fanout_lead_ns antes: ese es su deadline
+            timing_stats.record_pulse(deadline_ns - performance_state.fanout_lead_ns, sent_ns, now())
+            grid.advance()
+            self.tick = tick + 1
+            if on_pulse: self.song_pulse += 1
+        performance_state.song_pulse = self.song_pulse
+
+        if self.ramping:
+            performance_state.bpm = grid.current_bpm()
+            self.ramping = grid.ramp is not None
+            if not self.ramping: request_ui_refresh() # BPM final de la rampa
+        elif self.following:
+            performance_state.bpm = grid.current_bpm()
+        # La UI se redibuja como mucho una vez por tiempo: posición y, durante una rampa o siguiendo, el BPM
+        beat = self.song_pulse // PPQN
+        if beat != self.ui_beat and (self.ramping or self.following or ui_refresher.beat_indicator):
+            self.ui_beat = beat
+            request_ui_refresh()
+
+    def _regrid(self, deadline_ns):
+        """Pasa la rejilla a la resolución de las salidas actuales, con el pulso en deadline_ns como origen."""
+        self.resolution = performance_state.clock_resolution
+        self.base = self.resolution // PPQN
+        self.tick = self.song_pulse * self.base
+        if not self.following:
+            self.grid = TempoGrid(performance_state.bpm, self.resolution)
+            self.grid.start(deadline_ns)
+            self.ramping = False
+
+    def _process_commands(self, now_ns, boundary_ns=None):
+        # Los cambios de tempo se aplican en el límite del pulso recién enviado:
+        # el intervalo siguiente ya usa el tempo nuevo y la fase no salta. Con boundary_ns (instante
+        # previsto de ese pulso) solo se aplican los comandos llegados antes; los que llegan mientras
+        # se emite esperan al límite siguiente, así el reparto no depende de cuándo despierta el hilo.
+        if boundary_ns is None: boundary_ns = now_ns
+        pending_ramp = None
+        if command_queue and session_recorder is not None:
+            session_recorder.apply(now_ns, sum(1 for command in command_queue if command[2] <= boundary_ns))
+        while command_queue and command_queue[0][2] <= boundary_ns:
+            kind, value, _, trace = command_queue.popleft()
+            if trace is not None:
+                trace.mark("clock")
+                latency_tracer.waiting.append(trace)
+            if kind == "BPM":
+                bpm_coalescer.offer(value)
+                pending_ramp = None # Un cambio directo cancela la rampa pendiente
+            elif kind == "RAMP":
+                bpm_coalescer.discard() # La rampa sustituye a cualquier tempo pendiente
+                pending_ramp = value
+            elif kind == "DOMAIN":
+                index, domain_kind, domain_value = value
+                if 0 <= index < len(self.domains):
+                    self._domain_command(self.domains[index], domain_kind, domain_value, now_ns)
+            elif kind == "REJOIN":
+                self._rejoin(value)
+            else:
+                self._transport(kind)
+        if self.rejoins and performance_state.status != "PLAYING": # Se paró antes del límite de semicorchea
+            self._apply_rejoins()
+
+        if pending_ramp is not None:
+            self._start_ramp(*pending_ramp, now_ns)
+        new_bpm = bpm_coalescer.take(now_ns)
+        if new_bpm is not None: # Solo el último tempo pedido desde el pulso anterior
+            self._apply_bpm(new_bpm, now_ns)
+        bpm_coalescer.flush_echo(now_ns)
+        if latency_tracer is not None and latency_tracer.waiting and performance_state.status != "PLAYING":
+            latency_tracer.flush_waiting("applied") # Sin clock en marcha no hay bytes que esperar
+
+    def _apply_bpm(self, new_bpm, now_ns):
+        if performance_state.status == "PLAYING":
+            self.grid.retempo(new_bpm)
+            self.ramping = False
+        prev_bpm = performance_state.bpm
+        performance_state.bpm = new_bpm
+        set_feedback_message(f"BPM: {prev_bpm:.2f} -> {new_bpm:.2f}")
+        bpm_coalescer.echo(new_bpm, now_ns)
+        if session_recorder is not None: session_recorder.tempo(new_bpm, now_ns)
+
+    def _start_ramp(self, target, bars, ramp, now_ns):
+        if performance_state.status != "PLAYING" or ramp is None:
+            self._apply_bpm(target, now_ns) # Sin clock en marcha no hay rejilla sobre la que rampear
+            return
+        self.grid.start_ramp(ramp)
+        self.ramping = True
+        set_feedback_message(f"Rampa BPM: {performance_state.bpm:.2f} -> {target:.2f} en {bars:g} compases")
+        bpm_coalescer.echo(target, now_ns)
+        if session_recorder is not None: session_recorder.ramp(target, bars)
+
+    def _transport(self, kind):
+        status = performance_state.status
+        if kind == "TOGGLE":
+            kind = "PAUSE" if status == "PLAYING" and not self.scheduled else "PLAY"
+        elif kind == "PLAY_STOP":
+            kind = "STOP" if status in ("PLAYING", "PAUSED") else "PLAY"
+        elif kind == "CONTINUE":
+            if status != "PAUSED": return
+            kind = "PLAY"
+        elif kind == "ENSURE_PLAY": # Como PLAY, pero sin anular un stop/pause cuantizado si ya suena
+            if status == "PLAYING": return
+            kind = "PLAY"
+        elif kind == "ENSURE_STOP": # Como STOP, pero sin repetir el stop si ya está parado
+            if status == "STOPPED": return
+            kind = "STOP"
+
+        if kind == "PLAY" and self.scheduled is not None:
+            self.scheduled = performance_state.scheduled_transport = None # Play anula el stop/pause cuantizado
+            set_feedback_message("PLAYING")
+            return
+        if kind in ("STOP", "PAUSE") and status == "PLAYING" and performance_state.quantize != "none":
+            if self.scheduled is None or self.scheduled[0] != kind: # Repetir el comando lo ejecuta ya
+                unit = PPQN * (performance_state.beats_per_bar if performance_state.quantize == "bar" else 1)
+                target = -(-self.song_pulse // unit) * unit # Próximo límite de tiempo/compás
+                self.scheduled = (kind, target)
+                performance_state.scheduled_transport = kind
+                set_feedback_message(f"{kind} en el próximo {'compás' if performance_state.quantize == 'bar' else 'tiempo'}")
+                return
+            self.scheduled = performance_state.scheduled_transport = None
+        self._execute_transport(kind)
+
+    def _execute_transport(self, kind, deadline_ns=0):
+        status = performance_state.status
+        if kind == "PLAY": self._play()
+        elif kind == "PAUSE": self._pause(deadline_ns)
+        elif kind == "STOP": self._stop(deadline_ns)
+        if performance_state.status == status: return # Sin cambio (p. ej. play sonando): los dominios no se tocan
+        for domain in self.domains: # Dominios con link_transport siguen al transporte principal
+            if domain.link_transport:
+                self._domain_command(domain, kind, None, deadline_ns or time.perf_counter_ns())
+
+    def _play(self):
+        status = performance_state.status
+        if status == "PLAYING": return
+        now_ns = time.perf_counter_ns()
+        if status == "STOPPED":
+            self.song_pulse = 0
+            send_realtime(START_BYTES) # Sin deadline: no cuenta como pulso en el timing por puerto
+            set_feedback_message("PLAYING")
+        else: # PAUSED: SPP con la posición (en semicorcheas) y continue
+            self.song_pulse -= self.song_pulse % (PPQN // 4)
+            send_realtime(song_position_bytes(self.song_pulse))
+            send_realtime(CONTINUE_BYTES)
+            set_feedback_message("PLAYING (Continuado)")
+        performance_state.song_pulse = self.song_pulse
+        if performance_state.clock_resolution != self.resolution:
+            self._regrid(now_ns)
+        self.tick = self.song_pulse * self.base # Los divisores cuentan desde el principio de la canción
+        # El start/continue sale exactamente un intervalo de pulso (de 24 PPQN) antes del primer clock
+        self.grid.set_tempo(performance_state.bpm)
+        self.grid.start(now_ns + self.grid.nominal_period_ns() * self.base)
+        self.ramping = False
+        performance_state.status = "PLAYING"
+        send_osc_message(OSC_ADDRESSES["STATUS"], "PLAYING")
+        if session_recorder is not None: session_recorder.transport("PLAYING", self.song_pulse, now_ns)
+
+    def _pause(self, deadline_ns=0):
+        if performance_state.status == "PLAYING":
+            send_realtime(STOP_BYTES, deadline_ns)
+            performance_state.status = "PAUSED"
+            set_feedback_message("PAUSED")
+            send_osc_message(OSC_ADDRESSES["STATUS"], "PAUSED")
+            if session_recorder is not None: session_recorder.transport("PAUSED", self.song_pulse)
+
+    def _stop(self, deadline_ns=0):
+        send_realtime(STOP_BYTES, deadline_ns)
+        self.scheduled = performance_state.scheduled_transport = None
+        performance_state.status = "STOPPED"
+        set_feedback_message("STOPPED")
+        send_osc_message(OSC_ADDRESSES["STATUS"], "STOPPED")
+        if session_recorder is not None: session_recorder.transport("STOPPED", self.song_pulse)
+
+def midi_clock_sender():
+    ClockEngine(main_config.get("clock_engine", CLOCK_ENGINE_DEFAULTS)).run()
+
+# --- Motor de clock en un proceso aparte (--clock-process) ---
+# El proceso de clock es dueño de los puertos de salida. El front-end (UI, servidor OSC, entradas
+# MIDI) le escribe los comandos en un anillo de memoria compartida y lee su estado de un bloque
+# compartido con contador de secuencia, así que su carga no compite por el GIL con el clock.
+TRANSPORT_STATES = ("STOPPED", "PLAYING", "PAUSED")
+COMMAND_KINDS = ("PLAY", "STOP", "PAUSE", "TOGGLE", "PLAY_STOP", "CONTINUE", "BPM", "RAMP", "DOMAIN",
+                 "ENSURE_PLAY", "ENSURE_STOP")
+# secuencia, estado, transporte programado, bpm, secuencia de bpm aplicada, pulso de canción,
+# pulsos perdidos, timing (pulsos, p50, p99, máx, tarde, envío p99, peor puerto p99, descartados,
+# errores y cola máxima de los workers), número de mensaje, mensaje de feedback y nombre del peor puerto
+SHARED_STATE = struct.Struct("<Qbbd" + "q" * 13 + "Q200s64s")
+COMMAND_RECORD = struct.Struct("<Bqdd") # tipo, entero (secuencia de BPM o dominio), dos reales
+RING_HEADER = struct.Struct("<QQ") # cabeza (escribe el front-end), cola (escribe el proceso de clock)
+RING_CAPACITY = 256
+
+class SharedStateBlock:
+    """Estado del clock publicado por el proceso de clock; las lecturas reintentan si pillan una escritura."""
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.quit_offset = SHARED_STATE.size # Un byte más: el front-end pide aquí el cierre
+
+    @staticmethod
+    def size():
+        return SHARED_STATE.size + 1
+
+    def write(self, *fields):
+        seq = struct.unpack_from("<Q", self.buffer, 0)[0]
+        struct.pack_into("<Q", self.buffer, 0, seq + 1) # Impar: escritura en curso
+        SHARED_STATE.pack_into(self.buffer, 0, seq + 1, *fields)
+        struct.pack_into("<Q", self.buffer, 0, seq + 2)
+
+    def read(self):
+        while True:
+            fields = SHARED_STATE.unpack_from(self.buffer, 0)
+            if not fields[0] & 1 and struct.unpack_from("<Q", self.buffer, 0)[0] == fields[0]:
+                return fields[1:]
+
+    def request_quit(self):
+        self.buffer[self.quit_offset] = 1
+
+    def quit_requested(self):
+        return self.buffer[self.quit_offset] != 0
+
+class SharedCommandRing:
+    """
+    Anillo de comandos de tamaño fijo en memoria compartida, con un solo productor (el front-end,
+    serializado con un lock) y un solo consumidor (el proceso de clock). Lleno, el comando se descarta.
+    """
+    def __init__(self, buffer, capacity=RING_CAPACITY):
+        self.buffer = buffer
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.dropped = 0
+
+    @staticmethod
+    def size(capacity=RING_CAPACITY):
+        return RING_HEADER.size + capacity * COMMAND_RECORD.size
+
+    def push(self, kind, value):
+        code = COMMAND_KINDS.index(kind)
+        seq, a, b = 0, 0.0, 0.0
+        if kind == "BPM": seq, a = value
+        elif kind == "RAMP": a, b = value[0], value[1]
+        elif kind == "DOMAIN": seq, a, b = value[0], COMMAND_KINDS.index(value[1]), value[2] or 0.0
+        with self.lock:
+            head, tail = RING_HEADER.unpack_from(self.buffer, 0)
+            if head - tail >= self.capacity:
+                self.dropped += 1
+                return False
+            offset = RING_HEADER.size + (head % self.capacity) * COMMAND_RECORD.size
+            COMMAND_RECORD.pack_into(self.buffer, offset, code, seq, a, b)
+            struct.pack_into("<Q", self.buffer, 0, head + 1) # Se publica después de escribir el registro
+        return True
+
+    def pop_all(self):
+        head, tail = RING_HEADER.unpack_from(self.buffer, 0)
+        while tail < head:
+            offset = RING_HEADER.size + (tail % self.capacity) * COMMAND_RECORD.size
+            code, seq, a, b = COMMAND_RECORD.unpack_from(self.buffer, offset)
+            tail += 1
+            struct.pack_into("<Q", self.buffer, 8, tail)
+            kind = COMMAND_KINDS[code]
+            if kind == "BPM": value = (seq, a)
+            elif kind == "RAMP": value = (a, b)
+            elif kind == "DOMAIN": value = (seq, COMMAND_KINDS[int(a)], b)
+            else: value = None
+            yield kind, value
+
+def open_clock_outputs(port_names, virtual_name=None):
+    """Abre el puerto virtual (si se pide) y las salidas físicas del clock."""
+    opened = []
+    if virtual_name:
+        try:
+            port = mido.open_output(virtual_name, virtual=True)
+            opened.append(port)
+            performance_state.virtual_port_name = port.name
+            print(f"Puerto virtual de salida '{port.name}' abierto.")
+        except Exception as e:
+            print(f"Error abriendo puerto virtual '{virtual_name}': {e}")
+
+    for name in port_names:
+        if performance_state.virtual_port_name and name == performance_state.virtual_port_name:
+            continue
+        try:
+            port = mido.open_output(name)
+            opened.append(port)
+            print(f"Puerto de salida físico '{name}' abierto.")
+        except Exception as e:
+            print(f"Error abriendo puerto físico '{name}': {e}")
+    return opened
+
+def close_clock_outputs():
+    # Crear una copia de la lista para iterar, ya que podríamos estar modificándola indirectamente
+    ports_to_close = list(performance_state.output_ports)
+    set_output_ports([]) # Vaciar la lista original y las funciones de envío
+    for port in ports_to_close:
+        try:
+            if hasattr(port, 'panic'): port.panic() 
+            if not port.closed: port.close()
+            print(f"Puerto de salida '{port.name}' cerrado.")
+        except Exception: pass
+
+def print_timing_report(dump_path=None):
+    """Resumen de timing al salir (global y por puerto) y volcado opcional del registro."""
+    if timing_stats.pulses:
+        print(f"Timing ({timing_stats.pulses} pulsos): {timing_summary_text()}")
+        for timing in timing_stats.ports.values():
+            if timing.delay.count:
+                print(f"  '{timing.name}': retraso p99 {format_duration_ns(timing.delay.percentile(0.99))}, "
+                      f"envío p99 {format_duration_ns(timing.duration.percentile(0.99))} (máx {format_duration_ns(timing.duration.max_ns)})")
+            if timing.sent or timing.dropped or timing.errors: # Solo con fanout "threaded"
+                print(f"    cola: {timing.sent} enviados, {timing.dropped} pulsos descartados, "
+                      f"{timing.errors} errores, máx. {timing.max_backlog} pendientes")
+    if dump_path:
+        try:
+            count = timing_stats.dump(dump_path)
+            print(f"Registro de timing ({count} pulsos) volcado en '{dump_path}'.")
+        except OSError as e:
+            print(f"Error volcando el registro de timing en '{dump_path}': {e}")
+
+def _publish_clock_state(state, feedback_count, timing):
+    scheduled = performance_state.scheduled_transport
+    state.write(TRANSPORT_STATES.index(performance_state.status),
+                COMMAND_KINDS.index(scheduled) + 1 if scheduled else 0,
+                performance_state.bpm, bpm_coalescer.applied_seq, performance_state.song_pulse,
+                performance_state.late_pulses, timing["pulses"], timing["p50_ns"], timing["p99_ns"],
+                timing["max_ns"], timing["late"], timing["send_p99_ns"], timing["worst_port_p99_ns"],
+                timing["dropped"], timing["port_errors"], timing["max_backlog"], feedback_count, performance_state.last_feedback_message.encode("utf-8")[:200],
+                timing["worst_port"].encode("utf-8")[:64])
+
+def clock_process_main(settings, state_buffer, ring_buffer, wakeup, conn):
+    """
+    Entrada del proceso de clock: abre las salidas, arranca ClockEngine en su hilo y hace de puente:
+    pasa los comandos del anillo a command_queue y publica el estado en el bloque compartido.
+    """
+    global main_config, global_device_aliases, osc_client, SHUTDOWN_FLAG
+    import multiprocessing
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # El cierre lo pide el front-end
+    main_config = settings["main_config"]
+    global_device_aliases = settings["device_aliases"]
+    performance_state.bpm = settings["bpm"]
+    performance_state.quantize = settings["quantize"]
+    performance_state.beats_per_bar = settings["beats_per_bar"]
+    performance_state.output_rates = settings["output_rates"]
+    osc_config = main_config.get("osc_configuration", {})
+    if osc_config.get("enabled"): # Los ecos de estado y BPM salen directamente del proceso de clock
+        load_osc_modules()
+        osc_client = OscSender.from_config(osc_config)
+
+    state = SharedStateBlock(state_buffer)
+    ring = SharedCommandRing(ring_buffer)
+    set_output_ports(open_clock_outputs(settings["port_names"], settings["virtual_name"]))
+    performance_state.domain_configs = settings["domains"]
+    clock_domains.extend(open_clock_domains(performance_state.domain_configs))
+    engine_thread = threading.Thread(target=midi_clock_sender, daemon=True, name="midimaster-clock")
+    engine_thread.start()
+    clock_engine_ready.wait(5.0) # Calibrado (y en tiempo real, si se pidió) antes de aceptar comandos
+    device_monitor = start_device_monitor(clock=True, rules=False)
+    conn.send({"outputs": [port.name for port in performance_state.output_ports],
+               "virtual": performance_state.virtual_port_name,
+               "realtime": performance_state.realtime_report})
+    conn.close()
 
-# --- MIDI Clock Thread (con pequeño ajuste para timing) ---
-def midi_clock_sender():
-    global SHUTDOWN_FLAG, performance_state
-    
-    # Variables para un timing más preciso
-    last_pulse_time = 0
-    pulse_interval = 0 # Se calculará en el bucle
+    # Si el front-end muere sin pedir el cierre, el proceso de clock termina también
+    parent_process = getattr(multiprocessing, "parent_process", None) # Python 3.8+
+    parent = parent_process() if parent_process is not None else None
+    parent_pid = os.getppid()
+    parent_alive = parent.is_alive if parent is not None else (lambda: os.getppid() == parent_pid)
+    feedback_count, feedback_time = 0, 0
+    timing, next_timing_ns = timing_stats.summary(), 0
+    while not state.quit_requested() and parent_alive():
+        # En reposo solo despierta con comandos; en marcha, o con comandos sin aplicar, publica cada 10 ms
+        wakeup.wait(0.01 if command_queue or performance_state.status == "PLAYING" else 1.0)
+        wakeup.clear()
+        received = 0
+        for kind, value in ring.pop_all():
+            received += 1
+            if kind == "RAMP":
+                target, bars = value
+                ramp = None
+                if performance_state.status == "PLAYING" and bars > 0: # Fuera del hilo de clock, como en el front-end
+                    ramp = TempoRamp(performance_state.bpm, target, bars, performance_state.beats_per_bar,
+                                     performance_state.clock_resolution)
+                value = (target, bars, ramp)
+            enqueue_command(kind, value)
+        if received: # Dar al hilo de clock la ocasión de aplicarlos antes de publicar (en reposo, al instante)
+            limit = time.perf_counter() + 0.002
+            while command_queue and time.perf_counter() < limit:
+                time.sleep(0.0002)
+        now_ns = time.perf_counter_ns()
+        if now_ns >= next_timing_ns:
+            timing, next_timing_ns = timing_stats.summary(), now_ns + 250_000_000
+        if performance_state.feedback_message_time != feedback_time:
+            feedback_time = performance_state.feedback_message_time
+            feedback_count += 1
+        _publish_clock_state(state, feedback_count, timing)
+
+    SHUTDOWN_FLAG = True
+    if device_monitor is not None: device_monitor.stop()
+    wake_clock_engine()
+    engine_thread.join(timeout=0.5)
+    if osc_client is not None: osc_client.close()
+    close_clock_domains()
+    close_clock_outputs()
+    if settings.get("timing_report", True):
+        print_timing_report(settings["timing_dump"])
 
-    while not SHUTDOWN_FLAG:
-        current_time = time.perf_counter()
+class ClockProcess:
+    """Lado del front-end del proceso de clock: envía comandos por el anillo y refleja su estado."""
+    def __init__(self, settings):
+        import multiprocessing
+        ctx = multiprocessing.get_context("spawn") # Proceso limpio: sin hilos ni estado de UI heredados
+        self.state = SharedStateBlock(ctx.RawArray('B', SharedStateBlock.size()))
+        self.ring = SharedCommandRing(ctx.RawArray('B', SharedCommandRing.size()))
+        self.wakeup = ctx.Event()
+        receiver, sender = ctx.Pipe(duplex=False)
+        self.process = ctx.Process(target=clock_process_main, name="midimaster-clock",
+                                   args=(settings, self.state.buffer, self.ring.buffer, self.wakeup, sender))
+        self.receiver = receiver
+        self.output_names = []
+        self.timing = timing_stats.summary()
+        self.feedback_count = 0
+        self.shown = None # Lo que la UI muestra del último estado reflejado
+        self.stopped = False
+        self.sent = threading.Event()
+        self.mirror_thread = None
 
-        if performance_state.status == "PLAYING":
-            # Si se ha señalado un cambio de BPM, reiniciar la temporización
-            if bpm_update_signal.is_set():
-                last_pulse_time = 0
-                bpm_update_signal.clear()
-
-            pulse_interval = 60.0 / (performance_state.bpm * PPQN)
-            if last_pulse_time == 0: # Primer pulso después de Play o cambio de BPM
-                last_pulse_time = current_time
-            
-            if current_time >= last_pulse_time:
-                clock_message = mido.Message('clock')
-                for port in performance_state.output_ports:
-                    try:
-                        port.send(clock_message)
-                    except Exception: pass
-                
-                last_pulse_time += pulse_interval # Programar el siguiente pulso
+    @classmethod
+    def launch(cls, settings, timeout=10.0):
+        """Arranca el proceso y espera a que abra sus salidas; devuelve None si no lo consigue."""
+        clock = cls(settings)
+        try:
+            clock.process.start()
+            if not clock.receiver.poll(timeout): raise TimeoutError("sin respuesta del proceso de clock")
+            ready = clock.receiver.recv()
+        except Exception as e:
+            print(f"Error iniciando el proceso de clock: {e}")
+            if clock.process.is_alive(): clock.process.terminate()
+            return None
+        clock.output_names = ready["outputs"]
+        performance_state.virtual_port_name = ready["virtual"]
+        performance_state.realtime_report = ready["realtime"]
+        clock.mirror_thread = threading.Thread(target=clock._mirror, daemon=True, name="midimaster-clock-mirror")
+        clock.mirror_thread.start()
+        return clock
 
-            # Dormir hasta un poco antes del siguiente pulso teórico
-            # Esto es una heurística, no un reloj de alta precisión en tiempo real.
-            next_event_time = last_pulse_time 
-            sleep_time = next_event_time - time.perf_counter() - 0.0005 # despertar un poco antes
-            if sleep_time > 0:
-                time.sleep(sleep_time)
-            # Si estamos retrasados, el bucle se ejecutará inmediatamente.
+    def send(self, kind, value=None):
+        if not self.ring.push(kind, value):
+            set_feedback_message(f"Cola del proceso de clock llena: '{kind}' descartado")
+        self.wakeup.set()
+        self.sent.set()
 
-        else: # STOPPED o PAUSED
-            if performance_state.status == "STOPPED":
-                last_pulse_time = 0 # Resetear para la próxima vez que se dé a play
-            time.sleep(0.01) # Menor consumo de CPU cuando no está activo
+    def _apply(self, fields):
+        (status, scheduled, bpm, applied_seq, song_pulse, late_pulses, pulses, p50, p99, max_ns, late,
+         send_p99, worst_p99, dropped, port_errors, max_backlog, feedback_count, feedback, worst_port) = fields
+        performance_state.status = TRANSPORT_STATES[status]
+        performance_state.scheduled_transport = COMMAND_KINDS[scheduled - 1] if scheduled else None
+        performance_state.bpm = bpm
+        performance_state.song_pulse = song_pulse
+        performance_state.late_pulses = late_pulses
+        bpm_coalescer.applied_seq = max(bpm_coalescer.applied_seq, applied_seq)
+        self.timing = {"pulses": pulses, "p50_ns": p50, "p99_ns": p99, "max_ns": max_ns, "late": late,
+                       "missed": late_pulses, "send_p99_ns": send_p99,
+                       "dropped": dropped, "port_errors": port_errors, "max_backlog": max_backlog,
+                       "worst_port": worst_port.rstrip(b"\0").decode("utf-8", "replace"), "worst_port_p99_ns": worst_p99}
+        if feedback_count != self.feedback_count:
+            self.feedback_count = feedback_count
+            set_feedback_message(feedback.rstrip(b"\0").decode("utf-8", "replace"))
+        shown = (status, scheduled, round(bpm, 2), song_pulse // PPQN if ui_refresher.beat_indicator else 0)
+        if shown != self.shown:
+            self.shown = shown
+            request_ui_refresh()
 
+    def _mirror(self):
+        last_command = -10.0
+        while not self.stopped:
+            if struct.unpack_from("<Q", self.state.buffer, 0)[0]: # Nada que leer antes de la primera publicación
+                self._apply(self.state.read())
+            # Con el clock parado basta mirar de vez en cuando; en marcha cada 20 ms y justo tras un comando, cada 2 ms
+            since_command = time.monotonic() - last_command
+            interval = 0.002 if since_command < 0.05 else 0.02 if performance_state.status == "PLAYING" or since_command < 1.0 else 1.0
+            if self.sent.wait(interval):
+                self.sent.clear()
+                last_command = time.monotonic()
 
-# --- Funciones de Control (set_bpm, send_midi_command, play/pause/stop, set_feedback_message) ---
+    def stop(self, timeout=2.0):
+        self.stopped = True
+        self.state.request_quit()
+        self.wakeup.set()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
 
+
+# --- Funciones de Control ---
+# Se pueden llamar desde cualquier hilo: solo encolan el comando para el hilo de clock.
 def set_bpm(new_bpm):
     if performance_state.bpm_locked:
         set_feedback_message(f"BPM bloqueado en {performance_state.bpm:.2f}")
         return
+    if external_clock is not None:
+        set_feedback_message("El BPM lo marca el clock externo (--follow)")
+        return
     
-    prev_bpm = performance_state.bpm
     new_bpm_float = max(20.0, min(300.0, float(new_bpm)))
     
-    if prev_bpm != new_bpm_float:
-        performance_state.bpm = new_bpm_float
-        set_feedback_message(f"BPM: {prev_bpm:.2f} -> {performance_state.bpm:.2f}")
-        bpm_update_signal.set()
-        send_osc_message(OSC_ADDRESSES["CURRENT_BPM"], new_bpm_float)
+    if target_bpm() != new_bpm_float:
+        bpm_coalescer.request(new_bpm_float)
+
+def start_bpm_ramp(target_bpm, bars):
+    """
+    Programa una rampa de tempo desde el BPM actual hasta target_bpm a lo largo de 'bars' compases.
+    ValueError si bars no es una longitud válida (ver ramp_bars_value).
+    """
+    bars = ramp_bars_value(bars)
+    if performance_state.bpm_locked:
+        set_feedback_message(f"BPM bloqueado en {performance_state.bpm:.2f}")
+        return
+    if external_clock is not None:
+        set_feedback_message("El BPM lo marca el clock externo (--follow)")
+        return
+    target = max(20.0, min(300.0, float(target_bpm)))
+    ramp = None
+    if performance_state.status == "PLAYING" and bars > 0:
+        # La tabla de pulsos se precalcula aquí, fuera del hilo de clock
+        ramp = TempoRamp(performance_state.bpm, target, bars, performance_state.beats_per_bar, performance_state.clock_resolution)
+    enqueue_command("RAMP", (target, bars, ramp))
 
 
 def send_midi_command(command_type):
-    msg = mido.Message(command_type)
-    for port in performance_state.output_ports:
-        try:
-            port.send(msg)
-        except Exception: pass
+    send_realtime(REALTIME_BYTES[command_type])
 
 def play_clock(*args):
-    if performance_state.status == "STOPPED":
-        send_midi_command('start')
-        set_feedback_message("PLAYING")
-    elif performance_state.status == "PAUSED":
-        send_midi_command('continue')
-        set_feedback_message("PLAYING (Continuado)")
-    performance_state.status = "PLAYING"
-    bpm_update_signal.set()
-    send_osc_message(OSC_ADDRESSES["STATUS"], "PLAYING")
+    enqueue_command("PLAY")
 
 def pause_clock(*args):
-    if performance_state.status == "PLAYING":
-        send_midi_command('stop') 
-        performance_state.status = "PAUSED"
-        set_feedback_message("PAUSED")
-        send_osc_message(OSC_ADDRESSES["STATUS"], "PAUSED")
+    enqueue_command("PAUSE")
 
 def stop_clock(*args):
-    send_midi_command('stop')
-    performance_state.status = "STOPPED"
-    set_feedback_message("STOPPED")
-    send_osc_message(OSC_ADDRESSES["STATUS"], "STOPPED")
+    enqueue_command("STOP")
+
+def toggle_play_pause():
+    enqueue_command("TOGGLE")
+
+def toggle_play_stop():
+    enqueue_command("PLAY_STOP")
+
+def continue_clock():
+    """Reanuda solo si está en pausa."""
+    enqueue_command("CONTINUE")
+
+def ensure_playing():
+    """Play salvo que ya suene; lo decide el hilo de clock con su propio estado."""
+    enqueue_command("ENSURE_PLAY")
+
+def ensure_stopped():
+    """Stop salvo que ya esté parado; lo decide el hilo de clock con su propio estado."""
+    enqueue_command("ENSURE_STOP")
+
+DOMAIN_COMMAND_KINDS = ("PLAY", "STOP", "PAUSE", "TOGGLE", "PLAY_STOP", "CONTINUE", "BPM")
+
+def domain_command(name, kind, value=None):
+    """Encola un comando para el dominio de clock 'name'; devuelve False si no existe."""
+    for index, config in enumerate(performance_state.domain_configs):
+        if config["name"] == name:
+            enqueue_command("DOMAIN", (index, kind, value))
+            return True
+    set_feedback_message(f"Dominio de clock '{name}' no definido")
+    return False
 
 def set_feedback_message(message):
     performance_state.last_feedback_message = message
     performance_state.feedback_message_time = time.time()
+    request_ui_refresh()
 
 
 # --- OSC Functions ---
-def send_osc_message(address, value):
-    """Envía un mensaje OSC si el cliente está configurado."""
-    if osc_client:
+class OscSender:
+    """
+    Envío OSC en segundo plano. send_message() solo guarda el último valor de cada dirección y
+    despierta al hilo emisor, así que no añade latencia a quien lo llama (callbacks MIDI, teclado,
+    hilo de clock). Todas las direcciones salientes son estado (transporte, BPM, timing): un valor
+    aún no enviado se sustituye por el nuevo. El hilo espera bundle_window_s para reunir cambios
+    y manda lo pendiente en un solo paquete (un bundle si hay varios mensajes) a cada destino.
+    Un valor puede ser una función sin argumentos: la llama el hilo emisor al enviar, así que un
+    valor caro de calcular (p. ej. las estadísticas de timing) no cuesta nada a quien lo pide.
+    """
+    def __init__(self, targets, bundle_window_s=0.001):
+        self.targets = list(targets) # [(ip, puerto)]
+        self.bundle_window_s = bundle_window_s
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False) # Un destino que no responde no frena a los demás
+        self.lock = threading.Lock()
+        self.pending = {} # dirección -> último valor sin enviar
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.posted = 0
+        self.superseded = 0 # Valores sustituidos por otro más reciente antes de salir
+        self.packets = 0
+        self.errors = {} # destino -> envíos fallidos
+        self.thread = threading.Thread(target=self._run, daemon=True, name="midimaster-osc-out")
+        self.thread.start()
+
+    @classmethod
+    def from_config(cls, osc_config):
+        """Destinos de send_targets ([{"ip": ..., "port": ...}]) o, si no hay, send_ip/send_port."""
+        load_osc_modules()
+        targets = [(t.get("ip", "127.0.0.1"), int(t.get("port", 9000)))
+                   for t in osc_config.get("send_targets") or [] if isinstance(t, dict)]
+        if not targets:
+            targets = [(osc_config.get("send_ip", "127.0.0.1"), int(osc_config.get("send_port", 9000)))]
+        return cls(targets, max(0.0, float(osc_config.get("bundle_window_ms", 1.0))) / 1000)
+
+    def send_message(self, address, value):
+        with self.lock:
+            if address in self.pending: self.superseded += 1
+            self.pending[address] = value
+            self.posted += 1
+        self.wakeup.set()
+
+    def _build_packet(self, messages):
+        built = []
+        for address, value in messages.items():
+            builder = osc_message_builder.OscMessageBuilder(address=address)
+            for arg in value if isinstance(value, (list, tuple)) else (value,):
+                builder.add_arg(arg)
+            built.append(builder.build())
+        if len(built) == 1:
+            return built[0].dgram
+        bundle = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
+        for message in built:
+            bundle.add_content(message)
+        return bundle.build().dgram
+
+    def _run(self):
+        while not self.stopped:
+            self.wakeup.wait()
+            if self.bundle_window_s and not self.stopped:
+                time.sleep(self.bundle_window_s)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            messages, self.pending = self.pending, {}
+        if not messages: return
         try:
-            osc_client.send_message(address, value)
+            messages = {address: value() if callable(value) else value for address, value in messages.items()}
+            packet = self._build_packet(messages)
         except Exception as e:
-            # Evitar que un error de OSC detenga la aplicación
-            # print(f"Error enviando OSC: {e}") # Descomentar para depuración
-            pass
+            set_feedback_message(f"Error construyendo OSC: {e}")
+            return
+        for target in self.targets:
+            try:
+                self.sock.sendto(packet, target)
+                self.packets += 1
+            except OSError as e:
+                count = self.errors[target] = self.errors.get(target, 0) + 1
+                if count == 1: # Solo el primer fallo de cada destino, para no inundar la línea de mensajes
+                    set_feedback_message(f"Error enviando OSC a {target[0]}:{target[1]}: {e}")
+
+    def close(self):
+        self.stopped = True
+        self.wakeup.set()
+        self.thread.join(timeout=0.2)
+        self.flush() # Lo último pendiente (p. ej. el STOPPED del cierre)
+        self.sock.close()
+
+def send_osc_message(address, value):
+    """
+    Envía un mensaje OSC si el cliente está configurado (con OscSender, sin esperar al envío).
+    value puede ser una función que el hilo emisor llama al enviar.
+    """
+    if osc_client:
+        osc_client.send_message(address, value)
+
+def _handle_osc_timing_request(address, *args):
+    """Responde a una petición en /midimaster/stats/timing con las estadísticas actuales."""
+    send_osc_message(OSC_ADDRESSES["TIMING"], timing_osc_values())
 
 def _handle_osc_bpm_set(address, *args):
     """Manejador para recibir BPM vía OSC. Espera un float o int."""
     if args and isinstance(args[0], (int, float)):
         set_bpm(float(args[0]))
 
+def _handle_osc_bpm_ramp(address, *args):
+    """Manejador de rampas vía OSC. Espera BPM destino y número de compases."""
+    if len(args) >= 2 and all(isinstance(a, (int, float)) for a in args[:2]):
+        try:
+            start_bpm_ramp(float(args[0]), float(args[1]))
+        except ValueError as e:
+            set_feedback_message(f"Rampa OSC ignorada: {e}")
+
+def build_osc_dispatcher():
+    """Dispatcher de pythonosc con las direcciones de entrada de OSC_ADDRESSES."""
+    load_osc_modules()
+    disp = dispatcher.Dispatcher()
+    osc_handlers = {"PLAY": play_clock, "STOP": stop_clock, "PAUSE": pause_clock,
+                    "SET_BPM": _handle_osc_bpm_set, "RAMP_BPM": _handle_osc_bpm_ramp}
+    for key, handler in osc_handlers.items():
+        if latency_tracer is not None:
+            handler = traced_handler(f"osc:{OSC_ADDRESSES[key]}", handler)
+        if session_recorder is not None:
+            handler = recorded_osc_handler(handler)
+        disp.map(OSC_ADDRESSES[key], handler)
+    disp.map(OSC_ADDRESSES["TIMING"], _handle_osc_timing_request)
+    return disp
+
+def recorded_osc_handler(handler):
+    """handler de pythonosc que antes deja el mensaje en la grabación de la sesión (--record)."""
+    def recorded(address, *args):
+        session_recorder.osc(address, args)
+        return handler(address, *args)
+    return recorded
+
 def osc_server_handler(server):
     """Función objetivo para el hilo del servidor OSC."""
     try:
@@ -287,33 +2824,269 @@ def osc_server_handler(server):
              print(f"\nError en el servidor OSC: {e}")
 
 
+# --- Socket de control local (Unix) ---
+# Protocolo de líneas: cada comando es una línea de texto y cada respuesta otra, que empieza por
+# "ok" o "err". Comandos: play, stop, pause, continue, bpm <valor>, ramp <bpm> <compases>,
+# domain <nombre> <acción> [bpm], domains, reload, status, stats y quit. status y stats responden con campos clave=valor; en status el último
+# campo, feedback=, ocupa el resto de la línea.
+def _control_quit():
+    global SHUTDOWN_FLAG
+    SHUTDOWN_FLAG = True
+    shutdown_requested.set()
+    if app_ui_instance:
+        app_ui_instance.exit(result="shutdown")
+
+def _control_bpm(value):
+    if performance_state.bpm_locked:
+        return f"err BPM bloqueado en {performance_state.bpm:.2f}"
+    set_bpm(float(value))
+
+def _control_ramp(target, bars):
+    if performance_state.bpm_locked:
+        return f"err BPM bloqueado en {performance_state.bpm:.2f}"
+    start_bpm_ramp(float(target), float(bars))
+
+def _control_domain(name, action, value=None):
+    kind = action.upper()
+    if kind not in DOMAIN_COMMAND_KINDS:
+        return f"err acción de dominio desconocida: {action}"
+    if (kind == "BPM") != (value is not None):
+        return "err domain <nombre> bpm espera un valor" if kind == "BPM" else f"err {action} no lleva valor"
+    if not domain_command(name, kind, float(value) if value is not None else None):
+        return f"err dominio desconocido: {name}"
+
+def control_domains_line():
+    if clock_process is not None:
+        return "err el estado de los dominios no se refleja con --clock-process"
+    return "ok " + " ".join(f"{domain.name}={domain.status},{domain.bpm:.2f},{domain.song_pulse}" for domain in clock_domains)
+
+def _control_reload():
+    if not loaded_rule_files:
+        return "err no hay archivo de reglas cargado"
+    messages = []
+    if not reload_rule_files(messages.append):
+        return f"err {messages[-1] if messages else 'no se pudieron recargar las reglas'}"
+    set_feedback_message(messages[-1])
+    return f"ok {messages[-1]}"
+
+def control_status_line():
+    state = performance_state
+    return (f"ok status={state.status} bpm={state.bpm:.2f} target={target_bpm():.2f} pulse={state.song_pulse}"
+            f" scheduled={state.scheduled_transport or '-'} locked={int(state.bpm_locked)}"
+            f" feedback={state.last_feedback_message}")
+
+def control_stats_line():
+    summary = current_timing_summary()
+    return "ok " + " ".join(f"{key}={value}" for key, value in summary.items() if key != "worst_port") \
+        + f" worst_port={summary['worst_port'] or '-'}"
+
+CONTROL_COMMANDS = {
+    # nombre -> (función, número de argumentos o tupla de números admitidos)
+    "play": (play_clock, 0),
+    "stop": (stop_clock, 0),
+    "pause": (pause_clock, 0),
+    "continue": (continue_clock, 0),
+    "bpm": (_control_bpm, 1),
+    "ramp": (_control_ramp, 2),
+    "domain": (_control_domain, (2, 3)),
+    "domains": (control_domains_line, 0),
+    "reload": (_control_reload, 0),
+    "status": (control_status_line, 0),
+    "stats": (control_stats_line, 0),
+    "quit": (_control_quit, 0),
+}
+
+def handle_control_command(line):
+    """Ejecuta una línea del protocolo de control y devuelve la respuesta (sin salto de línea)."""
+    parts = line.split()
+    if not parts:
+        return "err línea vacía"
+    if session_recorder is not None: session_recorder.control(" ".join(parts))
+    entry = CONTROL_COMMANDS.get(parts[0].lower())
+    if entry is None:
+        return f"err comando desconocido: {parts[0]}"
+    handler, arg_count = entry
+    if len(parts) - 1 not in (arg_count if isinstance(arg_count, tuple) else (arg_count,)):
+        expected = "-".join(map(str, arg_count)) if isinstance(arg_count, tuple) else arg_count
+        return f"err {parts[0]} espera {expected} argumento(s)"
+    try:
+        reply = handler(*parts[1:])
+    except (ValueError, OverflowError) as e:
+        return f"err {e}"
+    return reply or "ok"
+
+class ControlRequestHandler(socketserver.StreamRequestHandler):
+    """Una conexión del socket de control: responde a cada línea recibida hasta que el cliente cierra."""
+    def handle(self):
+        for raw_line in self.rfile:
+            trace = latency_tracer.begin("control") if latency_tracer is not None else None
+            try:
+                reply = handle_control_command(raw_line.decode("utf-8", "replace"))
+            finally:
+                if trace is not None: latency_tracer.end(trace)
+            self.wfile.write(reply.encode("utf-8") + b"\n")
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        self.path = str(path)
+        try:
+            mode = os.lstat(self.path).st_mode
+        except FileNotFoundError:
+            mode = None
+        if mode is not None: # Un socket huérfano de una ejecución anterior se reemplaza
+            if not stat.S_ISSOCK(mode): # Nunca se borra otra cosa que un socket
+                raise OSError(f"'{self.path}' existe y no es un socket")
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                raise OSError(f"'{self.path}' ya está en uso por otra instancia")
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(self.path)
+            finally:
+                probe.close()
+        super().__init__(self.path, ControlRequestHandler)
+        os.chmod(self.path, 0o600) # Solo el usuario que ejecuta midimaster
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+def start_control_server(path):
+    """Abre el socket de control en path y lo atiende en un hilo; devuelve None si no es posible."""
+    if not hasattr(socket, "AF_UNIX"):
+        print("Socket de control no disponible: esta plataforma no admite sockets Unix.")
+        return None
+    try:
+        server = ControlServer(path)
+    except OSError as e:
+        print(f"Error abriendo el socket de control '{path}': {e}")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True, name="midimaster-control").start()
+    return server
+
+
 # --- UI Functions (prompt_toolkit) ---
-# (get_status_text, get_feedback_line_text, build_key_bindings permanecen iguales)
-def get_status_text():
+class UiRefresher:
+    """
+    Redibujado de la UI por eventos. Quien cambia algo visible (transporte, tempo, feedback, puertos)
+    llama a request(), que solo activa un Event y es barato también desde el hilo de clock; un hilo
+    propio invalida entonces la aplicación. Por tiempo solo se redibuja al caducar el mensaje de
+    feedback y, con el clock en marcha, cada timing_refresh_s para la línea de timing.
+    """
+    def __init__(self):
+        self.dirty = threading.Event()
+        self.beat_indicator = True # Posición [compás.tiempo] redibujada en cada tiempo
+        self.timing_refresh_s = 1.0
+        self.timing_epoch = 0 # Cambia cada vez que toca rehacer la línea de timing
+        self.fragments = {} # nombre -> (clave, fragmento ya formateado)
+        self.thread = None
+
+    def configure(self, general_settings):
+        self.beat_indicator = bool(general_settings.get("ui_beat_indicator", True))
+        self.timing_refresh_s = max(0.0, float(general_settings.get("ui_timing_refresh_ms", 1000)) / 1000)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True, name="midimaster-ui-refresh")
+        self.thread.start()
+
+    def request(self):
+        self.dirty.set()
+
+    def fragment(self, name, key, build):
+        """Fragmento name; solo se vuelve a formatear con build() si su clave ha cambiado."""
+        cached = self.fragments.get(name)
+        if cached is None or cached[0] != key:
+            cached = self.fragments[name] = (key, build())
+        return cached[1]
+
+    def _timeout(self, next_timing):
+        timeouts = []
+        feedback_left = performance_state.feedback_message_time + performance_state.feedback_message_duration - time.time()
+        if performance_state.last_feedback_message and feedback_left > 0:
+            timeouts.append(feedback_left)
+        if performance_state.status == "PLAYING":
+            timeouts.append(next_timing - time.monotonic())
+        return max(0.0, min(timeouts)) if timeouts else None
+
+    def _run(self):
+        next_timing = time.monotonic()
+        shown_status = None
+        while not SHUTDOWN_FLAG:
+            self.dirty.wait(self._timeout(next_timing))
+            self.dirty.clear()
+            now = time.monotonic()
+            if now >= next_timing or performance_state.status != shown_status:
+                # Al cambiar el transporte la línea de timing se rehace para mostrar el resultado final
+                shown_status = performance_state.status
+                self.timing_epoch += 1
+                next_timing = now + self.timing_refresh_s if self.timing_refresh_s else math.inf
+            app = app_ui_instance
+            if app is not None and app.is_running:
+                app.invalidate()
+
+ui_refresher = UiRefresher()
+
+def request_ui_refresh():
+    ui_refresher.request()
+
+def _ports_fragment():
     ports_str_list = []
     if performance_state.virtual_port_name:
         ports_str_list.append(f"Virtual: {performance_state.virtual_port_name}")
-    ports_str_list.extend([port.name for port in performance_state.output_ports if port.name != performance_state.virtual_port_name]) # Evitar duplicados si el virtual está en la lista
+    output_names = clock_process.output_names if clock_process is not None else [port.name for port in performance_state.output_ports]
+    ports_str_list.extend([name for name in output_names if name != performance_state.virtual_port_name]) # Evitar duplicados si el virtual está en la lista
+    return ", ".join(ports_str_list) if ports_str_list else "Ninguno"
 
-    ports_display = ", ".join(ports_str_list) if ports_str_list else "Ninguno"
+def get_status_text():
+    # Cada línea se guarda ya formateada y solo se rehace si cambia lo que muestra
+    fragment = ui_refresher.fragment
+    ports_display = fragment("ports", (performance_state.virtual_port_name, performance_state.output_senders, clock_process), _ports_fragment)
 
+    status = performance_state.status
+    beat = performance_state.song_pulse // PPQN if status != "STOPPED" and ui_refresher.beat_indicator else None
+    scheduled = performance_state.scheduled_transport
+    def transport_line():
+        line = f"Estado: {status.upper()}"
+        if beat is not None:
+            line += f"  [{beat // performance_state.beats_per_bar + 1}.{beat % performance_state.beats_per_bar + 1}]"
+        if scheduled:
+            line += f" -> {scheduled}"
+        return line
+    transport_display = fragment("transport", (status, beat, scheduled), transport_line)
 
-    status_line = f"Salida: {ports_display}\n"
-    status_line += f"Estado: {performance_state.status.upper()}\n"
-    
-    bpm_display = f"{performance_state.bpm:.2f}"
-    if len(performance_state.bpm_input_buffer) > 0:
-        bpm_display += f" (Entrada: {performance_state.bpm_input_buffer})" # Corrección aquí
-    if performance_state.bpm_locked:
-        bpm_display += " [BLOQUEADO]"
-    status_line += f"BPM:    {bpm_display}"
-    return HTML(status_line)
+    bpm, bpm_input, bpm_locked = performance_state.bpm, performance_state.bpm_input_buffer, performance_state.bpm_locked
+    follow_locked = external_clock.locked if external_clock is not None else None
+    def bpm_line():
+        bpm_display = f"{bpm:.2f}"
+        if len(bpm_input) > 0:
+            bpm_display += f" (Entrada: {bpm_input})"
+        if bpm_locked:
+            bpm_display += " [BLOQUEADO]"
+        if follow_locked is not None:
+            bpm_display += " [EXTERNO]" if follow_locked else " [EXTERNO, enganchando]"
+        return bpm_display
+    bpm_display = fragment("bpm", (bpm, bpm_input, bpm_locked, follow_locked), bpm_line)
+    timing_display = fragment("timing", ui_refresher.timing_epoch, timing_summary_text)
+
+    lines = (ports_display, transport_display, bpm_display, timing_display)
+    if clock_domains:
+        domains = tuple((domain.name, domain.status, round(domain.bpm, 2)) for domain in clock_domains)
+        domains_display = fragment("domains", domains,
+                                   lambda: " | ".join(f"{name} {status} {bpm:.2f}" for name, status, bpm in domains))
+        lines += (domains_display,)
+    return fragment("status", lines, lambda: HTML(f"Salida: {lines[0]}\n{lines[1]}\nBPM:    {lines[2]}\nTiming: {lines[3]}"
+                                                  + (f"\nDominios: {lines[4]}" if len(lines) > 4 else "")))
 
 def get_feedback_line_text():
-    if performance_state.last_feedback_message and \
-       (time.time() - performance_state.feedback_message_time < performance_state.feedback_message_duration):
-        return HTML(f"\n<i>{performance_state.last_feedback_message}</i>")
-    return HTML("\n ") 
+    message = performance_state.last_feedback_message
+    visible = bool(message) and time.time() - performance_state.feedback_message_time < performance_state.feedback_message_duration
+    return ui_refresher.fragment("feedback", (message, visible), lambda: HTML(f"\n<i>{message}</i>") if visible else HTML("\n "))
 
 def build_key_bindings():
     kb = KeyBindings()
@@ -347,10 +3120,10 @@ def build_key_bindings():
 
 
     @kb.add('+')
-    def _(event): set_bpm(performance_state.bpm + 1)
+    def _(event): set_bpm(target_bpm() + 1)
 
     @kb.add('-')
-    def _(event): set_bpm(performance_state.bpm - 1)
+    def _(event): set_bpm(target_bpm() - 1)
     
     @kb.add('b')
     def _(event):
@@ -368,11 +3141,7 @@ def build_key_bindings():
 
     @kb.add(' ')
     @kb.add('c')
-    def _(event):
-        if performance_state.status == "PLAYING":
-            pause_clock()
-        else: 
-            play_clock()
+    def _(event): toggle_play_pause()
     
     @kb.add('enter')
     def _(event):
@@ -384,30 +3153,33 @@ def build_key_bindings():
                 set_feedback_message(f"Entrada BPM inválida: {performance_state.bpm_input_buffer}")
             finally:
                 performance_state.bpm_input_buffer = ""
-        elif performance_state.status == "PLAYING" or performance_state.status == "PAUSED":
-            stop_clock()
-            # Si se quiere que Enter desde Pausa también reinicie:
-            # if performance_state.status == "PAUSED": play_clock() # Esto lo reiniciaría
-        else: # STOPPED
-            play_clock()
+        else: # Stop si está en marcha o en pausa, Play si está parado
+            toggle_play_stop()
 
     @kb.add('p')
-    def _(event):
-        if performance_state.status != "PLAYING":
-            play_clock()
+    def _(event): ensure_playing()
 
     @kb.add('s')
-    def _(event):
-        if performance_state.status != "STOPPED":
-            stop_clock()
+    def _(event): ensure_stopped()
             
+    if session_recorder is not None: # Cada tecla queda en la grabación antes de su acción
+        for binding in kb.bindings:
+            binding.handler = recorded_key_handler(binding.keys, binding.handler)
     return kb
 
+def recorded_key_handler(keys, handler):
+    name = " ".join(str(getattr(key, "value", key)) for key in keys)
+    def recorded(event):
+        session_recorder.key(name)
+        return handler(event)
+    return recorded
+
 def global_midi_callback(msg, port_name):
     """
     Despachador global de callbacks MIDI.
     Maneja los comandos de transporte por defecto y pasa el resto al procesador de reglas.
     """
+    if session_recorder is not None: session_recorder.midi(msg, port_name)
     # Manejo de comandos de transporte MIDI universales
     if msg.type == 'start':
         play_clock()
@@ -423,75 +3195,571 @@ def global_midi_callback(msg, port_name):
     # Si no es un comando de transporte, se pasa al procesador de mapeos JSON
     process_midi_mappings(msg, port_name)
 
+def follow_midi_callback(msg, port_name):
+    """Callback del puerto seguido con --follow: el clock entrante va a external_clock."""
+    if msg.type == 'clock':
+        external_clock.on_clock(time.perf_counter_ns())
+        if session_recorder is not None: session_recorder.midi(msg, port_name)
+        return
+    if msg.type in ('start', 'continue'):
+        external_clock.on_start() # El primer pulso que llegue desde aquí es el pulso 0 de la salida
+    (traced_midi_callback if latency_tracer is not None else global_midi_callback)(msg, port_name)
 
-# --- Procesamiento de Mapeos MIDI (igual que antes) ---
+def traced_midi_callback(msg, port_name):
+    """global_midi_callback con trazado de latencia (--trace-latency)."""
+    trace = latency_tracer.begin(f"midi:{port_name}")
+    try:
+        global_midi_callback(msg, port_name)
+    finally:
+        latency_tracer.end(trace)
 
-def process_midi_mappings(msg, port_name):
-    global performance_state
-    if not midi_filters: return
-
-    for mapping in midi_filters: 
-        dev_alias = mapping.get("device_in")
-        if dev_alias:
-            dev_substr = global_device_aliases.get(dev_alias, dev_alias)
-            if dev_substr.lower() not in port_name.lower():
-                continue
-        else: continue 
 
-        if "ch_in" in mapping:
-            if hasattr(msg, 'channel'): # Comprueba si el mensaje TIENE un atributo 'channel'
-                if msg.channel != mapping["ch_in"]:
-                    continue
-            else:
-                # Si el mensaje NO tiene canal (ej. 'start', 'stop')
-                # pero el mapeo SÍ especifica 'ch_in', entonces este mapeo no aplica.
+# --- Procesamiento de Mapeos MIDI ---
+# Los mapeos se compilan al cargar en un índice (tipo, canal, data1) por puerto de entrada.
+# None en canal o data1 actúa como comodín.
+_EVENT_TYPES = {"note": ("note_on", "note_off"), "cc": ("control_change",), "pc": ("program_change",)}
+_DATA1_ATTRS = {"note_on": "note", "note_off": "note", "control_change": "control", "program_change": "program"}
+
+# --- Tablas de transformación de valores ---
+CURVES = ("linear", "log", "exp")
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+def _is_midi_int(value, top=127):
+    return isinstance(value, int) and not isinstance(value, bool) and 0 <= value <= top
+
+def _scale_pair(scale_config, key, default):
+    pair = scale_config.get(key, default)
+    if not (isinstance(pair, (list, tuple)) and len(pair) >= 2 and all(_is_number(v) for v in pair[:2])):
+        raise ValueError(f"'{key}' debe ser una lista de dos números")
+    return pair[0], pair[1]
+
+def _apply_curve(x, curve, amount):
+    if curve == "log": return math.log1p(amount * x) / math.log1p(amount)
+    if curve == "exp": return math.expm1(amount * x) / math.expm1(amount)
+    return x
+
+def build_value_lut(scale_config=None, default_out=(0, 127), as_int=False, clamp_out=None):
+    """
+    Precalcula la tabla de 128 entradas valor MIDI -> valor de salida de un bloque de escala:
+    range_in, range_out (invertido si va de mayor a menor), curve ("linear"/"log"/"exp"),
+    curve_amount e invert. ValueError si algún campo no es válido.
+    """
+    scale_config = scale_config if isinstance(scale_config, dict) else {}
+    min_in, max_in = _scale_pair(scale_config, "range_in", [0, 127])
+    min_out, max_out = _scale_pair(scale_config, "range_out", list(default_out))
+    curve = scale_config.get("curve", "linear")
+    if curve not in CURVES:
+        raise ValueError(f"'curve' debe ser uno de {', '.join(CURVES)}")
+    amount = scale_config.get("curve_amount", 4.0)
+    if not _is_number(amount):
+        raise ValueError("'curve_amount' debe ser un número")
+    amount = float(amount) or 4.0
+    if curve == "log" and amount <= -1:
+        raise ValueError("'curve_amount' debe ser mayor que -1 con la curva log")
+    invert = bool(scale_config.get("invert", False))
+    lut = []
+    for value in range(128):
+        if max_in == min_in: normalized = 0.0 if value <= min_in else 1.0
+        else: normalized = (float(max(min(min_in, max_in), min(max(min_in, max_in), value))) - min_in) / (max_in - min_in)
+        normalized = _apply_curve(normalized, curve, amount)
+        if invert: normalized = 1.0 - normalized
+        out = normalized * (max_out - min_out) + min_out
+        if clamp_out: out = max(clamp_out[0], min(clamp_out[1], out))
+        lut.append(int(round(out)) if as_int else out)
+    return tuple(lut)
+
+# --- Acciones de los mapeos ---
+# Cada acción se compila una vez por mapping en una función fn(msg); el trabajo por mensaje
+# se reduce a consultar las tablas precalculadas.
+# Con "domain" la acción va al dominio de clock con ese nombre en vez de al clock principal
+def _compile_play(mapping):
+    domain = mapping.get("domain")
+    return (lambda msg: domain_command(domain, "PLAY")) if domain else (lambda msg: play_clock())
+
+def _compile_stop(mapping):
+    domain = mapping.get("domain")
+    return (lambda msg: domain_command(domain, "STOP")) if domain else (lambda msg: stop_clock())
+
+def _compile_pause(mapping):
+    domain = mapping.get("domain")
+    return (lambda msg: domain_command(domain, "PAUSE")) if domain else (lambda msg: pause_clock())
+
+def _compile_continue(mapping):
+    domain = mapping.get("domain")
+    return (lambda msg: domain_command(domain, "CONTINUE")) if domain else (lambda msg: continue_clock())
+
+def _compile_bpm(mapping):
+    scale_config = mapping.get("bpm_scale")
+    if isinstance(scale_config, dict):
+        lut = build_value_lut(scale_config, default_out=(60, 180))
+    else: # Sin escala el valor del CC se usa directamente como BPM
+        lut = tuple(float(value) for value in range(128))
+    domain = mapping.get("domain")
+    if domain:
+        return lambda msg: domain_command(domain, "BPM", lut[msg.value])
+    return lambda msg: set_bpm(lut[msg.value])
+
+def _compile_bpm_ramp(mapping):
+    target_bpm = mapping.get("ramp_bpm")
+    if not isinstance(target_bpm, (int, float)): return None
+    bars = mapping.get("ramp_bars", BEATS_PER_BAR)
+    if not _is_number(bars):
+        raise ValueError("'ramp_bars' debe ser un número")
+    bars = ramp_bars_value(bars)
+    return lambda msg: start_bpm_ramp(target_bpm, bars)
+
+_STATUS_BASES = {"note_off": 0x80, "note_on": 0x90, "control_change": 0xB0, "program_change": 0xC0}
+
+def _compile_thru(mapping):
+    """MIDI thru hacia device_out con canal, nota/CC y valor remapeados por tablas."""
+    output = thru_outputs.get(mapping.get("device_out"))
+    if output is None: return None
+    send = output[1]
+    ch_out = mapping.get("ch_out")
+    value_1_out = mapping.get("value_1_out")
+    if value_1_out is not None and not _is_midi_int(value_1_out):
+        raise ValueError("'value_1_out' debe ser un entero 0-127")
+    value_lut = build_value_lut(mapping.get("value_scale"), as_int=True, clamp_out=(0, 127))
+    # Byte de estado por tipo y canal de entrada
+    status_lut = {msg_type: tuple(base | (ch_out if isinstance(ch_out, int) else ch) for ch in range(16))
+                  for msg_type, base in _STATUS_BASES.items()}
+    note_status = status_lut["note_on"]; off_status = status_lut["note_off"]; cc_status = status_lut["control_change"]
+    pc_status = status_lut["program_change"]
+
+    def fn(msg):
+        msg_type = msg.type
+        if msg_type == "control_change":
+            send(bytes((cc_status[msg.channel], msg.control if value_1_out is None else value_1_out, value_lut[msg.value])))
+        elif msg_type == "note_on":
+            send(bytes((note_status[msg.channel], msg.note if value_1_out is None else value_1_out, value_lut[msg.velocity])))
+        elif msg_type == "note_off":
+            send(bytes((off_status[msg.channel], msg.note if value_1_out is None else value_1_out, value_lut[msg.velocity])))
+        else: # program_change
+            send(bytes((pc_status[msg.channel], value_lut[msg.program])))
+    return fn
+
+# acción -> (compilador, tipos de mensaje admitidos o None para todos)
+RULE_ACTIONS = {
+    "play": (_compile_play, None),
+    "stop": (_compile_stop, None),
+    "pause": (_compile_pause, None),
+    "continue": (_compile_continue, None),
+    "bpm": (_compile_bpm, ("control_change",)),
+    "bpm_ramp": (_compile_bpm_ramp, None),
+    "thru": (_compile_thru, tuple(_STATUS_BASES)),
+}
+
+def _validate_mapping(mapping):
+    """Comprueba los campos de entrada comunes a todas las acciones; ValueError con el motivo."""
+    for key in ("device_in", "event_in", "device_out"):
+        if not isinstance(mapping.get(key, ""), str):
+            raise ValueError(f"'{key}' debe ser un texto")
+    ch_in = mapping.get("ch_in")
+    if ch_in is not None and not _is_midi_int(ch_in, 15):
+        raise ValueError("'ch_in' debe ser un canal 0-15")
+    value_1 = mapping.get("value_1_in")
+    if value_1 is not None and not _is_midi_int(value_1):
+        raise ValueError("'value_1_in' debe ser un entero 0-127")
+
+def open_thru_outputs(output_names=None, mappings=None, aliases=None):
+    """
+    Abre (o reutiliza si ya son salidas de clock) los puertos device_out de las acciones "thru"
+    de mappings con esos alias (por defecto, los mapeos y alias cargados).
+    """
+    output_names = output_names if output_names is not None else midi_port_names("outputs")
+    mappings = mappings if mappings is not None else midi_filters
+    aliases = aliases if aliases is not None else global_device_aliases
+    clock_ports = {port.name: port for port in performance_state.output_ports}
+    for mapping in mappings:
+        alias = mapping.get("device_out")
+        if mapping.get("action") != "thru" or not alias or alias in thru_outputs: continue
+        dev_substr = aliases.get(alias, alias)
+        port_name = find_port_by_substring(output_names, dev_substr)
+        if not port_name:
+            print(f"Advertencia: Salida thru '{alias}' no encontrada.")
+            continue
+        port = clock_ports.get(port_name)
+        try:
+            if port is None:
+                port = mido.open_output(port_name)
+                print(f"Puerto de salida thru '{port_name}' abierto.")
+            thru_outputs[alias] = (port, raw_sender_for(port))
+        except Exception as e:
+            print(f"Error abriendo puerto de salida thru '{port_name}': {e}")
+
+class PortRuleTable:
+    """Reglas que aplican a un puerto de entrada, indexadas por (tipo, canal, data1)."""
+    def __init__(self, buckets):
+        self.buckets = buckets # clave con comodines -> [(orden, función compilada)]
+        self.cache = {} # clave concreta -> tupla de funciones compiladas en orden de archivo
+
+    def _resolve(self, key):
+        msg_type, channel, data1 = key
+        candidates = {key, (msg_type, None, data1), (msg_type, channel, None), (msg_type, None, None)}
+        matches = []
+        for candidate in candidates:
+            matches.extend(self.buckets.get(candidate, ()))
+        matches.sort(key=lambda entry: entry[0])
+        return tuple(fn for _, fn in matches)
+
+    def lookup(self, msg_type, channel, data1):
+        key = (msg_type, channel, data1)
+        hit = self.cache.get(key)
+        if hit is None:
+            hit = self.cache[key] = self._resolve(key)
+        return hit
+
+class RuleDispatcher:
+    """
+    Despachador de mapeos compilado. La correspondencia puerto/alias se resuelve una vez por
+    puerto (table_for_port) y cada mensaje cuesta una consulta a diccionario.
+    """
+    def __init__(self, mappings, aliases):
+        self.mappings = list(mappings)
+        self.aliases = dict(aliases)
+        self.port_tables = {}
+        # Las acciones (y sus tablas) se compilan una sola vez por mapping, no por puerto
+        self.compiled = []
+        self.labels = {} # función compilada -> etiqueta legible, para el trazado de latencia
+        self.warnings = [] # Mapeos descartados por campos no válidos
+        for order, mapping in enumerate(self.mappings, 1):
+            action = RULE_ACTIONS.get(mapping.get("action"))
+            try:
+                _validate_mapping(mapping)
+                fn = action[0](mapping) if action else None
+            except Exception as e: # Un mapeo mal escrito se descarta; el resto sigue funcionando
+                where = mapping.get("_source_file", "reglas")
+                self.warnings.append(f"Advertencia: Mapeo {mapping.get('_map_id_in_file', order - 1)} de '{where}' ignorado: {e}")
+                fn = None
+            self.compiled.append((fn, action[1]) if fn else None)
+            if fn:
+                value_1 = mapping.get("value_1_in")
+                self.labels[fn] = (f"#{order} {mapping.get('action')} {mapping.get('device_in')}/{mapping.get('event_in')}"
+                                   + (f" {value_1}" if value_1 is not None else ""))
+
+    def _compile_for_port(self, port_name):
+        port_lower = port_name.lower()
+        buckets = {}
+        for order, (mapping, compiled) in enumerate(zip(self.mappings, self.compiled)):
+            dev_alias = mapping.get("device_in")
+            if not compiled or not dev_alias: continue
+            dev_substr = self.aliases.get(dev_alias, dev_alias)
+            if not isinstance(dev_substr, str) or dev_substr.lower() not in port_lower: continue
+
+            map_event = mapping.get("event_in")
+            if not map_event: continue
+            fn, allowed_types = compiled
+
+            channel = mapping.get("ch_in") # None si no se especifica
+            for msg_type in _EVENT_TYPES.get(map_event, (map_event,)):
+                if allowed_types and msg_type not in allowed_types: continue
+                if "value_1_in" in mapping:
+                    if msg_type not in _DATA1_ATTRS: continue # Solo note/cc/pc tienen valor 1
+                    data1 = mapping["value_1_in"]
+                else:
+                    data1 = None
+                buckets.setdefault((msg_type, channel, data1), []).append((order, fn))
+        return PortRuleTable(buckets)
+
+    def table_for_port(self, port_name):
+        table = self.port_tables.get(port_name)
+        if table is None:
+            table = self.port_tables[port_name] = self._compile_for_port(port_name)
+        return table
+
+    def dispatch(self, msg, port_name):
+        table = self.port_tables.get(port_name) or self.table_for_port(port_name)
+        msg_type = msg.type
+        data1_attr = _DATA1_ATTRS.get(msg_type)
+        data1 = getattr(msg, data1_attr) if data1_attr else None
+        fns = table.lookup(msg_type, getattr(msg, 'channel', None), data1)
+        if latency_tracer is not None:
+            latency_tracer.run_rules(fns, msg, self.labels)
+            return
+        for fn in fns:
+            fn(msg)
+
+def build_rule_dispatcher(mappings, aliases, port_names=(), report=None):
+    """
+    Compila mappings en un RuleDispatcher (el de la caché si hay un solo archivo y no ha cambiado)
+    y precompila las tablas de port_names, sin publicarlo. Con report se avisa de cada mapeo descartado.
+    """
+    rule_files = [_rule_cache.get(path) for path in loaded_rule_files]
+    if len(rule_files) == 1 and rule_files[0] is not None and rule_files[0].mappings == mappings:
+        dispatcher_obj = rule_files[0].dispatcher(aliases)
+    else:
+        dispatcher_obj = RuleDispatcher(mappings, aliases)
+    for port_name in list(port_names):
+        dispatcher_obj.table_for_port(port_name)
+    if report is not None:
+        for warning in dispatcher_obj.warnings:
+            report(warning)
+    return dispatcher_obj
+
+def rebuild_rule_dispatcher(port_names=(), report=None):
+    """
+    Compila midi_filters con build_rule_dispatcher y publica el resultado con una sola asignación.
+    Los callbacks MIDI leen la referencia una vez por mensaje: el cambio no los bloquea y cada
+    mensaje ve unas reglas u otras.
+    """
+    global rule_dispatcher
+    rule_dispatcher = build_rule_dispatcher(midi_filters, global_device_aliases, port_names, report)
+    return rule_dispatcher
+
+def open_mapping_inputs(report=print):
+    """Abre con callback las entradas MIDI que usan los mapeos y aún no están abiertas."""
+    required_dev_aliases = {m.get("device_in") for m in midi_filters if m.get("device_in")}
+    for alias in required_dev_aliases:
+        dev_substr = global_device_aliases.get(alias, alias)
+        port_name = find_port_by_substring(midi_port_names("inputs"), dev_substr)
+        if port_name and port_name not in midi_input_ports:
+            try:
+                # Crear un callback que capture el nombre del puerto y lo envíe al despachador global
+                midi_callback = traced_midi_callback if latency_tracer is not None else global_midi_callback
+                if external_clock is not None and port_name == external_clock.port_name:
+                    midi_callback = follow_midi_callback
+                callback_func = lambda msg, name=port_name, cb=midi_callback: cb(msg, name)
+                rule_dispatcher.table_for_port(port_name) # Compilar las reglas del puerto antes de recibir
+                port = mido.open_input(port_name, callback=callback_func)
+                midi_input_ports[port_name] = port
+                report(f"Puerto de entrada '{port_name}' para mapeos abierto.")
+            except Exception as e:
+                report(f"Error abriendo puerto de entrada '{port_name}': {e}")
+
+_reload_lock = threading.Lock() # RuleWatcher y el comando reload pueden coincidir
+# Mientras se recompila, el hilo de recarga suelta el GIL cada 0.5 ms (por defecto 5 ms): si no,
+# un pulso que vence a mitad de la compilación puede salir hasta 5 ms tarde
+RELOAD_SWITCH_INTERVAL_S = 0.0005
+
+def reload_rule_files(report=None):
+    """
+    Vuelve a leer los archivos de reglas cargados y publica el despachador nuevo sin parar el clock.
+    Se aplican los mapeos, los alias y quantize/beats_per_bar; el resto de clock_settings (tempo,
+    salidas, dominios) se aplica al reiniciar. Si un archivo no es válido se mantienen las reglas actuales.
+    """
+    with _reload_lock:
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(switch_interval, RELOAD_SWITCH_INTERVAL_S))
+        try:
+            return _reload_rule_files(report or set_feedback_message)
+        finally:
+            sys.setswitchinterval(switch_interval)
+
+def _reload_rule_files(report):
+    global global_device_aliases, midi_filters, rule_dispatcher
+    rule_files = []
+    for path in loaded_rule_files:
+        rule_file = compile_rule_file(path, report, load_rule_file_content_offloaded)
+        if rule_file is None: return False
+        rule_files.append(rule_file)
+    # Como al cargar: cuentan los alias del primer archivo que los define
+    aliases = next((dict(rule_file.aliases) for rule_file in rule_files if rule_file.aliases), {})
+    mappings = [mapping for rule_file in rule_files for mapping in rule_file.mappings]
+    # Todo se prepara en variables locales: si algo falla, las reglas publicadas no se tocan
+    try:
+        open_thru_outputs(mappings=mappings, aliases=aliases)
+        dispatcher_obj = build_rule_dispatcher(mappings, aliases, midi_input_ports, report)
+    except Exception as e:
+        report(f"Error al recargar las reglas: {e}. Se mantienen las reglas actuales.")
+        return False
+    for rule_file in rule_files:
+        apply_live_clock_settings(rule_file.clock_settings)
+    global_device_aliases = aliases
+    midi_filters = mappings
+    rule_dispatcher = dispatcher_obj
+    open_mapping_inputs(report)
+    ignored = f", {len(dispatcher_obj.warnings)} ignorados" if dispatcher_obj.warnings else ""
+    report(f"Reglas recargadas: {', '.join(path.name for path in loaded_rule_files)} ({len(mappings)} mapeos{ignored})")
+    if session_recorder is not None: session_recorder.rules(rule_files_snapshot())
+    return True
+
+class RuleWatcher:
+    """
+    Vigila los archivos de reglas cargados (mtime y tamaño, cada interval_s) y los recarga al
+    cambiar. Un archivo guardado a medias o con errores deja activas las reglas anteriores.
+    """
+    def __init__(self, paths, interval_s=0.5):
+        self.paths = list(paths)
+        self.interval_s = interval_s
+        self.stamps = [_file_stamp(path) for path in self.paths]
+        self.reloads = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True, name="midimaster-rules")
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        with _reload_lock: # El proceso auxiliar de lectura, listo antes del primer cambio
+            start_rule_parser()
+        while not self.stopped.wait(self.interval_s):
+            stamps = [_file_stamp(path) for path in self.paths]
+            if stamps != self.stamps:
+                self.stamps = stamps
+                try:
+                    if reload_rule_files():
+                        self.reloads += 1
+                except Exception as e: # Un fallo inesperado no para la vigilancia
+                    set_feedback_message(f"Error al recargar las reglas: {e}")
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join(timeout=1.0)
+
+def open_follow_input(report=print):
+    """Abre la entrada del clock externo (--follow) si aún no está abierta."""
+    if external_clock is None or external_clock.port_name in midi_input_ports: return
+    port_name = external_clock.port_name
+    try:
+        midi_input_ports[port_name] = mido.open_input(port_name, callback=lambda msg, name=port_name: follow_midi_callback(msg, name))
+        report(f"Puerto de entrada '{port_name}' para el clock externo abierto.")
+    except Exception as e:
+        report(f"Error abriendo la entrada de clock '{port_name}': {e}")
+
+class DeviceMonitor:
+    """
+    Vigila la enumeración de puertos MIDI cada interval_s y reabre por nombre las salidas y entradas
+    que desaparecen y vuelven (un USB desconectado, un virmidi reiniciado). Enumerar y abrir puertos
+    se hace en este hilo; el hilo de clock solo incorpora los ya abiertos (ver OutputRejoin).
+    clock=True vigila las salidas del motor de clock y de los dominios (en el proceso que los tiene);
+    rules=True las entradas de los mapeos y de --follow y las salidas thru.
+    """
+    def __init__(self, interval_s=1.0, clock=True, rules=True, report=None):
+        self.interval_s = interval_s
+        self.clock = clock
+        self.rules = rules
+        self.report = report or set_feedback_message
+        self.lost_outputs = {} # id del puerto desaparecido -> puerto
+        self.lost_inputs = set() # Nombres base de las entradas desaparecidas
+        self.input_names = None # Última enumeración de entradas atendida
+        self.reconnects = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True, name="midimaster-devices")
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stopped.wait(self.interval_s):
+            try:
+                self.poll()
+            except Exception as e: # Un fallo del backend al enumerar no detiene la vigilancia
+                self.report(f"Error vigilando los dispositivos MIDI: {e}")
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join(timeout=1.0)
+
+    def poll(self):
+        if self.clock or (self.rules and thru_outputs):
+            self._check_outputs(midi_port_names("outputs", refresh=True))
+        if self.rules and (midi_filters or external_clock is not None):
+            self._check_inputs(midi_port_names("inputs", refresh=True))
+
+    @staticmethod
+    def _reappeared(name, names):
+        """Nombre con el que ha vuelto el puerto 'name' (el mismo o con otra numeración), o None."""
+        if name in names: return name
+        base = port_base_name(name)
+        return next((candidate for candidate in names if port_base_name(candidate) == base), None)
+
+    def _output_targets(self):
+        """(dominio o None, puertos) de cada conjunto de salidas del motor de clock vigilado."""
+        if not self.clock: return []
+        return [(None, performance_state.output_ports)] + [(domain, domain.ports) for domain in clock_domains]
+
+    def _check_outputs(self, names):
+        present = set(names)
+        watched = {id(port): port for _, ports in self._output_targets() for port in ports
+                   if port.name != performance_state.virtual_port_name}
+        if self.rules:
+            watched.update((id(port), port) for port, _ in thru_outputs.values())
+        for port_id, port in watched.items():
+            if port_id not in self.lost_outputs and port.name not in present:
+                self.lost_outputs[port_id] = port
+                self.report(f"Salida '{port.name}' desconectada: se reabrirá cuando vuelva.")
+
+        thru_changed = False
+        for port_id, old in list(self.lost_outputs.items()):
+            new_name = self._reappeared(old.name, names)
+            if new_name is None: continue
+            try:
+                new = mido.open_output(new_name)
+            except Exception as e: # Se reintenta en la próxima vuelta
+                self.report(f"Error reabriendo la salida '{new_name}': {e}")
                 continue
-        
-        map_event = mapping.get("event_in")
-        is_event_match = False
-        if map_event:
-            if map_event == "note" and msg.type in ["note_on", "note_off"]: is_event_match = True
-            elif map_event == "cc" and msg.type == "control_change": is_event_match = True
-            elif map_event == "pc" and msg.type == "program_change": is_event_match = True
-            elif msg.type == map_event: is_event_match = True
-        if not is_event_match: continue
-        
-        if "value_1_in" in mapping:
-            msg_v1 = getattr(msg, 'note', None)
-            if msg_v1 is None: msg_v1 = getattr(msg, 'control', None)
-            if msg_v1 is None: msg_v1 = getattr(msg, 'program', None)
-            if msg_v1 is None: msg_v1 = -1
-            expected_value = mapping["value_1_in"]
-            if msg.type in ["note_on", "note_off", "control_change", "program_change"]:
-                if msg_v1 != expected_value:
-                    continue
-            elif msg.type not in ["note_on", "note_off", "control_change", "program_change"] and "value_1_in" in mapping:
-                 continue
-        
-        action = mapping.get("action") 
-        if action == "play": play_clock()
-        elif action == "stop": stop_clock()
-        elif action == "pause":
-            if performance_state.status == "PLAYING": pause_clock()
-        elif action == "continue": # Bloque añadido
-            if performance_state.status == "PAUSED":
-                play_clock()
-        elif action == "bpm" and msg.type == "control_change":
-            cc_val = msg.value
-            scale_config = mapping.get("bpm_scale") 
-            if isinstance(scale_config, dict):
-                min_in = scale_config.get("range_in", [0,127])[0]
-                max_in = scale_config.get("range_in", [0,127])[1]
-                min_out = scale_config.get("range_out", [60,180])[0]
-                max_out = scale_config.get("range_out", [60,180])[1]
-                
-                if max_in == min_in: normalized = 0.0 if cc_val <= min_in else 1.0
-                else: normalized = (float(max(min_in, min(max_in, cc_val))) - min_in) / (max_in - min_in)
-                scaled_bpm = normalized * (max_out - min_out) + min_out
-                set_bpm(scaled_bpm)
-            else:
-                set_bpm(cc_val) 
-        # break 
+            del self.lost_outputs[port_id]
+            for domain, ports in self._output_targets():
+                if old in ports: # El mismo lugar en la lista: mismo PPQN y mismos grupos
+                    ports = [new if port is old else port for port in ports]
+                    rates = domain.rates if domain is not None else performance_state.output_rates
+                    if not self._rejoin(OutputRejoin(domain, prepare_output_fanout(ports, rates), (new,))):
+                        try: new.close() # Cierre en curso: el puerto nuevo no llegó a usarse
+                        except Exception: pass
+                        return
+            with _reload_lock: # Una recarga de reglas también toca thru_outputs
+                for alias, (port, _) in list(thru_outputs.items()):
+                    if port is old:
+                        thru_outputs[alias] = (new, raw_sender_for(new))
+                        thru_changed = True
+            performance_state.send_errors.pop(old.name, None) # Volver a avisar si falla otra vez
+            try:
+                if not old.closed: old.close()
+            except Exception: pass
+            self.reconnects += 1
+            self.report(f"Salida '{new_name}' reconectada.")
+        if thru_changed: # Las acciones thru capturan su puerto al compilar
+            with _reload_lock:
+                rebuild_rule_dispatcher(midi_input_ports)
+
+    def _rejoin(self, rejoin):
+        """Entrega los puertos nuevos al hilo de clock y espera a que los incorpore; False si se cierra antes."""
+        enqueue_command("REJOIN", rejoin)
+        while not rejoin.done.wait(0.1):
+            if SHUTDOWN_FLAG or self.stopped.is_set(): return False
+        for worker in rejoin.retired_workers:
+            worker.stop()
+        return True
+
+    def _check_inputs(self, names):
+        if names == self.input_names: return
+        self.input_names = names
+        present = set(names)
+        if external_clock is not None and external_clock.port_name not in present:
+            new_name = self._reappeared(external_clock.port_name, names)
+            if new_name: external_clock.port_name = new_name
+        # midi_input_ports también lo cambia una recarga de reglas
+        with _reload_lock:
+            for name in [name for name in midi_input_ports if name not in present]:
+                port = midi_input_ports.pop(name)
+                self.lost_inputs.add(port_base_name(name))
+                try:
+                    if not port.closed: port.close()
+                except Exception: pass
+                self.report(f"Entrada '{name}' desconectada: se reabrirá cuando vuelva.")
+            # Las entradas se resuelven por alias en cada cambio: también las que no estaban al arrancar
+            open_mapping_inputs(self.report)
+            open_follow_input(self.report)
+        for name in midi_input_ports:
+            base = port_base_name(name)
+            if base in self.lost_inputs:
+                self.lost_inputs.discard(base)
+                self.reconnects += 1
+
+def start_device_monitor(clock=True, rules=True):
+    """DeviceMonitor con el intervalo de general_settings.device_monitor_interval_ms; None si está desactivado."""
+    interval_ms = main_config.get("general_settings", {}).get("device_monitor_interval_ms", 1000)
+    if not isinstance(interval_ms, (int, float)) or interval_ms <= 0: return None
+    return DeviceMonitor(interval_ms / 1000, clock=clock, rules=rules).start()
+
+def process_midi_mappings(msg, port_name):
+    dispatcher_obj = rule_dispatcher
+    if dispatcher_obj is None: return
+    dispatcher_obj.dispatch(msg, port_name)
 
 
 # --- UI para selección de puertos (adaptado de MIDImod) ---
@@ -579,8 +3847,9 @@ def interactive_port_selector(available_ports, prompt_title="Selecciona puertos
 
 # --- Main Application ---
 def main():
-    global SHUTDOWN_FLAG, performance_state, midi_clock_thread, app_ui_instance
-    global global_device_aliases, midi_filters, main_config, osc_client, osc_server_thread
+    global SHUTDOWN_FLAG, performance_state, midi_clock_thread, clock_process, app_ui_instance
+    global global_device_aliases, midi_filters, main_config, osc_client, osc_server_thread, latency_tracer, external_clock
+    global session_recorder
 
     main_config = load_main_config()
     # Actualizar el BPM por defecto desde la configuración
@@ -591,16 +3860,38 @@ def main():
     parser.add_argument("--virtual-ports", action="store_true", help="Activa puerto MIDI virtual de SALIDA.")
     parser.add_argument("--vp-out", type=str, default=main_config.get("general_settings", {}).get("default_virtual_port_name"), metavar="NOMBRE", help="Nombre para el puerto virtual de SALIDA.")
     parser.add_argument("--list-ports", action="store_true", help="Lista puertos MIDI y sale.")
+    parser.add_argument("--timing-dump", type=str, default=main_config.get("clock_engine", {}).get("timing_dump") or None, metavar="RUTA", help="Al salir, vuelca el registro de timing del clock (CSV si termina en .csv, binario si no).")
+    parser.add_argument("--clock-process", action="store_true", default=bool(main_config.get("clock_engine", {}).get("process")), help="Ejecuta el motor de clock en un proceso aparte, dueño de los puertos de salida.")
+    parser.add_argument("--realtime", action="store_true", default=bool(main_config.get("clock_engine", {}).get("realtime")), help="Hilo de clock en tiempo real: SCHED_FIFO, afinidad de CPU, memoria bloqueada y GC controlado (Linux).")
+    parser.add_argument("--rt-cpu", type=int, default=None, metavar="N", help="Con --realtime, fija el hilo de clock al núcleo N.")
+    parser.add_argument("--rt-priority", type=int, default=None, metavar="P", help="Con --realtime, prioridad SCHED_FIFO (1-99).")
+    parser.add_argument("--follow", type=str, default=None, metavar="DISPOSITIVO", help="Sigue el clock MIDI que entra por DISPOSITIVO (alias o parte del nombre) y lo redistribuye sin jitter.")
+    parser.add_argument("--headless", action="store_true", help="Sin interfaz ni selector de puertos; se controla por el socket de control, OSC o reglas MIDI.")
+    parser.add_argument("--control-socket", type=str, default=main_config.get("general_settings", {}).get("control_socket") or None, metavar="RUTA", help=f"Socket Unix de control (con --headless, por defecto {DEFAULT_CONTROL_SOCKET}).")
+    parser.add_argument("--trace-latency", action="store_true", default=bool(main_config.get("clock_engine", {}).get("trace_latency")), help="Mide la latencia de cada evento de entrada hasta los bytes MIDI que produce.")
+    parser.add_argument("--record", type=str, default=main_config.get("general_settings", {}).get("session_record") or None, metavar="RUTA", help="Graba la sesión (entradas, OSC, teclas, tempo, transporte y pulsos) en RUTA; admite campos de strftime.")
     args = parser.parse_args()
+    engine_config = main_config["clock_engine"]
+    engine_config["realtime"] = args.realtime
+    if args.rt_cpu is not None: engine_config["rt_cpu"] = args.rt_cpu
+    if args.rt_priority is not None: engine_config["rt_priority"] = args.rt_priority
+    if args.trace_latency:
+        latency_tracer = LatencyTracer.from_config(main_config.get("clock_engine", {}))
 
     if args.list_ports:
         print("Puertos de ENTRADA MIDI disponibles:")
-        for name in mido.get_input_names(): print(f"  - '{name}'")
+        for name in midi_port_names("inputs"): print(f"  - '{name}'")
         print("\nPuertos de SALIDA MIDI disponibles:")
-        for name in mido.get_output_names(): print(f"  - '{name}'")
+        for name in midi_port_names("outputs"): print(f"  - '{name}'")
         return
 
+    if not args.clock_process:
+        # La calibración del timer (~50 ms de sleeps) corre mientras se cargan reglas y puertos
+        threading.Thread(target=get_precision_timer, daemon=True, name="midimaster-calibrate").start()
+
     RULES_DIR.mkdir(parents=True, exist_ok=True)
+    if args.headless:
+        signal.signal(signal.SIGTERM, signal_handler) # Parada normal de un servicio
 
 
 
@@ -615,7 +3906,7 @@ def main():
             if hasattr(performance_state, 'default_device_out_alias_from_json'):
                 alias = performance_state.default_device_out_alias_from_json
                 dev_substr = global_device_aliases.get(alias, alias)
-                resolved_name = find_port_by_substring(mido.get_output_names(), dev_substr)
+                resolved_name = find_port_by_substring(midi_port_names("outputs"), dev_substr)
                 if resolved_name:
                     port_name_from_json = resolved_name
                     selected_port_names.append(port_name_from_json)
@@ -624,9 +3915,12 @@ def main():
                     print(f"Advertencia: Dispositivo de salida por defecto '{alias}' del JSON no encontrado.")
 
     # Mostrar selector interactivo solo si el JSON no especificó un puerto válido
-    if not port_name_from_json:
-        available_physical_outputs = mido.get_output_names()
+    if args.headless and not port_name_from_json:
+        print("Modo headless: sin selector de puertos; salidas del archivo de reglas y del puerto virtual.")
+    elif not port_name_from_json:
+        available_physical_outputs = midi_port_names("outputs")
         if available_physical_outputs:
+            load_ui_modules()
             user_selected_names = interactive_port_selector(available_physical_outputs)
             if user_selected_names is None: # Usuario canceló
                 print("Saliendo de midimaster.")
@@ -634,47 +3928,65 @@ def main():
             if user_selected_names:
                 selected_port_names.extend(user_selected_names)
 
-    # Abrir puertos
-    opened_port_objects = []
-    if args.virtual_ports:
-        try:
-            vp_name = args.vp_out
-            port = mido.open_output(vp_name, virtual=True)
-            opened_port_objects.append(port)
-            performance_state.virtual_port_name = port.name
-            print(f"Puerto virtual de salida '{port.name}' abierto.")
-        except Exception as e:
-            print(f"Error abriendo puerto virtual '{args.vp_out}': {e}")
-
-    for name in selected_port_names:
-        if performance_state.virtual_port_name and name == performance_state.virtual_port_name:
-            continue
-        try:
-            port = mido.open_output(name)
-            opened_port_objects.append(port)
-            print(f"Puerto de salida físico '{name}' abierto.")
-        except Exception as e:
-            print(f"Error abriendo puerto físico '{name}': {e}")
+    # Clock externo a seguir (--follow o clock_settings.follow): antes de arrancar el motor de clock
+    follow_alias = args.follow or getattr(performance_state, 'follow_alias_from_json', None)
+    if follow_alias:
+        follow_port_name = find_port_by_substring(midi_port_names("inputs"), global_device_aliases.get(follow_alias, follow_alias))
+        if follow_port_name:
+            external_clock = ExternalClock(follow_port_name, main_config["clock_engine"], performance_state.bpm)
+            print(f"Siguiendo el clock MIDI de '{follow_port_name}'.")
+            if args.clock_process: # Las llegadas se fechan en los callbacks de este proceso
+                print("--follow no es compatible con --clock-process: se usará el hilo de clock de este proceso.")
+                args.clock_process = False
+        else:
+            print(f"Advertencia: Entrada de clock '{follow_alias}' no encontrada. Se usará el clock interno.")
+    if args.record and args.clock_process: # Los pulsos y el tempo se graban desde el hilo de clock
+        print("--record no es compatible con --clock-process: se usará el hilo de clock de este proceso.")
+        args.clock_process = False
 
-    performance_state.output_ports = opened_port_objects
+    # Abrir puertos (en el proceso de clock, si se ha pedido)
+    virtual_name = args.vp_out if args.virtual_ports else None
+    if args.clock_process:
+        clock_process = ClockProcess.launch({
+            "main_config": main_config, "device_aliases": global_device_aliases, "bpm": performance_state.bpm,
+            "quantize": performance_state.quantize, "beats_per_bar": performance_state.beats_per_bar,
+            "output_rates": performance_state.output_rates, "domains": performance_state.domain_configs,
+            "port_names": selected_port_names, "virtual_name": virtual_name, "timing_dump": args.timing_dump})
+        if clock_process is None:
+            print("Se usará el hilo de clock de este proceso.")
+    if clock_process is None:
+        set_output_ports(open_clock_outputs(selected_port_names, virtual_name))
+        clock_domains.extend(open_clock_domains(performance_state.domain_configs))
+    output_count = len(clock_process.output_names) if clock_process is not None else len(performance_state.output_ports)
 
-    if not performance_state.output_ports:
+    if not output_count:
         print("Advertencia: No hay puertos de salida activos. El clock no se enviará a ningún destino MIDI.")
 
+    if args.record:
+        try:
+            session_recorder = SessionRecorder.from_path_template(args.record, session_settings()).start()
+            print(f"Grabando la sesión en '{session_recorder.path}'.")
+        except OSError as e:
+            print(f"Advertencia: no se pudo abrir la grabación '{args.record}': {e}")
+
+    # Iniciar hilo de clock MIDI en cuanto hay salidas; OSC, entradas y UI se preparan después
+    if clock_process is None:
+        midi_clock_thread = threading.Thread(target=midi_clock_sender, daemon=True)
+        midi_clock_thread.start()
+        if args.realtime: clock_engine_ready.wait(5.0)
+    if args.realtime:
+        print("Modo tiempo real del clock:")
+        for line in performance_state.realtime_report: print(f"  {line}")
+
     # Iniciar cliente y servidor OSC si está habilitado
     osc_config = main_config.get("osc_configuration", {})
     osc_server_object = None
     if osc_config.get("enabled"):
-        send_ip = osc_config.get("send_ip", "127.0.0.1")
-        send_port = osc_config.get("send_port", 9000)
-        osc_client = udp_client.SimpleUDPClient(send_ip, send_port)
-        print(f"OSC: Enviando actualizaciones a {send_ip}:{send_port}")
+        load_osc_modules()
+        osc_client = OscSender.from_config(osc_config)
+        print(f"OSC: Enviando actualizaciones a {', '.join(f'{ip}:{port}' for ip, port in osc_client.targets)}")
 
-        disp = dispatcher.Dispatcher()
-        disp.map(OSC_ADDRESSES["PLAY"], play_clock)
-        disp.map(OSC_ADDRESSES["STOP"], stop_clock)
-        disp.map(OSC_ADDRESSES["PAUSE"], pause_clock)
-        disp.map(OSC_ADDRESSES["SET_BPM"], _handle_osc_bpm_set)
+        disp = build_osc_dispatcher()
 
         listen_ip = osc_config.get("listen_ip", "0.0.0.0")
         listen_port = osc_config.get("listen_port", 8000)
@@ -688,43 +4000,50 @@ def main():
             print(f"Error fatal iniciando servidor OSC en {listen_ip}:{listen_port} - {e}")
             print("La funcionalidad de recepción OSC estará desactivada.")
 
-    # Iniciar hilo de clock MIDI
-    midi_clock_thread = threading.Thread(target=midi_clock_sender, daemon=True)
-    midi_clock_thread.start()
-
     # Abrir puertos de entrada MIDI con callbacks si hay mapeos
-    midi_input_ports = {}
     if midi_filters:
-        required_dev_aliases = {m.get("device_in") for m in midi_filters if m.get("device_in")}
-        
-        for alias in required_dev_aliases:
-            dev_substr = global_device_aliases.get(alias, alias)
-            port_name = find_port_by_substring(mido.get_input_names(), dev_substr)
-            if port_name and port_name not in midi_input_ports:
-                try:
-                    # Crear un callback que capture el nombre del puerto y lo envíe al despachador global
-                    callback_func = lambda msg, name=port_name: global_midi_callback(msg, name)
-                    port = mido.open_input(port_name, callback=callback_func)
-                    midi_input_ports[port_name] = port
-                    print(f"Puerto de entrada '{port_name}' para mapeos abierto.")
-                except Exception as e:
-                    print(f"Error abriendo puerto de entrada '{port_name}': {e}")
-    
+        open_thru_outputs()
+        rebuild_rule_dispatcher(report=print)
+        open_mapping_inputs()
+    open_follow_input()
+    # Reconexión de dispositivos; las salidas del proceso de clock las vigila ese proceso
+    device_monitor = start_device_monitor(clock=clock_process is None)
 
-    status_window = Window(content=FormattedTextControl(text=get_status_text, focusable=False), height=4, style="bg:#444444 #ffffff")
-    feedback_window = Window(content=FormattedTextControl(text=get_feedback_line_text, focusable=False), height=2, style="bg:#222222 #aaaaaa")
-    
-    layout = Layout(HSplit([status_window, feedback_window]))
-    kb = build_key_bindings()
-    
-    global app_ui_instance
-    app_ui_instance = Application(layout=layout, key_bindings=kb, full_screen=False, refresh_interval=0.1, mouse_support=False)
+    # Recarga en caliente de las reglas: el despachador nuevo se publica sin parar el clock
+    rule_watcher = None
+    reload_interval_ms = main_config.get("general_settings", {}).get("rules_reload_interval_ms", 500)
+    if loaded_rule_files and isinstance(reload_interval_ms, (int, float)) and reload_interval_ms > 0:
+        rule_watcher = RuleWatcher(loaded_rule_files, reload_interval_ms / 1000).start()
+
+    control_path = args.control_socket or (DEFAULT_CONTROL_SOCKET if args.headless else None)
+    control_server = start_control_server(control_path) if control_path else None
+    if control_server is not None:
+        print(f"Control: escuchando comandos en {control_path}")
+
+    if not args.headless:
+        load_ui_modules()
+        status_window = Window(content=FormattedTextControl(text=get_status_text, focusable=False), height=5 + bool(clock_domains), style="bg:#444444 #ffffff")
+        feedback_window = Window(content=FormattedTextControl(text=get_feedback_line_text, focusable=False), height=2, style="bg:#222222 #aaaaaa")
+        
+        layout = Layout(HSplit([status_window, feedback_window]))
+        kb = build_key_bindings()
+        
+        # Sin refresh_interval: la UI se redibuja cuando cambia el estado (ver UiRefresher)
+        app_ui_instance = Application(layout=layout, key_bindings=kb, full_screen=False, min_redraw_interval=0.05, mouse_support=False)
+        ui_refresher.configure(main_config.get("general_settings", {}))
+        ui_refresher.start()
 
-    print("\nIniciando interfaz de midimaster...")
-    print("Controles: Números (BPM), +/- (BPM), Espacio/c (Play/Pause), Enter (Play/Stop), p (Play), s (Stop), b (Bloqueo BPM), q/Esc (Salir)")
+        print("\nIniciando interfaz de midimaster...")
+        print("Controles: Números (BPM), +/- (BPM), Espacio/c (Play/Pause), Enter (Play/Stop), p (Play), s (Stop), b (Bloqueo BPM), q/Esc (Salir)")
+    else:
+        print("\nmidimaster en marcha sin interfaz (Ctrl+C, SIGTERM o 'quit' por el socket de control para salir).")
     
     try:
-        app_ui_instance.run()
+        if args.headless:
+            while not SHUTDOWN_FLAG: # El manejador de señales solo levanta SHUTDOWN_FLAG
+                shutdown_requested.wait(0.5)
+        else:
+            app_ui_instance.run()
     except KeyboardInterrupt: 
         SHUTDOWN_FLAG = True
     except Exception as e:
@@ -733,8 +4052,18 @@ def main():
         SHUTDOWN_FLAG = True
     finally:
         SHUTDOWN_FLAG = True 
+        wake_clock_engine()
+        request_ui_refresh()
         print("\nCerrando midimaster...")
 
+        if control_server is not None:
+            control_server.close()
+        if rule_watcher is not None:
+            rule_watcher.stop()
+        stop_rule_parser()
+        if device_monitor is not None:
+            device_monitor.stop()
+
         # Apagar servidor OSC
         if osc_server_object:
             osc_server_object.shutdown()
@@ -743,17 +4072,23 @@ def main():
             print("Servidor OSC detenido.")
         if midi_clock_thread and midi_clock_thread.is_alive():
             midi_clock_thread.join(timeout=0.2) # Reducir timeout para cierre más rápido
+        if osc_client is not None:
+            osc_client.close() # Tras el clock: envía su último estado pendiente
+
+        # Resumen y volcado del timing del clock (el proceso de clock hace los suyos al cerrarse)
+        if clock_process is not None:
+            clock_process.stop()
+        else:
+            print_timing_report(args.timing_dump)
+        if latency_tracer is not None:
+            for line in latency_tracer.report_lines(): print(line)
+        if session_recorder is not None: # Lo que llegue después ya no se vuelca
+            records, dropped = session_recorder.stop()
+            print(f"Sesión grabada en '{session_recorder.path}' ({records} registros, {dropped} perdidos).")
         
-        # Cerrar puertos de salida
-        # Crear una copia de la lista para iterar, ya que podríamos estar modificándola indirectamente
-        ports_to_close = list(performance_state.output_ports)
-        performance_state.output_ports.clear() # Limpiar la lista original
-        for port in ports_to_close:
-            try:
-                if hasattr(port, 'panic'): port.panic() 
-                if not port.closed: port.close()
-                print(f"Puerto de salida '{port.name}' cerrado.")
-            except Exception: pass
+        # Cerrar puertos de salida (los de los dominios antes, para no cerrar dos veces los compartidos)
+        close_clock_domains()
+        close_clock_outputs()
         
         # Cerrar puertos de entrada
         inputs_to_close = list(midi_input_ports.values())
@@ -763,6 +4098,14 @@ def main():
                 if not port_obj.closed: port_obj.close()
                 # print(f"Puerto de entrada '{port_obj.name}' cerrado.") # El nombre no siempre está disponible así
             except Exception: pass
+
+        # Cerrar puertos thru que no sean también salidas de clock
+        thru_to_close = {id(port): port for port, _ in thru_outputs.values()}
+        thru_outputs.clear()
+        for port in thru_to_close.values():
+            try:
+                if not port.closed: port.close()
+            except Exception: pass
         print("midimaster detenido.")
 
 